@@ -1,4 +1,6 @@
 import logging
+import os
+import nanocomp.progress as progress
 import nanocomp.utils as utils
 
 def main():
@@ -10,11 +12,13 @@ def main():
     """
 
     settings, args = utils.get_args()
-    from nanomath import write_stats
 
     try:
         utils.make_output_dir(args.outdir)
         utils.init_logs(args)
+        if args.progress:
+            progress.init(args.progress)
+        progress.stage("plan")
         sources = {
             "fastq": args.fastq,
             "fastq_rich": args.fastq_rich,
@@ -24,207 +28,321 @@ def main():
             "fasta": args.fasta,
             "ubam": args.ubam,
         }
-        if args.split_runs:
-            split_dict = utils.validate_split_runs_file(args.split_runs)
-        if args.pickle:
-            from nanoget import combine_dfs
-            import pickle
-
-            datadf = combine_dfs(
-                dfs=[pickle.load(open(p, "rb")) for p in args.pickle],
+        split_dict = utils.validate_split_runs_file(args.split_runs) if args.split_runs else None
+        from nanocomp.planner import make_plan, log_peak_memory
+
+        sources.update(pickle=args.pickle, feather=args.feather)
+        source = [n for n, s in sources.items() if s][0]
+        plan = make_plan(
+            source,
+            sources[source],
+            threads=args.threads,
+            max_memory=args.max_memory,
+            sample=args.quick,
+            prefetch=args.prefetch,
+            # sampling isn't possible per barcode or run
+            auto_sample=args.max_memory is not None and not (args.barcoded or args.split_runs),
+        )
+        settings["subsample"] = plan.subsample
+        progress.stage(
+            "ingest", total=sum(os.path.getsize(f) for f in sources[source]), unit="bytes"
+        )
+        extras = {}
+        if args.pickle or args.feather:
+            from nanocomp.extraction import get_stored
+
+            datadf = get_stored(
+                source=source,
+                files=sources[source],
+                threads=plan.threads,
+                names=args.names,
+                sample=plan.sample,
+                extras=extras,
+                time_window=args.time_window,
+                split=split_dict,
+            )
+        elif plan.sample:
+            from nanocomp.quick import get_sample
+
+            datadf, extras["quick"] = get_sample(
+                source=source,
+                files=sources[source],
+                n=plan.sample,
+                threads=plan.threads,
+                readtype=args.readtype,
                 names=args.names,
-                method="track",
+                batch_size=plan.batch_size,
+                time_window=args.time_window,
+                prefetch=plan.prefetch,
             )
-        elif args.feather:
-            from nanoget import combine_dfs
-            from pandas import read_feather
-
-            datadf = combine_dfs(
-                [read_feather(p) for p in args.feather],
-                names=args.names or args.feather,
-                method="track",
-            ).rename(columns={"identities": "percentIdentity"})
         else:
-            from nanoget import get_input
+            from nanocomp.extraction import get_input
 
             datadf = get_input(
-                source=[n for n, s in sources.items() if s][0],
-                files=[f for f in sources.values() if f][0],
-                threads=args.threads,
+                source=source,
+                files=sources[source],
+                threads=plan.threads,
                 readtype=args.readtype,
                 names=args.names,
                 barcoded=args.barcoded,
-                combine="track",
+                batch_size=plan.batch_size,
+                extras=extras,
+                time_window=args.time_window,
+                split=split_dict,
+                prefetch=plan.prefetch,
+            )
+        if args.mux_scan:
+            from nanocomp.extraction import get_mux_scan
+
+            extras["mux_scan"] = get_mux_scan(
+                args.mux_scan, names=args.names or sources[source], threads=plan.threads
             )
+        progress.stage("filter")
         from nanoplot.filteroptions import filter_and_transform_data
         datadf, settings = filter_and_transform_data(datadf, vars(args))
         if args.raw:
-            datadf.to_csv(
-                settings["path"] + "NanoComp-data.tsv.gz",
-                sep="\t",
-                index=False,
-                compression="gzip",
-            )
+            from nanocomp.export import write_raw
+
+            write_raw(datadf, settings["path"], fmt=args.raw_format, threads=plan.threads)
         if args.store:
             import pickle
             pickle.dump(obj=datadf, file=open(settings["path"] + "NanoComp-data.pickle", "wb"))
-        if args.split_runs:
-            utils.change_identifiers(datadf, split_dict)
         if args.barcoded:
             datadf["dataset"] = datadf["barcode"]
             datadf = datadf.sort_values(by=["dataset"])
-        identifiers = list(datadf["dataset"].unique())
-        stats_df = write_stats(
-            datadfs=[datadf[datadf["dataset"] == i] for i in identifiers],
-            outputfile=settings["path"] + "NanoStats.txt",
-            names=identifiers,
-            as_tsv=args.tsv_stats,
-        )
-        if args.plot != "false":
-            plots = make_plots(datadf, settings)
-            make_report(plots, settings["path"], stats_df=stats_df)
+        progress.stage("stats")
+        from nanocomp.aggregate import Aggregator, write_stats
+
+        with Aggregator(datadf, threads=plan.threads) as aggregator:
+            stats_df = write_stats(
+                aggregator,
+                outputfile=settings["path"] + "NanoStats.txt",
+                names=aggregator.datasets,
+                as_tsv=args.tsv_stats,
+                end_reasons=extras.get("end_reasons"),
+                quick=extras.get("quick"),
+            )
+            if args.time_table:
+                progress.stage("time_table")
+                if "start_time" in aggregator:
+                    from nanocomp.export import write_time_table
+
+                    write_time_table(aggregator, settings["path"], fmt=args.raw_format)
+                else:
+                    logging.info("NanoComp: No time table written, no start_time in data.")
+            if args.plot != "false":
+                plots = make_plots(datadf, settings, aggregator=aggregator, extras=extras)
+                progress.stage("report")
+                make_report(
+                    plots,
+                    settings["path"],
+                    stats_df=stats_df,
+                    quick=extras.get("quick"),
+                    paginate=args.paginate,
+                )
+        log_peak_memory(plan)
         logging.info("Succesfully processed all input.")
+        progress.finish()
     except Exception as e:
         logging.error(e, exc_info=True)
+        progress.finish(error=str(e))
         raise
 
 
-def make_plots(df, settings):
+def make_plots(df, settings, aggregator=None, extras=None):
+    """Make the plots selected with --plots and --exclude_plots.
+
+    Plots lacking the required columns in the data are skipped,
+    and data derived for plotting is only prepared when a plot that is made needs it.
+    With --cache, plots made earlier from the same data and settings are reused.
+    Plots of all reads are aggregated per dataset by the aggregator, see nanocomp.aggregate.
+    <extras> is the data collected during extraction which is not in the DataFrame.
+    Returns the plots made, by name.
+    """
     import nanocomp.compplots as compplots
-    import numpy as np
-    from nanoplot.utils import subsample_datasets
+    from nanocomp.derived import DerivedData
+    from nanocomp.static import export_images, image_formats
     from itertools import cycle
     import plotly.colors
 
-    sub_df = subsample_datasets(df)
-    df["log length"] = np.log10(df["lengths"])
-    sub_df["log length"] = np.log10(sub_df["lengths"])
+    extras = extras or {}
+    # the factor per dataset to extrapolate totals of a sample (--quick)
+    scale = None
+    if extras.get("quick") is not None:
+        from nanocomp.quick import factors
+
+        scale = factors(extras["quick"])
+    selected = []
+    for name in settings["plots"]:
+        missing = [c for c in utils.PLOTS[name] if c not in df and extras.get(c) is None]
+        if missing:
+            logging.info(f"NanoComp: Skipping plot {name}, no {' or '.join(missing)} in data.")
+        else:
+            selected.append(name)
+    logging.info(f"NanoComp: Making plots {', '.join(selected) or 'none'}.")
 
     # Create a consistent color dictionary for ALL plots upfront
     datasets = df["dataset"].unique()
     palette = settings["colors"] if settings["colors"] else cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
     settings["colordict"] = {dataset: color for dataset, color in zip(datasets, palette)}
 
-    plots = []
-    plots.extend(
-        compplots.output_barplot(
-            df=df, path=settings["path"], title=settings["title"], settings=settings
-        )
-    )
-    plots.extend(
-        compplots.n50_barplot(
-            df=sub_df, path=settings["path"], title=settings["title"], settings=settings
-        )
-    )
-    plots.extend(
-        compplots.violin_or_box_plot(
-            df=sub_df[sub_df["length_filter"]],
-            y="lengths",
+    if settings["cache"]:
+        from nanocomp.cache import PlotCache
+
+        cache = PlotCache(settings["cache"], df, settings, extras=extras)
+        cached = {name: cache.load(name) for name in selected}
+    else:
+        cached = {}
+
+    # Plots use all reads, aggregated per dataset, except box plots which use a subsample,
+    # of which the derived columns are only calculated by the plots using them
+    aggregator = compplots.aggregator_of(df, aggregator)
+    data = DerivedData(df, subsample_size=settings.get("subsample", 10000))
+
+    def violin_or_box_plot(y, y_name, where=None, log=False):
+        """Violins and ridges are drawn from the density of all reads, box plots of a subsample."""
+        return compplots.violin_or_box_plot(
+            df=data.subsample().frame(y, where=where) if settings["plot"] == "box" else df,
+            y=y,
             path=settings["path"],
-            y_name="Read length",
+            y_name=y_name,
             plot=settings["plot"],
+            log=log,
             title=settings["title"],
             settings=settings,
+            aggregator=aggregator,
+            where=where,
         )
-    )
-    plots.extend(
-        compplots.violin_or_box_plot(
-            df=sub_df[sub_df["length_filter"]],
-            y="log length",
+
+    def overlay_histogram(name):
+        return compplots.overlay_histogram(
+            df=df, path=settings["path"], settings=settings, plots=[name], aggregator=aggregator
+        )
+
+    makers = {
+        "number_of_reads": lambda: compplots.output_barplot(
+            df=df,
+            path=settings["path"],
+            title=settings["title"],
+            settings=settings,
+            plots=["number_of_reads"],
+            scale=scale,
+        ),
+        "total_throughput": lambda: compplots.output_barplot(
+            df=df,
             path=settings["path"],
+            title=settings["title"],
+            settings=settings,
+            plots=["total_throughput"],
+            scale=scale,
+        ),
+        "N50": lambda: compplots.n50_barplot(
+            df=df,
+            path=settings["path"],
+            title=settings["title"],
+            settings=settings,
+            aggregator=aggregator,
+        ),
+        "lengths": lambda: violin_or_box_plot(
+            y="lengths", y_name="Read length", where="length_filter"
+        ),
+        "log_length": lambda: violin_or_box_plot(
+            y="log length",
             y_name="Log-transformed read length",
-            plot=settings["plot"],
+            where="length_filter",
             log=True,
+        ),
+        "quals": lambda: violin_or_box_plot(y="quals", y_name="Average base call quality score"),
+        "sequencing_speed": lambda: compplots.compare_sequencing_speed(
+            df=df,
+            path=settings["path"],
             title=settings["title"],
             settings=settings,
-        )
-    )
-    if "quals" in df:
-        plots.extend(
-            compplots.violin_or_box_plot(
-                df=sub_df,
-                y="quals",
-                path=settings["path"],
-                y_name="Average base call quality score",
-                plot=settings["plot"],
-                title=settings["title"],
-                settings=settings,
-            )
-        )
-    if "duration" in df:
-        plots.extend(
-            compplots.compare_sequencing_speed(
-                df=sub_df,
-                path=settings["path"],
-                title=settings["title"],
-                settings=settings,
-            )
-        )
-    if "percentIdentity" in df:
-        plots.extend(
-            compplots.violin_or_box_plot(
-                df=sub_df[sub_df["percentIdentity"] > np.percentile(sub_df["percentIdentity"], 1)],
-                y="percentIdentity",
-                path=settings["path"],
-                y_name="Percent reference identity",
-                plot=settings["plot"],
-                title=settings["title"],
-                settings=settings,
-            )
-        )
-        plots.append(
+            aggregator=aggregator,
+        ),
+        "identity": lambda: violin_or_box_plot(
+            y="percentIdentity", y_name="Percent reference identity", where="identity_filter"
+        ),
+        "identity_histogram": lambda: [
             compplots.overlay_histogram_identity(
-                df=sub_df[sub_df["percentIdentity"] > np.percentile(sub_df["percentIdentity"], 1)],
+                df=df,
                 path=settings["path"],
                 settings=settings,
+                aggregator=aggregator,
+                where="identity_filter",
             )
-        )
-
-        plots.append(
+        ],
+        "phred_histogram": lambda: [
             compplots.overlay_histogram_phred(
-                df=sub_df[sub_df["percentIdentity"] > np.percentile(sub_df["percentIdentity"], 1)],
-                path=settings["path"],
-                settings=settings,
-            )
-        )
-
-    if "start_time" in df:
-        plots.extend(
-            compplots.compare_cumulative_yields(
                 df=df,
                 path=settings["path"],
-                title=settings["title"],
                 settings=settings,
+                aggregator=aggregator,
+                where="identity_filter",
             )
-        )
-    if "channelIDs" in df:
-        plots.append(
+        ],
+        "cumulative_yield": lambda: compplots.compare_cumulative_yields(
+            df=df,
+            path=settings["path"],
+            title=settings["title"],
+            settings=settings,
+            aggregator=aggregator,
+            scale=scale,
+        ),
+        "active_pores": lambda: [
             compplots.active_pores_over_time(
                 df=df,
                 path=settings["path"],
                 title=settings["title"],
                 settings=settings,
+                aggregator=aggregator,
             )
-        )
-    plots.extend(
-        compplots.overlay_histogram(
-            df=sub_df,
+        ],
+        "end_reasons": lambda: compplots.end_reason_barplot(
+            extras["end_reasons"], path=settings["path"], settings=settings, title=settings["title"]
+        ),
+        "end_reasons_relative": lambda: compplots.end_reason_barplot(
+            extras["end_reasons"],
             path=settings["path"],
             settings=settings,
-        )
-    )
-    return plots
+            title=settings["title"],
+            relative=True,
+        ),
+        "mux_scan": lambda: compplots.mux_scan_plot(
+            extras["mux_scan"], path=settings["path"], settings=settings, title=settings["title"]
+        ),
+    }
+    for name in compplots.HISTOGRAMS:
+        makers[name] = lambda name=name: overlay_histogram(name)
 
+    plots = []
+    images = []
+    progress.stage("plots", total=len(selected), unit="plots")
+    for name in selected:
+        if cached.get(name):
+            plot = cached[name]
+            images.append((plot, cache.missing_images(name)))
+        else:
+            plot = makers[name]()[0]
+            images.append((plot, image_formats(settings)))
+        # written to its html file already, from which the report copies it
+        plot.html = None
+        plots.append(plot)
+        progress.advance(plot=name, cached=bool(cached.get(name)))
+    saved = export_images(images, settings)
+    if settings["cache"]:
+        for name, plot in zip(selected, plots):
+            cache.store(name, plot, images=plot in saved)
+    for plot in plots:
+        # all files of the plot are written
+        plot.fig = plot.json = None
+    return dict(zip(selected, plots))
 
-def make_report(plots, path, stats_df):
-    """
-    Creates a fat html report based on the previously created files
-    plots is a list of Plot objects defined by a path and title
-    statsfile is the file to which the stats have been saved,
-    which is parsed to a table (rather dodgy)
-    """
-    logging.info("Writing html report.")
-    html_head = """<!DOCTYPE html>
+
+# The report is split in pages (as with --paginate) when the plots together exceed this size
+REPORT_SIZE = 64 << 20
+
+REPORT_HEAD = """<!DOCTYPE html>
     <html>
         <head>
         <meta charset="UTF-8">
@@ -401,52 +519,134 @@ li {
             <title>NanoComp Report</title>
         </head>"""
 
-    html_content = []
-    html_content.append('<body><nav><ul><li><a href="#stats">Summary Statistics</a></li>')
-    html_content.append('<li class="submenu"><a href="#plots" class="submenubtn">Plots</a>')
-    html_content.append('<ul class="submenu-items">')
-    html_content.extend(
-        ['<li><a href="#' + p.title.replace(" ", "_") + '">' + p.title + "</a></li>" for p in plots]
-    )
-    html_content.append("</ul>")
-    html_content.append("</li>")
-    html_content.append(
-        '<li class="issue-btn"><a href="https://github.com/wdecoster/nanocomp/issues" target="_blank"  class="reporting">Report issue on Github</a></li>'
-    )
-    html_content.append("</ul></nav>")
-    html_content.append("<h1>NanoComp report</h1>")
-    html_content.append("<h2 id='stats'>Summary statistics</h2><div class='tablewrapper'>")
-    if stats_df is not None:
-        html_content.append(stats_df.to_html())
-    else:
-        html_content.append(utils.stats2html(path + "NanoStats.txt"))
-    # html_content.append('\n<br>\n<br>\n<br>\n<br>')
-    html_content.append("</div><h2 id='plots'>Plots</h2>")
+REPORT_SCRIPT = (
+    '<script>var coll = document.getElementsByClassName("collapsible");var i;for (i = 0; i < coll.length; i++) {'
+    'coll[i].addEventListener("click", function() {this.classList.toggle("active");var content = '
+    'this.nextElementSibling;if (content.style.display === "none") {content.style.display = "block";} else {'
+    'content.style.display = "none";}});}</script>'
+)
+
+REPORT_ISSUES = (
+    '<li class="issue-btn"><a href="https://github.com/wdecoster/nanocomp/issues" target="_blank"  class="reporting">Report issue on Github</a></li>'
+)
+
+
+def make_report(plots, path, stats_df, quick=None, paginate=False):
+    """
+    Creates a fat html report based on the previously created files
+    plots is a dictionary of Plot objects defined by a path and title, by plot name
+    statsfile is the file to which the stats have been saved,
+    which is parsed to a table (rather dodgy)
+    quick is the table of sampled and estimated reads with --quick, noted below the stats
+    The report is written to disk plot by plot. With paginate (--paginate), or if the plots
+    together are larger than REPORT_SIZE, the report is an index page with the stats and
+    links to a page per group of plots (utils.REPORT_PAGES).
+    """
+    logging.info("Writing html report.")
+    report = path + "NanoComp-report.html"
+    size = sum(os.path.getsize(p.path) for p in plots.values())
+    if plots and not paginate and size > REPORT_SIZE:
+        logging.info("NanoComp: Splitting the report in pages, the plots are too large for one.")
+        paginate = True
+    pages = report_pages(plots, path) if paginate else []
+    with open(report, "w") as html_file:
+        html_file.write(REPORT_HEAD + "\n")
+        html_file.write('<body><nav><ul><li><a href="#stats">Summary Statistics</a></li>\n')
+        if pages:
+            write_menu(html_file, "Pages", [(p.title, os.path.basename(p.path)) for p in pages])
+        elif plots:
+            write_menu(html_file, "Plots", [(p.title, anchor(p)) for p in plots.values()], "#plots")
+        html_file.write(REPORT_ISSUES + "\n</ul></nav>\n<h1>NanoComp report</h1>\n")
+        html_file.write("<h2 id='stats'>Summary statistics</h2><div class='tablewrapper'>\n")
+        if stats_df is not None:
+            html_file.write(stats_df.to_html() + "\n")
+        else:
+            html_file.write(utils.stats2html(path + "NanoStats.txt") + "\n")
+        if quick is not None:
+            from nanocomp.quick import report_note
+
+            html_file.write(report_note(quick) + "\n")
+        html_file.write("</div>\n")
+        if pages:
+            html_file.write("<h2 id='plots'>Plots</h2><ul class='pages'>\n")
+            for page in pages:
+                html_file.write(
+                    f'<li><a href="{os.path.basename(page.path)}">{page.title}</a>: '
+                    f"{', '.join(p.title for p in page.plots)}</li>\n"
+                )
+            html_file.write("</ul>\n")
+        elif plots:
+            html_file.write("<h2 id='plots'>Plots</h2>\n")
+            write_plots(html_file, plots.values())
+        html_file.write(REPORT_SCRIPT + "</body></html>")
+    for page in pages:
+        write_page(page, report, pages)
+    return report
+
+
+class ReportPage(object):
+    """A page of the report, with the plots of a group."""
+
+    def __init__(self, path, title, plots):
+        self.path = path
+        self.title = title
+        self.plots = plots
+
+
+def report_pages(plots, path):
+    """Return the pages of the report with the plots made, by group of utils.REPORT_PAGES."""
+    pages = []
+    for key, (title, names) in utils.REPORT_PAGES.items():
+        page_plots = [plots[name] for name in names if name in plots]
+        if page_plots:
+            pages.append(ReportPage(path + f"NanoComp-report-{key}.html", title, page_plots))
+    return pages
+
+
+def write_page(page, report, pages):
+    """Write a page of the report, linking back to the statistics and to the other pages."""
+    index = os.path.basename(report)
+    with open(page.path, "w") as html_file:
+        html_file.write(REPORT_HEAD.replace("NanoComp Report", f"NanoComp {page.title}") + "\n")
+        html_file.write(f'<body><nav><ul><li><a href="{index}#stats">Summary Statistics</a></li>\n')
+        write_menu(html_file, "Pages", [(p.title, os.path.basename(p.path)) for p in pages])
+        write_menu(html_file, "Plots", [(p.title, anchor(p)) for p in page.plots], "#plots")
+        html_file.write(REPORT_ISSUES + "\n</ul></nav>\n")
+        html_file.write(f"<h1>NanoComp report</h1>\n<h2 id='plots'>{page.title}</h2>\n")
+        write_plots(html_file, page.plots)
+        html_file.write(REPORT_SCRIPT + "</body></html>")
+
+
+def write_menu(html_file, name, links, target=None):
+    """Write a submenu of the navigation bar, of (title, link) tuples."""
+    href = f' href="{target}"' if target else ""
+    html_file.write(f'<li class="submenu"><a{href} class="submenubtn">{name}</a>\n')
+    html_file.write('<ul class="submenu-items">\n')
+    for title, link in links:
+        html_file.write(f'<li><a href="{link}">{title}</a></li>\n')
+    html_file.write("</ul>\n</li>\n")
+
+
+def anchor(plot):
+    return "#" + plot.title.replace(" ", "_")
+
+
+def write_plots(html_file, plots):
+    """Write the plots as collapsible sections, one after the other, copied from their html file."""
+    import shutil
 
     for plot in plots:
-        html_content.append('<button class="collapsible">' + plot.title + "</button>")
-        html_content.append(
+        html_file.write('<button class="collapsible">' + plot.title + "</button>\n")
+        html_file.write(
             '<section class="collapsible-content"><h4 class="hiddentitle" id="'
             + plot.title.replace(" ", "_")
             + '">'
             + plot.title
-            + "</h4>"
+            + "</h4>\n"
         )
-        html_content.append(plot.encode())
-        html_content.append("</section>")
-
-    html_content.append(
-        '<script>var coll = document.getElementsByClassName("collapsible");var i;for (i = 0; i < coll.length; i++) {'
-        'coll[i].addEventListener("click", function() {this.classList.toggle("active");var content = '
-        'this.nextElementSibling;if (content.style.display === "none") {content.style.display = "block";} else {'
-        'content.style.display = "none";}});}</script>'
-    )
-
-    html_body = "\n".join(html_content) + "</body></html>"
-    html_str = html_head + html_body
-    with open(path + "NanoComp-report.html", "w") as html_file:
-        html_file.write(html_str)
-    return path + "NanoComp-report.html"
+        with open(plot.path) as plot_html:
+            shutil.copyfileobj(plot_html, html_file)
+        html_file.write("\n</section>\n")
 
 
 if __name__ == "__main__":
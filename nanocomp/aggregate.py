@@ -0,0 +1,371 @@
+"""Aggregating the data per dataset in a pool of worker processes.
+
+The numeric columns are copied once to shared memory, ordered by dataset, after which every
+dataset is aggregated in a separate task. Workers read the columns of their dataset from the
+shared memory rather than getting a pickled copy of the data, and only return the aggregated
+result, such as the counts of a histogram or the statistics of the dataset.
+"""
+
+import concurrent.futures as cfutures
+import logging
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+from nanocomp.derived import DerivedData, PERCENTILES
+
+# Below this number of reads the aggregation is done in the main process
+MIN_ROWS_PARALLEL = 200000
+
+# The shared memory blocks and columns attached to by a worker process
+_shared = {}
+
+
+class Aggregator(object):
+    """The data of all datasets, with a pool of workers to aggregate it per dataset.
+
+    Use as a context manager, or call close() to stop the workers and free the shared memory.
+    With a single thread or a small amount of data, no workers or shared memory are used.
+    """
+
+    def __init__(self, df, threads=4):
+        import pandas as pd
+
+        self.df = df
+        codes, datasets = pd.factorize(df["dataset"], sort=False)
+        self.datasets = list(datasets)
+        self.order = np.argsort(codes, kind="stable")
+        self.bounds = np.searchsorted(codes[self.order], np.arange(len(self.datasets) + 1))
+        self.percentiles = {}
+        self.blocks = []
+        self.columns = {}
+        self.executor = None
+        workers = min(threads, len(self.datasets))
+        parallel = workers > 1 and len(df) >= MIN_ROWS_PARALLEL
+        spec = {}
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if column == "dataset" or values.dtype.kind not in "biufm":
+                continue
+            if parallel:
+                block = SharedMemory(create=True, size=max(values.nbytes, 1))
+                self.blocks.append(block)
+                shared = np.ndarray(len(values), dtype=values.dtype, buffer=block.buf)
+                np.take(values, self.order, out=shared)
+                self.columns[column] = shared
+                spec[column] = (block.name, values.dtype.str, len(values))
+            else:
+                self.columns[column] = values[self.order]
+        if parallel:
+            self.executor = cfutures.ProcessPoolExecutor(
+                max_workers=workers, initializer=attach, initargs=(spec,)
+            )
+            logging.info(
+                f"NanoComp: Aggregating {len(self.datasets)} datasets using {workers} workers."
+            )
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.columns = {}
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def percentile(self, column, q):
+        """Return a percentile of a column over all datasets, which is shared with all tasks."""
+        if (column, q) not in self.percentiles:
+            self.percentiles[(column, q)] = np.percentile(self.columns[column], q)
+        return self.percentiles[(column, q)]
+
+    def map(self, func, **kwargs):
+        """Return func(data, **kwargs) for every dataset, in the order of the datasets.
+
+        data is the DerivedData of the dataset, with all numeric and derived columns.
+        """
+        for name in [kwargs.get("column"), kwargs.get("where")]:
+            if name in PERCENTILES:
+                self.percentile(*PERCENTILES[name])
+        tasks = [
+            (func, start, end, self.percentiles, kwargs)
+            for start, end in zip(self.bounds[:-1], self.bounds[1:])
+        ]
+        if self.executor is None:
+            return [run_task(*task, arrays=self.columns) for task in tasks]
+        return list(self.executor.map(run_task, *zip(*tasks)))
+
+    def rows(self, index, positions):
+        """Return the row numbers in the DataFrame of the reads at positions in a dataset."""
+        return self.order[self.bounds[index] + np.asarray(positions, dtype=np.intp)]
+
+
+def attach(spec):
+    """Attach to the shared memory of the columns, when starting a worker process."""
+    for column, (name, dtype, length) in spec.items():
+        block = SharedMemory(name=name)
+        _shared[column] = (block, np.ndarray(length, dtype=dtype, buffer=block.buf))
+
+
+def run_task(func, start, end, percentiles, kwargs, arrays=None):
+    if arrays is None:
+        arrays = {column: values for column, (_, values) in _shared.items()}
+    data = DerivedData({column: values[start:end] for column, values in arrays.items()})
+    data.percentiles.update(percentiles)
+    return func(data, **kwargs)
+
+
+def values_of(data, column, where=None):
+    values = np.asarray(data.column(column))
+    return values[np.asarray(data.column(where))] if where else values
+
+
+def value_range(data, column, where=None):
+    values = values_of(data, column, where)
+    if len(values) == 0:
+        return np.nan, np.nan
+    return np.nanmin(values), np.nanmax(values)
+
+
+def n50(data, column):
+    from nanomath import get_N50
+
+    return get_N50(np.sort(data.column(column)))
+
+
+def histogram(data, column, bins, where=None, density=False, weights_column=None):
+    counts, _ = np.histogram(
+        values_of(data, column, where),
+        bins=bins,
+        density=density,
+        weights=values_of(data, weights_column, where) if weights_column else None,
+    )
+    return counts
+
+
+def density(data, column, where=None):
+    from nanocomp.kde import kde
+
+    return kde(values_of(data, column, where))
+
+
+def read_stats(data, read_ids=False):
+    """Return the nanomath Stats of a dataset.
+
+    With read_ids, the positions of the reads in the dataset are used as read IDs,
+    for Aggregator.rows() to find the read IDs of the reads in the top 5.
+    """
+    import pandas as pd
+    from nanomath import Stats
+
+    df = pd.DataFrame(data.df, copy=False)
+    if read_ids:
+        df["readIDs"] = np.arange(len(df))
+    stats = Stats(df)
+    for top5 in ["_top5_lengths", "_top5_quals"]:
+        if hasattr(stats, top5):
+            setattr(stats, top5, list(getattr(stats, top5)))
+    return stats
+
+
+def write_stats(aggregator, outputfile, names, as_tsv=False, end_reasons=None, quick=None):
+    """Write the statistics of all datasets, as nanomath.write_stats, calculated per dataset.
+
+    The number of reads per end reason is added if <end_reasons> is given,
+    see nanocomp.extraction.end_reasons.
+    Of a sample (--quick) the totals are extrapolated with the table of sampled and
+    estimated reads in <quick>, see nanocomp.quick.extrapolate.
+    """
+    from nanomath import write_stats_legacy
+
+    read_ids = "readIDs" in aggregator.df
+    stats = aggregator.map(read_stats, read_ids=read_ids)
+    if read_ids:
+        ids = aggregator.df["readIDs"].to_numpy()
+        for index, s in enumerate(stats):
+            for top5 in ["_top5_lengths", "_top5_quals"]:
+                if hasattr(s, top5):
+                    rows = aggregator.rows(index, [entry[-1] for entry in getattr(s, top5)])
+                    reads = [entry[:-1] + (ids[r],) for entry, r in zip(getattr(s, top5), rows)]
+                    setattr(s, top5, reads)
+    reasons = end_reason_lines(end_reasons, names) if end_reasons is not None else []
+    if quick is not None:
+        from nanocomp.quick import extrapolate, factors
+
+        scale = factors(quick)
+        stats = [extrapolate(s, scale.get(name, 1)) for s, name in zip(stats, names)]
+        sampled = quick["sampled"].reindex(names, fill_value=0).astype(str).tolist()
+    with open(outputfile, "wt") as output:
+        if as_tsv:
+            import pandas as pd
+
+            df = pd.DataFrame([s.to_dict() for s in stats]).transpose()
+            df.index.name = "Metrics"
+            df.columns = names
+            for reason, values in reasons:
+                df.loc[f"end_reason_{reason}"] = values
+            if quick is not None:
+                df.loc["sampled_reads"] = sampled
+            output.write(df.to_csv(sep="\t"))
+            return df
+        write_stats_legacy(stats, names, output, [aggregator.df.columns] * len(stats))
+        if reasons:
+            output.write("Number and percentage of reads per end reason\n")
+            for reason, values in reasons:
+                output.write(f"{reason}:\t" + "\t".join(values) + "\n")
+        if quick is not None:
+            output.write("Estimated from a sample of reads (--quick), totals are extrapolated\n")
+            output.write("Sampled reads:\t" + "\t".join(sampled) + "\n")
+
+
+def end_reason_lines(end_reasons, names):
+    """Return the end reasons with the number and percentage of reads of every dataset."""
+    end_reasons = end_reasons.reindex(columns=names, fill_value=0)
+    fractions = end_reasons / end_reasons.sum().replace(0, 1)
+    return [
+        (reason, [f"{n} ({f:.1%})" for n, f in zip(end_reasons.loc[reason], fractions.loc[reason])])
+        for reason in end_reasons.index
+    ]
+
+
+def time_limit(aggregator, days=5):
+    """Return the time after which reads are not used for plots over time, or None.
+
+    As nanoplotter.timeplots.check_valid_time_and_sort, if the data spans more than
+    <days> days, which likely indicates multiple runs are combined.
+    """
+    import sys
+
+    times = aggregator.columns["start_time"]
+    timediff = (np.nanmax(times) - np.nanmin(times)) // np.timedelta64(1, "D")
+    if timediff < days:
+        return None
+    sys.stderr.write(f"\nWarning: data generated is from more than {days} days.\n")
+    sys.stderr.write("Likely this indicates you are combining multiple runs.\n")
+    sys.stderr.write(
+        f"Plots based on time are invalid and therefore truncated to first {days} days.\n\n"
+    )
+    logging.warning(f"Time plots truncated to first {days} days: invalid timespan: {timediff} days")
+    return np.timedelta64(days, "D")
+
+
+def time_bins(data, limit, interval, columns, where=None):
+    """Return columns of the reads ordered by start time, their time bin and the bin starts.
+
+    The bins start at the first read, as with resample() of pandas for timedeltas,
+    and the start of every bin is returned in hours.
+    """
+    import pandas as pd
+
+    times = data.column("start_time")
+    keep = ~np.isnat(times)
+    if limit is not None:
+        keep &= times < limit
+    if where is not None:
+        keep &= where
+    order = np.argsort(times[keep], kind="stable")
+    times = times[keep][order]
+    values = [np.asarray(data.column(c))[keep][order] for c in columns]
+    if len(times) == 0:
+        return values, np.empty(0, dtype=np.intp), np.empty(0)
+    interval = np.timedelta64(interval, "m")
+    bins = ((times - times[0]) // interval).astype(np.intp)
+    starts = pd.TimedeltaIndex(times[0] + np.arange(bins[-1] + 1) * interval)
+    return values, bins, starts.total_seconds().to_numpy() / 3600
+
+
+def cumulative_yield(data, limit, interval=10):
+    """Return the hours and the cumulative yield in gigabases at the end of every bin."""
+    (lengths,), bins, hours = time_bins(data, limit, interval, ["lengths"])
+    return hours, binned_cumsum(lengths, bins, len(hours)) / 1e9
+
+
+def active_pores(data, limit, interval=10):
+    """Return the hours and the number of different channels active in every bin."""
+    (channels,), bins, hours = time_bins(data, limit, interval, ["channelIDs"])
+    return hours, binned_nunique(channels, bins, len(hours))
+
+
+def sequencing_speed(data, limit, interval=30):
+    """Return the hours and the median speed in nucleotides per second of reads in every bin."""
+    (lengths, durations), bins, hours = time_bins(
+        data, limit, interval, ["lengths", "duration"], where=data.column("duration") > 0
+    )
+    return hours, binned_median(lengths / durations, bins, len(hours))
+
+
+def time_metrics(data, limit, interval=10):
+    """Return a dictionary with the metrics of every time bin of <interval> minutes.
+
+    These are the start of the bin in hours, the number of reads and bases, the cumulative
+    yield in gigabases and, if the data has the columns to calculate them, the median speed
+    in nucleotides per second and the number of active pores.
+    """
+    columns = [c for c in ["lengths", "duration", "channelIDs"] if c in data.df]
+    values, bins, hours = time_bins(data, limit, interval, columns)
+    values = dict(zip(columns, values))
+    n = len(hours)
+    metrics = {
+        "hours": hours,
+        "reads": np.bincount(bins, minlength=n),
+        "bases": np.bincount(bins, weights=values["lengths"], minlength=n).astype(np.int64),
+        "cumulative_yield": binned_cumsum(values["lengths"], bins, n) / 1e9,
+    }
+    if "duration" in values:
+        valid = values["duration"] > 0
+        metrics["median_speed"] = binned_median(
+            values["lengths"][valid] / values["duration"][valid], bins[valid], n
+        )
+    if "channelIDs" in values:
+        metrics["active_pores"] = binned_nunique(values["channelIDs"], bins, n)
+    return metrics
+
+
+def time_table(aggregator, interval=10):
+    """Return a DataFrame with the time_metrics() of all datasets, a row per dataset and bin."""
+    import pandas as pd
+
+    tables = aggregator.map(time_metrics, limit=time_limit(aggregator), interval=interval)
+    return pd.concat(
+        [
+            pd.DataFrame({"dataset": dataset, **metrics})
+            for dataset, metrics in zip(aggregator.datasets, tables)
+        ],
+        ignore_index=True,
+    )
+
+
+def binned_cumsum(values, bins, n):
+    """Return the cumulative sum of the values at the end of every bin, NaN for empty bins.
+
+    The values are ordered by time and <bins> is the bin of every value, see time_bins().
+    """
+    sums = np.full(n, np.nan)
+    last = np.flatnonzero(np.diff(bins, append=n))
+    sums[bins[last]] = np.cumsum(values)[last]
+    return sums
+
+
+def binned_nunique(values, bins, n):
+    """Return the number of different values in every bin."""
+    pairs = np.unique(np.stack([bins, values.astype(np.int64)]), axis=1)
+    return np.bincount(pairs[0], minlength=n)
+
+
+def binned_median(values, bins, n):
+    """Return the median of the values in every bin, NaN for empty bins."""
+    order = np.lexsort((values, bins))
+    values, bins = values[order], bins[order]
+    medians = np.full(n, np.nan)
+    groups, first, sizes = np.unique(bins, return_index=True, return_counts=True)
+    lower, upper = values[first + (sizes - 1) // 2], values[first + sizes // 2]
+    medians[groups] = (lower + upper) / 2
+    return medians
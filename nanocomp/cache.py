@@ -0,0 +1,148 @@
+"""Reusing plots made by an earlier run of NanoComp on the same data with the same settings."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from nanocomp.static import image_formats
+from nanocomp.utils import PLOTS
+from nanocomp.version import __version__
+
+# Columns which, if present, are used by the plots in addition to the required ones
+OPTIONAL_COLUMNS = ("dataset", "length_filter", "aligned_lengths", "quick")
+
+# Settings that change the figure of only some of the plots, with the names of these plots
+PLOT_SETTINGS = {
+    "title": (
+        "number_of_reads",
+        "total_throughput",
+        "N50",
+        "lengths",
+        "log_length",
+        "quals",
+        "sequencing_speed",
+        "identity",
+        "cumulative_yield",
+        "active_pores",
+        "end_reasons",
+        "end_reasons_relative",
+        "mux_scan",
+    ),
+    "plot": ("lengths", "log_length", "quals", "identity"),
+    "subsample": ("lengths", "log_length", "quals", "identity"),
+}
+
+# Plots with colors of their own, which don't change with the colors of the datasets
+OWN_COLORS = ("end_reasons", "end_reasons_relative", "mux_scan")
+
+
+class PlotCache(object):
+    """A directory with the figures and static images of plots made earlier.
+
+    The plots are stored under a key made from the name of the plot, a fingerprint of the
+    data in the columns it uses and the settings changing its figure. For every plot the
+    figure is stored as JSON, which holds the values aggregated from the data, and every
+    static image made from it is stored under the key and the dpi of the image.
+    Cached plots are written to the output directory, so only their figures are reused,
+    while the plots that are not cached are made as usual and stored afterwards.
+    The extra data collected during extraction is fingerprinted like the columns.
+    """
+
+    def __init__(self, directory, df, settings, extras=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.df = df
+        self.settings = settings
+        self.extras = extras or {}
+        self.digests = {}
+
+    def fingerprint(self, column):
+        """Return a hash of the values in a column, calculated once per column."""
+        import pandas as pd
+
+        if column not in self.digests:
+            if column in self.extras:
+                hashes = self.extras[column].to_csv().encode()
+            else:
+                hashes = pd.util.hash_pandas_object(self.df[column], index=False).to_numpy()
+            self.digests[column] = hashlib.sha256(hashes).hexdigest()
+        return self.digests[column]
+
+    def key(self, name):
+        columns = [c for c in PLOTS[name] + OPTIONAL_COLUMNS if c in self.df or c in self.extras]
+        settings = {
+            s: self.settings.get(s) for s, names in PLOT_SETTINGS.items() if name in names
+        }
+        content = [
+            __version__,
+            name,
+            {c: self.fingerprint(c) for c in columns},
+            settings,
+        ]
+        if name not in OWN_COLORS:
+            content.append([[str(d), str(c)] for d, c in self.settings["colordict"].items()])
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def entry(self, name):
+        return os.path.join(self.directory, self.key(name))
+
+    def static_image(self, entry, figformat):
+        return f"{entry}_{self.settings['dpi']}dpi.{figformat}"
+
+    def load(self, name):
+        """Return the plot from the cache and write its output files, or None if not cached.
+
+        Only the static images made earlier are written, see missing_images().
+        """
+        from nanocomp.compplots import Plot, html_from_json
+
+        entry = self.entry(name)
+        try:
+            with open(entry + ".json") as cached:
+                meta = json.load(cached)
+        except (OSError, ValueError):
+            return None
+        logging.info(f"NanoComp: Reusing plot {name} from the cache.")
+        plot = Plot(path=self.settings["path"] + meta["file"], title=meta["title"])
+        plot.json = meta["figure"]
+        plot.html = html_from_json(plot.json, height=meta["height"])
+        plot.write(self.settings)
+        for figformat in image_formats(self.settings):
+            image = self.static_image(entry, figformat)
+            if os.path.exists(image):
+                shutil.copyfile(image, plot.path.replace(".html", f".{figformat}"))
+        return plot
+
+    def missing_images(self, name):
+        """Return the requested static formats of a plot which are not in the cache."""
+        entry = self.entry(name)
+        return [
+            f
+            for f in image_formats(self.settings)
+            if not os.path.exists(self.static_image(entry, f))
+        ]
+
+    def store(self, name, plot, images=True):
+        """Store the figure of a plot and, if <images>, the static images just made of it.
+
+        Figures and images which are already in the cache are left as is.
+        """
+        entry = self.entry(name)
+        if images:
+            for figformat in self.missing_images(name):
+                output = plot.path.replace(".html", f".{figformat}")
+                if os.path.exists(output):
+                    shutil.copyfile(output, self.static_image(entry, figformat))
+        if os.path.exists(entry + ".json"):
+            return
+        meta = {
+            "file": plot.path[len(self.settings["path"]) :],
+            "title": plot.title,
+            "height": plot.fig.layout.height,
+            "figure": plot.json,
+        }
+        # Written to a temporary file first, so an interrupted run doesn't leave an incomplete entry
+        with open(entry + ".json.tmp", "w") as cached:
+            json.dump(meta, cached)
+        os.replace(entry + ".json.tmp", entry + ".json")
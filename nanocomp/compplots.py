@@ -1,19 +1,92 @@
-from nanoplotter.plot import Plot
-from nanoplotter.timeplots import check_valid_time_and_sort
-from nanomath import get_N50
+import nanoplotter.plot
+import nanocomp.aggregate as aggregate
 import logging
 import numpy as np
 import plotly
 import plotly.graph_objs as go
 import sys
+import uuid
+from functools import lru_cache
 from itertools import cycle
 
 
-def violin_or_box_plot(df, y, path, y_name, settings, title=None, plot="violin", log=False):
+class Plot(nanoplotter.plot.Plot):
+    """A Plot of which the figure is serialized to JSON only once.
+
+    The JSON is reused for the html in the report, the html file, the json output
+    and the static images, rather than validating and encoding the figure again for each.
+    Static images other than json are exported for all plots together, see nanocomp.static.
+    """
+
+    def __init__(self, path, title):
+        super().__init__(path, title)
+        self.json = None
+
+    def export(self, settings):
+        """Serialize the figure, and save it as html and json."""
+        self.json = self.fig.to_json()
+        self.html = html_from_json(self.json, height=self.fig.layout.height)
+        self.write(settings)
+
+    def write(self, settings):
+        """Write the html file, and the json file if requested."""
+        with open(self.path, "w") as html_out:
+            html_out.write(self.html)
+        if not settings["no_static"] and "json" in [f.lower() for f in settings["format"]]:
+            self.save_static("json", settings)
+
+    def save_static(self, figformat, settings):
+        if figformat.lower() == "json" and self.json:
+            output_path = self.path.replace(".html", ".json")
+            with open(output_path, "w") as json_out:
+                json_out.write(self.json)
+            logging.info("Saved %s as JSON", output_path)
+        else:
+            super().save_static(figformat, settings)
+
+
+@lru_cache(maxsize=None)
+def plotlyjs_loader():
+    """Return the script tags loading plotly.js from the CDN, as written by plotly.
+
+    Plotly calculates a hash of the complete plotly.js library for each figure it converts
+    to html with include_plotlyjs="cdn", so this is done once and reused.
+    """
+    html = go.Figure().to_html(full_html=False, include_plotlyjs="cdn")
+    return html[html.index(">") + 1 : html.index('<div id="')]
+
+
+def html_from_json(fig_json, height=None):
+    """Return a html div with a figure, as fig.to_html(full_html=False, include_plotlyjs="cdn")
+
+    but from a figure which is already serialized to JSON.
+    """
+    div_id = str(uuid.uuid4())
+    style = "height:{}; width:100%;".format(f"{height}px" if height else "100%")
+    return (
+        f'<div style="{style}">{plotlyjs_loader()}'
+        f'<div id="{div_id}" class="plotly-graph-div" style="{style}"></div>'
+        "<script>window.PLOTLYENV=window.PLOTLYENV || {};"
+        f'if (document.getElementById("{div_id}")) {{var fig = {fig_json};'
+        f'Plotly.newPlot("{div_id}", fig.data, fig.layout, {{"responsive": true}})}};'
+        "</script></div>"
+    )
+
+
+def aggregator_of(df, aggregator=None):
+    """Return the aggregator of the data, or one aggregating the DataFrame in this process."""
+    return aggregator if aggregator is not None else aggregate.Aggregator(df, threads=1)
+
+
+def violin_or_box_plot(
+    df, y, path, y_name, settings, title=None, plot="violin", log=False, aggregator=None, where=None
+):
     """Create a violin/boxplot/ridge from the received DataFrame.
 
     The x-axis should be divided based on the 'dataset' column,
     the y-axis is specified in the arguments
+    Violins and ridges are drawn from a kernel density estimate of all values passing <where>,
+    which is calculated per dataset by the aggregator rather than by plotly.js in the browser.
     """
     comp = Plot(
         path=f"{path}NanoComp_{y.replace(' ', '_')}_{plot}.html",
@@ -29,26 +102,33 @@ def violin_or_box_plot(df, y, path, y_name, settings, title=None, plot="violin",
         logging.info(f"NanoComp: Creating violin plot for {y}.")
 
         fig = go.Figure()
+        aggregator = aggregator_of(df, aggregator)
+        datasets = aggregator.datasets
+        densities = aggregator.map(aggregate.density, column=y, where=where)
 
-        for dataset in df["dataset"].unique():
+        for dataset, density in zip(datasets, densities):
             color = colordict.get(dataset)
             if not color and "colors" in settings and settings["colors"]:
                 color = next(settings["colors"])
             elif not color:
                 color = next(cycle(plotly.colors.DEFAULT_PLOTLY_COLORS))
                 
+            positions, values = density_outline(
+                density, position=datasets.index(dataset), width=0.9
+            )
             fig.add_trace(
-                go.Violin(
-                    x=df["dataset"][df["dataset"] == dataset],
-                    y=df[y][df["dataset"] == dataset],
+                go.Scatter(
+                    x=positions,
+                    y=values,
+                    fill="toself",
+                    mode="lines",
                     marker_color=color,
-                    points=False,
+                    hoveron="fills",
                     name=dataset,
                 )
             )
-        
-        # Add this line to prevent violin plots extending beyond data points
-        fig.update_traces(spanmode="hard")
+
+        fig.update_xaxes(tickvals=list(range(len(datasets))), ticktext=datasets)
 
         process_violin_and_box(
             fig,
@@ -56,7 +136,7 @@ def violin_or_box_plot(df, y, path, y_name, settings, title=None, plot="violin",
             plot_obj=comp,
             title=title,
             y_name=y_name,
-            ymax=np.amax(df[y]),
+            ymax=value_range(aggregator, y, where)[1],
             settings=settings,
         )
 
@@ -95,24 +175,40 @@ def violin_or_box_plot(df, y, path, y_name, settings, title=None, plot="violin",
         logging.info(f"NanoComp: Creating ridges plot for {y}.")
 
         fig = go.Figure()
+        aggregator = aggregator_of(df, aggregator)
+        datasets = aggregator.datasets
+        densities = aggregator.map(aggregate.density, column=y, where=where)
 
-        for dataset in df["dataset"].unique():
+        for dataset, density in zip(datasets, densities):
             color = colordict.get(dataset)
             if not color and "colors" in settings and settings["colors"]:
                 color = next(settings["colors"])
             elif not color:
                 color = next(cycle(plotly.colors.DEFAULT_PLOTLY_COLORS))
             
-            fig.add_trace(go.Violin(x=df[y][df["dataset"] == dataset], name=dataset, marker_color=color))
-
-        # Add this line to prevent violin plots extending beyond data points
-        fig.update_traces(spanmode="hard", orientation="h", side="positive", width=3, points=False)
+            positions, values = density_outline(
+                density,
+                position=datasets.index(dataset),
+                width=3,
+                side="positive",
+            )
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=positions,
+                    fill="toself",
+                    mode="lines",
+                    marker_color=color,
+                    hoveron="fills",
+                    name=dataset,
+                )
+            )
 
+        fig.update_yaxes(tickvals=list(range(len(datasets))), ticktext=datasets)
         fig.update_layout(title=title or comp.title, title_x=0.5)
 
         comp.fig = fig
-        comp.html = comp.fig.to_html(full_html=False, include_plotlyjs="cdn")
-        comp.save(settings)
+        comp.export(settings)
 
     else:
         logging.error(f"Unknown comp plot type {plot}")
@@ -121,6 +217,28 @@ def violin_or_box_plot(df, y, path, y_name, settings, title=None, plot="violin",
     return [comp]
 
 
+def density_outline(kde, position, width, side="both"):
+    """Return the outline of a violin, drawn from the kernel density estimate of all values.
+
+    <kde> is the grid and the density on it, see nanocomp.kde.kde.
+    The violin is centered on <position> and scaled to a width of <width> at the highest density,
+    with side="positive" only the half above <position> is drawn, as for a ridge.
+    Returns the coordinates along the position axis and along the value axis.
+    """
+    grid, density = kde
+    if len(density) and density.max() > 0:
+        density = density / density.max()
+    if side == "positive":
+        return (
+            np.concatenate([position + width / 2 * density, np.full(len(grid), position)]),
+            np.concatenate([grid, grid[::-1]]),
+        )
+    return (
+        np.concatenate([position + width / 2 * density, (position - width / 2 * density)[::-1]]),
+        np.concatenate([grid, grid[::-1]]),
+    )
+
+
 def process_violin_and_box(fig, log, plot_obj, title, y_name, ymax, settings):
     if log:
         ticks = [10**i for i in range(10) if not 10**i > 10 * (10**ymax)]
@@ -139,16 +257,21 @@ def process_violin_and_box(fig, log, plot_obj, title, y_name, ymax, settings):
     )
 
     plot_obj.fig = fig
-    plot_obj.html = plot_obj.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    plot_obj.save(settings)
+    plot_obj.export(settings)
 
 
-def output_barplot(df, path, settings, title=None):
-    """Create barplots based on number of reads and total sum of nucleotides sequenced."""
+def output_barplot(
+    df, path, settings, title=None, plots=("number_of_reads", "total_throughput"), scale=None
+):
+    """Create barplots based on number of reads and total sum of nucleotides sequenced.
+
+    Only the barplots with their name in <plots> are made.
+    With <scale>, the factor per dataset of a sample (--quick), the totals are extrapolated.
+    """
     logging.info("NanoComp: Creating barplots for number of reads and total throughput.")
-    read_count = Plot(
-        path=path + "NanoComp_number_of_reads.html", title="Comparing number of reads"
-    )
+    barplots = []
+    # Get unique datasets in a consistent order
+    datasets = df["dataset"].unique()
 
     # Use the centralized colordict from settings
     colordict = settings.get("colordict", {})
@@ -156,36 +279,53 @@ def output_barplot(df, path, settings, title=None):
     # Fall back to creating a new colordict if not provided
     if not colordict:
         palette = settings["colors"] if settings["colors"] else cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
-        datasets = df["dataset"].unique()
         colordict = {dataset: color for dataset, color in zip(datasets, palette)}
 
+    if "number_of_reads" in plots:
+        barplots.append(
+            read_count_barplot(df, path, datasets, colordict, settings, title, scale=scale)
+        )
+    if "total_throughput" in plots:
+        barplots.append(
+            throughput_barplot(df, path, datasets, colordict, settings, title, scale=scale)
+        )
+    return barplots
+
+
+def read_count_barplot(df, path, datasets, colordict, settings, title=None, scale=None):
+    read_count = Plot(
+        path=path + "NanoComp_number_of_reads.html", title="Comparing number of reads"
+    )
     # Count reads per dataset
     counts = df["dataset"].value_counts(sort=False)
-    
-    # Get unique datasets in a consistent order
-    datasets = df["dataset"].unique()
 
     read_count.fig = go.Figure()
     for idx in datasets:
         count = counts.get(idx, 0)  # Get count for this dataset
+        if scale:
+            count = round(count * scale.get(idx, 1))
         color = colordict.get(idx)
         read_count.fig.add_trace(go.Bar(x=[idx], y=[count], name=idx, marker_color=color))
 
     read_count.fig.update_layout(
         title_text=title or read_count.title,
         title_x=0.5,
-        yaxis_title="Number of reads",
+        yaxis_title="Estimated number of reads" if scale else "Number of reads",
     )
 
-    read_count.html = read_count.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    read_count.save(settings)
+    read_count.export(settings)
+    return read_count
+
 
+def throughput_barplot(df, path, datasets, colordict, settings, title=None, scale=None):
     throughput_bases = Plot(
         path=path + "NanoComp_total_throughput.html",
         title="Comparing throughput in bases",
     )
     length_column = "aligned_lengths" if "aligned_lengths" in df else "lengths"
     ylabel = "Total bases aligned" if "aligned_lengths" in df else "Total bases sequenced"
+    if scale:
+        ylabel = f"Estimated {ylabel.lower()}"
 
     throughput = df.groupby("dataset", sort=False)[length_column].sum()
     throughput_bases.fig = go.Figure()
@@ -193,6 +333,8 @@ def output_barplot(df, path, settings, title=None):
     # Use the same dataset order and colors as the first plot
     for idx in datasets:
         sum_dataset = throughput.get(idx, 0)  # Get sum for this dataset
+        if scale:
+            sum_dataset = sum_dataset * scale.get(idx, 1)
         color = colordict[idx]
         throughput_bases.fig.add_trace(
             go.Bar(x=[idx], y=[sum_dataset], name=idx, marker_color=color)
@@ -204,19 +346,18 @@ def output_barplot(df, path, settings, title=None):
         yaxis_title=ylabel,
     )
 
-    throughput_bases.html = throughput_bases.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    throughput_bases.save(settings)
-
-    return read_count, throughput_bases
+    throughput_bases.export(settings)
+    return throughput_bases
 
 
-def n50_barplot(df, path, settings, title=None):
+def n50_barplot(df, path, settings, title=None, aggregator=None):
     """
     Returns Plot object and creates figure(format specified)/html
     containing bar chart of total gb aligned/sequenced read length n50
     """
     n50_bar = Plot(path=path + "NanoComp_N50.html", title="Comparing read length N50")
-    datasets = df["dataset"].unique()
+    aggregator = aggregator_of(df, aggregator)
+    datasets = aggregator.datasets
     length_column = "aligned_lengths" if "aligned_lengths" in df else "lengths"
     ylabel = "Aligned read length N50" if "aligned_lengths" in df else "Sequenced read length N50"
 
@@ -227,7 +368,7 @@ def n50_barplot(df, path, settings, title=None):
         palette = settings["colors"] if settings["colors"] else cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
         colordict = {dataset: color for dataset, color in zip(datasets, palette)}
 
-    n50s = [get_N50(np.sort(df.loc[df["dataset"] == d, length_column])) for d in datasets]
+    n50s = aggregator.map(aggregate.n50, column=length_column)
     n50_bar.fig = go.Figure()
 
     for idx, n50 in zip(datasets, n50s):
@@ -240,20 +381,108 @@ def n50_barplot(df, path, settings, title=None):
         yaxis_title=ylabel,
     )
 
-    n50_bar.html = n50_bar.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    n50_bar.save(settings)
+    n50_bar.export(settings)
     return [n50_bar]
 
 
-def compare_sequencing_speed(df, path, settings, title=None):
+def end_reason_barplot(end_reasons, path, settings, title=None, relative=False):
+    """Create a stacked barplot of the number or, if relative, fraction of reads per end reason.
+
+    <end_reasons> has the end reasons as rows and the datasets as columns,
+    see nanocomp.extraction.end_reasons.
+    """
+    logging.info("NanoComp: Creating barplot of end reasons.")
+    suffix = "_relative" if relative else ""
+    end_reason = Plot(
+        path=f"{path}NanoComp_end_reasons{suffix}.html",
+        title=f"Comparing end reasons{' (relative)' if relative else ''}",
+    )
+    if relative:
+        end_reasons = end_reasons / end_reasons.sum()
+
+    end_reason.fig = go.Figure()
+    for reason, counts in end_reasons.iterrows():
+        end_reason.fig.add_trace(
+            go.Bar(x=list(end_reasons.columns), y=counts.to_numpy(), name=reason)
+        )
+
+    end_reason.fig.update_layout(
+        barmode="stack",
+        title=title or end_reason.title,
+        title_x=0.5,
+        yaxis_title="Fraction of reads" if relative else "Number of reads",
+        legend_title="End reason",
+    )
+
+    end_reason.export(settings)
+    return [end_reason]
+
+
+# Colors of the pore states in the mux scan plot, other states get the default colors
+MUX_SCAN_COLORS = {
+    "single_pore": "#4feb34",
+    "saturated": "#000000",
+    "multiple": "#f77d02",
+    "other": "#8c8c8b",
+    "zero": "#326ba1",
+    "unavailable": "#399bf7",
+}
+
+
+def mux_scan_plot(mux_scan, path, settings, title=None):
+    """Create stacked barplots of the pore states per repeat of the mux scan, a row per dataset.
+
+    <mux_scan> has the datasets and repeats as rows and the pore states as columns,
+    see nanocomp.extraction.get_mux_scan. All rows share the same y-axis range.
+    """
+    from plotly import subplots
+
+    logging.info("NanoComp: Creating plot of the pore states in the mux scans.")
+    pore_states = Plot(path=path + "NanoComp_mux_scan.html", title="Comparing pore states")
+    datasets = list(mux_scan.index.unique(level="dataset"))
+    fig = subplots.make_subplots(
+        rows=len(datasets), cols=1, shared_xaxes=True, vertical_spacing=0.05
+    )
+    palette = cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
+    colors = {s: MUX_SCAN_COLORS.get(s) or next(palette) for s in mux_scan.columns}
+    for row, dataset in enumerate(datasets, start=1):
+        counts = mux_scan.loc[dataset]
+        for state in mux_scan.columns:
+            fig.add_trace(
+                go.Bar(
+                    name=state,
+                    x=counts.index,
+                    y=counts[state].to_numpy(),
+                    marker_color=colors[state],
+                    legendgroup=state,
+                    showlegend=row == 1,
+                ),
+                row=row,
+                col=1,
+            )
+        fig.update_yaxes(title_text=dataset, row=row, col=1)
+    fig.update_yaxes(range=[0, mux_scan.sum(axis="columns").max() * 1.05])
+    fig.update_xaxes(title_text="Mux scan", row=len(datasets), col=1)
+    fig.update_layout(
+        barmode="stack",
+        title=title or pore_states.title,
+        title_x=0.5,
+        height=max(450, 200 * len(datasets) + 150),
+    )
+
+    pore_states.fig = fig
+    pore_states.export(settings)
+    return [pore_states]
+
+
+def compare_sequencing_speed(df, path, settings, title=None, aggregator=None):
     logging.info("NanoComp: creating comparison of sequencing speed over time.")
     seq_speed = Plot(
         path=path + "NanoComp_sequencing_speed_over_time.html",
         title="Sequencing speed over time",
     )
-
-    dfs = check_valid_time_and_sort(df, "start_time").set_index("start_time")
-    dfs = dfs.loc[dfs["duration"] > 0]
+    aggregator = aggregator_of(df, aggregator)
+    speeds = aggregator.map(aggregate.sequencing_speed, limit=aggregate.time_limit(aggregator))
 
     # Use the centralized colordict from settings
     colordict = settings.get("colordict", {})
@@ -263,19 +492,11 @@ def compare_sequencing_speed(df, path, settings, title=None):
         colordict = {dataset: color for dataset, color in zip(df["dataset"].unique(), palette)}
 
     data = []
-    for sample in df["dataset"].unique():
+    for sample, (hours, seqspeed) in zip(aggregator.datasets, speeds):
         color = colordict.get(sample)
-        seqspeed = (
-            (
-                dfs.loc[dfs["dataset"] == sample, "lengths"]
-                / dfs.loc[dfs["dataset"] == sample, "duration"]
-            )
-            .resample("30min")
-            .median()
-        )
         data.append(
             go.Scatter(
-                x=seqspeed.index.total_seconds() / 3600,
+                x=hours,
                 y=seqspeed,
                 opacity=0.75,
                 name=sample,
@@ -293,12 +514,13 @@ def compare_sequencing_speed(df, path, settings, title=None):
         yaxis_title="Sequencing speed (nucleotides/second)",
     )
 
-    seq_speed.html = seq_speed.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    seq_speed.save(settings)
+    seq_speed.export(settings)
     return [seq_speed]
 
 
-def compare_cumulative_yields(df, path, settings, title=None):
+def compare_cumulative_yields(df, path, settings, title=None, aggregator=None, scale=None):
+    """Plot the cumulative yield of every dataset over time,
+    extrapolated with the factor per dataset in <scale> for a sample (--quick)."""
     # Use the centralized colordict from settings
     colordict = settings.get("colordict", {})
     # Fall back to creating a new colordict if not provided
@@ -306,21 +528,23 @@ def compare_cumulative_yields(df, path, settings, title=None):
         palette = settings["colors"] if settings["colors"] else cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
         colordict = {dataset: color for dataset, color in zip(df["dataset"].unique(), palette)}
         
-    dfs = check_valid_time_and_sort(df, "start_time").set_index("start_time")
+    aggregator = aggregator_of(df, aggregator)
+    yields = aggregator.map(aggregate.cumulative_yield, limit=aggregate.time_limit(aggregator))
 
-    logging.info(f"NanoComp: Creating cumulative yield plots using {len(dfs)} reads.")
+    logging.info(f"NanoComp: Creating cumulative yield plots using {len(df)} reads.")
     cum_yield_gb = Plot(
         path=path + "NanoComp_CumulativeYieldPlot_Gigabases.html",
         title="Cumulative yield",
     )
     data = []
     annotations = []
-    for sample in df["dataset"].unique():
+    for sample, (hours, cumsum) in zip(aggregator.datasets, yields):
+        if scale:
+            cumsum = cumsum * scale.get(sample, 1)
         color = colordict.get(sample)
-        cumsum = dfs.loc[dfs["dataset"] == sample, "lengths"].cumsum().resample("10min").max() / 1e9
         data.append(
             go.Scatter(
-                x=cumsum.index.total_seconds() / 3600,
+                x=hours,
                 y=cumsum,
                 opacity=0.75,
                 name=sample,
@@ -331,10 +555,10 @@ def compare_cumulative_yields(df, path, settings, title=None):
             dict(
                 xref="paper",
                 x=0.99,
-                y=cumsum.iloc[-1],
+                y=cumsum[-1],
                 xanchor="left",
                 yanchor="middle",
-                text=f"{round(cumsum.iloc[-1], ndigits=2)}Gb",
+                text=f"{round(cumsum[-1], ndigits=2)}Gb",
                 showarrow=False,
             )
         )
@@ -346,20 +570,59 @@ def compare_cumulative_yields(df, path, settings, title=None):
                 barmode="overlay",
                 title=title or cum_yield_gb.title,
                 xaxis=dict(title="Time (hours)"),
-                yaxis=dict(title="Yield (gigabase)"),
+                yaxis=dict(
+                    title="Estimated yield (gigabase)" if scale else "Yield (gigabase)"
+                ),
                 annotations=annotations,
             ),
         }
     )
-    cum_yield_gb.html = cum_yield_gb.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    cum_yield_gb.save(settings)
+    cum_yield_gb.export(settings)
     return [cum_yield_gb]
 
 
-def overlay_histogram(df, path, settings):
+# Name of each length histogram, with the suffix of its file name, its title,
+# whether the lengths are log transformed and the arguments for making it
+HISTOGRAMS = {
+    "histogram": ("OverlayHistogram", "Histogram of read lengths", False, {}),
+    "histogram_normalized": (
+        "OverlayHistogram_Normalized",
+        "Normalized histogram of read lengths",
+        False,
+        {"density": True},
+    ),
+    "histogram_weighted": (
+        "OverlayHistogram_Weighted",
+        "Weighted histogram of read lengths",
+        False,
+        {"weights_column": "lengths"},
+    ),
+    "log_histogram": (
+        "OverlayLogHistogram",
+        "Histogram of log transformed read lengths",
+        True,
+        {},
+    ),
+    "log_histogram_normalized": (
+        "OverlayLogHistogram_Normalized",
+        "Normalized histogram of log transformed read lengths",
+        True,
+        {"density": True},
+    ),
+    "log_histogram_weighted": (
+        "OverlayLogHistogram_Weighted",
+        "Weighted histogram of log transformed read lengths",
+        True,
+        {"weights_column": "lengths"},
+    ),
+}
+
+
+def overlay_histogram(df, path, settings, plots=tuple(HISTOGRAMS), aggregator=None):
     """
     Use plotly to create an overlay of length histograms
     Return html code, but also save as figure (format specified)
+    Only the histograms with their name in <plots> are made.
 
     Only has 10 colors, which get recycled up to 5 times.
     """
@@ -370,57 +633,24 @@ def overlay_histogram(df, path, settings):
     else:
         palette = settings["colors"] if settings["colors"] else cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
 
-    hist = Plot(path=path + "NanoComp_OverlayHistogram.html", title="Histogram of read lengths")
-    hist.html, hist.fig = plot_overlay_histogram(df, palette, column="lengths", title=hist.title)
-    hist.save(settings)
-
-    hist_norm = Plot(
-        path=path + "NanoComp_OverlayHistogram_Normalized.html",
-        title="Normalized histogram of read lengths",
-    )
-    hist_norm.html, hist_norm.fig = plot_overlay_histogram(
-        df, palette, column="lengths", title=hist_norm.title, density=True
-    )
-    hist_norm.save(settings)
-
-    hist_weighted = Plot(
-        path=path + "NanoComp_OverlayHistogram_Weighted.html",
-        title="Weighted histogram of read lengths",
-    )
-    hist_weighted.html, hist_weighted.fig = plot_overlay_histogram(
-        df, palette, column="lengths", title=hist_weighted.title, weights_column="lengths"
-    )
-    hist_weighted.save(settings)
-
-    log_hist = Plot(
-        path=path + "NanoComp_OverlayLogHistogram.html",
-        title="Histogram of log transformed read lengths",
-    )
-    log_hist.html, log_hist.fig = plot_log_histogram(df, palette, title=log_hist.title)
-    log_hist.save(settings)
-
-    log_hist_norm = Plot(
-        path=path + "NanoComp_OverlayLogHistogram_Normalized.html",
-        title="Normalized histogram of log transformed read lengths",
-    )
-    log_hist_norm.html, log_hist_norm.fig = plot_log_histogram(
-        df, palette, title=log_hist_norm.title, density=True
-    )
-    log_hist_norm.save(settings)
-
-    log_hist_weighted = Plot(
-        path=path + "NanoComp_OverlayLogHistogram_Weighted.html",
-        title="Weighted histogram of log transformed read lengths",
-    )
-    log_hist_weighted.html, log_hist_weighted.fig = plot_log_histogram(
-        df, palette, title=log_hist_weighted.title, weights_column="lengths"
-    )
-    log_hist_weighted.save(settings)
-
-    return [hist, hist_norm, hist_weighted, log_hist, log_hist_norm, log_hist_weighted]
+    aggregator = aggregator_of(df, aggregator)
+    histograms = []
+    for name, (suffix, title, log, kwargs) in HISTOGRAMS.items():
+        if name not in plots:
+            continue
+        hist = Plot(path=f"{path}NanoComp_{suffix}.html", title=title)
+        if log:
+            hist.fig = plot_log_histogram(aggregator, palette, title=hist.title, **kwargs)
+        else:
+            hist.fig = plot_overlay_histogram(
+                aggregator, palette, column="lengths", title=hist.title, **kwargs
+            )
+        hist.export(settings)
+        histograms.append(hist)
+    return histograms
 
 
-def overlay_histogram_identity(df, path, settings):
+def overlay_histogram_identity(df, path, settings, aggregator=None, where=None):
     # Use the centralized colordict from settings
     colordict = settings.get("colordict", {})
     if colordict:
@@ -432,24 +662,24 @@ def overlay_histogram_identity(df, path, settings):
         path=path + "NanoComp_OverlayHistogram_Identity.html",
         title="Histogram of percent reference identity",
     )
-    hist_pid.html, hist_pid.fig = plot_overlay_histogram(
-        df, palette, "percentIdentity", hist_pid.title, density=True
+    hist_pid.fig = plot_overlay_histogram(
+        aggregator_of(df, aggregator),
+        palette,
+        "percentIdentity",
+        hist_pid.title,
+        density=True,
+        where=where,
     )
-    hist_pid.save(settings)
+    hist_pid.export(settings)
 
     return hist_pid
 
 
-def overlay_histogram_phred(df, path, settings):
+def overlay_histogram_phred(df, path, settings, aggregator=None, where=None):
     """
-    Reads with a perfect alignment and thus a percentIdentity of 100
-    get a phred score of Inf
-    Which is not cool
-    So these are set to 60, a very high phred score
+    Histogram of the percent identity as phred score, in the phredIdentity column,
+    see nanocomp.derived.phred_identity
     """
-    # Calculate phred scores and cap infinite values at 60
-    df["phredIdentity"] = np.minimum(-10 * np.log10(1 - (df["percentIdentity"] / 100)), 60)
-
     # Use the centralized colordict from settings
     colordict = settings.get("colordict", {})
     if colordict:
@@ -462,21 +692,42 @@ def overlay_histogram_phred(df, path, settings):
         title="Histogram of Phred scores",
     )
 
-    hist_phred.html, hist_phred.fig = plot_overlay_histogram(
-        df, palette, "phredIdentity", hist_phred.title, bins=20, density=True
+    hist_phred.fig = plot_overlay_histogram(
+        aggregator_of(df, aggregator),
+        palette,
+        "phredIdentity",
+        hist_phred.title,
+        bins=20,
+        density=True,
+        where=where,
     )
 
-    hist_phred.save(settings)
+    hist_phred.export(settings)
 
     return hist_phred
 
 
 def plot_overlay_histogram(
-    df, palette, column, title, bins=None, density=False, weights_column=None
+    aggregator, palette, column, title, bins=None, density=False, weights_column=None, where=None
 ):
+    """
+    Plot overlaying histograms of a column, of which the counts are aggregated per dataset
+    All datasets use the same bins, spanning the values of all datasets
+    Return the figure
+    """
     data = []
+    low, high = value_range(aggregator, column, where)
     if not bins:
-        bins = max(round(int(np.amax(df.loc[:, column])) / 500), 10)
+        bins = max(round(int(high) / 500), 10)
+    bins = np.linspace(low, high, bins + 1)
+    counts = aggregator.map(
+        aggregate.histogram,
+        column=column,
+        bins=bins,
+        where=where,
+        density=density,
+        weights_column=weights_column,
+    )
 
     # Use the centralized colordict if it exists in settings and was passed via palette
     colordict = {}
@@ -484,21 +735,15 @@ def plot_overlay_histogram(
         colordict = palette
         palette = cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
 
-    for dataset in df["dataset"].unique():
+    for dataset, dataset_counts in zip(aggregator.datasets, counts):
         color = colordict.get(dataset)
         if not color:
             color = next(palette)
             
-        counts, bins = np.histogram(
-            df.loc[df["dataset"] == dataset, column],
-            bins=bins,
-            density=density,
-            weights=df.loc[df["dataset"] == dataset, weights_column] if weights_column else None,
-        )
         data.append(
             go.Bar(
                 x=bins[1:],
-                y=counts,
+                y=dataset_counts,
                 opacity=0.4,
                 name=dataset,
                 hovertext=bins[1:],
@@ -516,16 +761,25 @@ def plot_overlay_histogram(
         yaxis_title = "Number of reads"
     fig.update_layout(title_x=0.5, yaxis_title=yaxis_title)
 
-    return fig.to_html(full_html=False, include_plotlyjs="cdn"), fig
+    return fig
 
 
-def plot_log_histogram(df, palette, title, density=False, weights_column=None):
+def plot_log_histogram(aggregator, palette, title, density=False, weights_column=None):
     """
     Plot overlaying histograms with log transformation of length
-    Return both html and figure
+    Return the figure
     """
     data = []
-    bins = max(round(int(np.amax(df.loc[:, "lengths"])) / 500), 10)
+    maxlength = value_range(aggregator, "lengths")[1]
+    low, high = value_range(aggregator, "log length")
+    bins = np.linspace(low, high, max(round(int(maxlength) / 500), 10) + 1)
+    counts = aggregator.map(
+        aggregate.histogram,
+        column="log length",
+        bins=bins,
+        density=density,
+        weights_column=weights_column,
+    )
     
     # Use the centralized colordict if it exists in settings and was passed via palette
     colordict = {}
@@ -533,21 +787,15 @@ def plot_log_histogram(df, palette, title, density=False, weights_column=None):
         colordict = palette
         palette = cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
         
-    for dataset in df["dataset"].unique():
+    for dataset, dataset_counts in zip(aggregator.datasets, counts):
         color = colordict.get(dataset)
         if not color:
             color = next(palette)
             
-        counts, bins = np.histogram(
-            np.log10(df.loc[df["dataset"] == dataset, "lengths"]),
-            bins=bins,
-            density=density,
-            weights=df.loc[df["dataset"] == dataset, weights_column] if weights_column else None,
-        )
         data.append(
             go.Bar(
                 x=bins[1:],
-                y=counts,
+                y=dataset_counts,
                 opacity=0.4,
                 name=dataset,
                 hovertext=[10**i for i in bins[1:]],
@@ -556,7 +804,7 @@ def plot_log_histogram(df, palette, title, density=False, weights_column=None):
             )
         )
 
-    xtickvals = [10**i for i in range(10) if not 10**i > 10 * np.amax(df["lengths"])]
+    xtickvals = [10**i for i in range(10) if not 10**i > 10 * maxlength]
 
     fig = go.Figure(
         {
@@ -577,10 +825,16 @@ def plot_log_histogram(df, palette, title, density=False, weights_column=None):
         yaxis_title = "Number of reads"
     fig.update_layout(title_x=0.5, yaxis_title=yaxis_title)
 
-    return fig.to_html(full_html=False, include_plotlyjs="cdn"), fig
+    return fig
+
+
+def value_range(aggregator, column, where=None):
+    """Return the lowest and highest value of a column over all datasets."""
+    ranges = np.array(aggregator.map(aggregate.value_range, column=column, where=where))
+    return np.nanmin(ranges[:, 0]), np.nanmax(ranges[:, 1])
 
 
-def active_pores_over_time(df, path, settings, title=None):
+def active_pores_over_time(df, path, settings, title=None, aggregator=None):
     # Use the centralized colordict from settings
     colordict = settings.get("colordict", {})
     # Fall back to creating a new colordict if not provided
@@ -588,20 +842,20 @@ def active_pores_over_time(df, path, settings, title=None):
         palette = settings["colors"] if settings["colors"] else cycle(plotly.colors.DEFAULT_PLOTLY_COLORS)
         colordict = {dataset: color for dataset, color in zip(df["dataset"].unique(), palette)}
 
-    dfs = check_valid_time_and_sort(df, "start_time").set_index("start_time")
+    aggregator = aggregator_of(df, aggregator)
+    pores = aggregator.map(aggregate.active_pores, limit=aggregate.time_limit(aggregator))
 
-    logging.info(f"NanoComp: Creating active pores plot using {len(dfs)} reads.")
+    logging.info(f"NanoComp: Creating active pores plot using {len(df)} reads.")
     active_pores = Plot(
         path=path + "NanoComp_ActivePoresOverTime.html", title="Active pores over time"
     )
     data = []
-    for sample in df["dataset"].unique():
+    for sample, (hours, active) in zip(aggregator.datasets, pores):
         color = colordict.get(sample)
-        pores = dfs.loc[dfs["dataset"] == sample, "channelIDs"].resample("10min").nunique()
         data.append(
             go.Scatter(
-                x=pores.index.total_seconds() / 3600,
-                y=pores,
+                x=hours,
+                y=active,
                 opacity=0.75,
                 name=sample,
                 marker=dict(color=color),
@@ -623,7 +877,6 @@ def active_pores_over_time(df, path, settings, title=None):
     active_pores.fig.update_layout(title_x=0.5)
     active_pores.fig.update_yaxes(rangemode="tozero")
 
-    active_pores.html = active_pores.fig.to_html(full_html=False, include_plotlyjs="cdn")
-    active_pores.save(settings)
+    active_pores.export(settings)
 
     return active_pores
@@ -0,0 +1,78 @@
+"""Columns derived from the extracted data for plotting, calculated once when first needed."""
+
+import numpy as np
+
+
+def log_length(data):
+    return np.log10(data.column("lengths"))
+
+
+def phred_identity(data):
+    """
+    Reads with a perfect alignment and thus a percentIdentity of 100
+    get a phred score of Inf
+    Which is not cool
+    So these are set to 60, a very high phred score
+    """
+    with np.errstate(divide="ignore"):
+        return np.minimum(-10 * np.log10(1 - (data.column("percentIdentity") / 100)), 60)
+
+
+def identity_filter(data):
+    """Drop the 1% reads with the lowest percent identity, as outliers."""
+    return data.column("percentIdentity") > data.percentile(*PERCENTILES["identity_filter"])
+
+
+DERIVED = {
+    "log length": log_length,
+    "phredIdentity": phred_identity,
+    "identity_filter": identity_filter,
+}
+
+# The percentiles used by derived columns, which are calculated over all datasets
+PERCENTILES = {"identity_filter": ("percentIdentity", 1)}
+
+
+class DerivedData(object):
+    """Data of which derived columns and statistics are calculated when first used.
+
+    The derived columns are kept separate from the DataFrame, which is never modified.
+    Plots get a frame with only the columns they use, for which the base table isn't copied.
+    """
+
+    def __init__(self, df, subsample_size=10000):
+        self.df = df
+        self.subsample_size = subsample_size
+        self.derived = {}
+        self.percentiles = {}
+        self.sample = None
+
+    def column(self, name):
+        if name in self.df:
+            return self.df[name]
+        if name not in self.derived:
+            self.derived[name] = DERIVED[name](self)
+        return self.derived[name]
+
+    def percentile(self, name, q):
+        if (name, q) not in self.percentiles:
+            self.percentiles[(name, q)] = np.percentile(self.column(name), q)
+        return self.percentiles[(name, q)]
+
+    def frame(self, *columns, where=None):
+        """Return a DataFrame with the dataset and the columns, of the reads passing <where>."""
+        import pandas as pd
+
+        names = ["dataset"] + [c for c in columns if c != "dataset"]
+        frame = pd.DataFrame({c: self.column(c) for c in names}, copy=False)
+        if where:
+            frame = frame.loc[self.column(where)]
+        return frame
+
+    def subsample(self):
+        """Return the derived data of a subsample of the reads, see utils.subsample_datasets."""
+        from nanocomp.utils import subsample_datasets
+
+        if self.sample is None:
+            self.sample = DerivedData(subsample_datasets(self.df, minimal=self.subsample_size))
+        return self.sample
@@ -0,0 +1,106 @@
+"""Writing the extracted data to disk, for use by other tools or later runs of NanoComp."""
+
+import logging
+import gzip
+import concurrent.futures as cfutures
+from collections import deque
+import numpy as np
+
+# Rows formatted and compressed at once when writing a tsv file
+CHUNK_ROWS = 100000
+
+
+def write_raw(df, path, fmt="tsv", threads=4):
+    """Write the extracted data to <path>NanoComp-data.tsv.gz or <path>NanoComp-data.parquet.
+
+    Both formats are written part by part, using <threads> threads.
+    Returns the name of the file written.
+    """
+    if fmt == "parquet":
+        outputfile = path + "NanoComp-data.parquet"
+        write_parquet(df, outputfile, threads=threads)
+    else:
+        outputfile = path + "NanoComp-data.tsv.gz"
+        write_tsv(df, outputfile, threads=threads)
+    logging.info(f"NanoComp: Wrote the extracted data to {outputfile}.")
+    return outputfile
+
+
+def partitions(df, size=CHUNK_ROWS):
+    """Yield consecutive slices of at most <size> rows of a DataFrame, one dataset per slice.
+
+    Slices are views of consecutive rows, so concatenating them gives the input unchanged.
+    """
+    if "dataset" in df and len(df):
+        codes = df["dataset"].to_numpy()
+        bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    else:
+        bounds = np.array([], dtype=int)
+    bounds = np.concatenate(([0], bounds, [len(df)]))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        for s in range(start, end, size):
+            yield df.iloc[s : min(s + size, end)]
+
+
+def write_tsv(df, outputfile, threads=4):
+    """Write a DataFrame as a gzip compressed tab separated file.
+
+    Every slice of CHUNK_ROWS rows is formatted and compressed to a separate gzip member in a
+    thread pool, with at most two slices per thread in flight, and the members are written in
+    order as they are done. A gzip file of multiple members is decompressed as a single stream,
+    so the output is the same as that of
+    DataFrame.to_csv(sep="\t", index=False, compression="gzip").
+    """
+
+    def compress(index, part):
+        text = part.to_csv(sep="\t", index=False, header=index == 0)
+        return gzip.compress(text.encode("utf-8"), compresslevel=6)
+
+    pending = deque()
+    with cfutures.ThreadPoolExecutor(max_workers=threads) as executor:
+        with open(outputfile, "wb") as output:
+            for index, part in enumerate(partitions(df)):
+                pending.append(executor.submit(compress, index, part))
+                if len(pending) >= 2 * threads:
+                    output.write(pending.popleft().result())
+            while pending:
+                output.write(pending.popleft().result())
+
+
+def write_parquet(df, outputfile, threads=4):
+    """Write a DataFrame as a zstd compressed parquet file, with a row group per dataset.
+
+    The datasets are converted to arrow tables one at a time, by <threads> threads,
+    and every table is written before the next is converted.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    groups = df.groupby("dataset", sort=False, observed=True) if "dataset" in df else [(None, df)]
+    with pq.ParquetWriter(outputfile, schema, compression="zstd") as writer:
+        for _, group in groups:
+            table = pa.Table.from_pandas(
+                group, schema=schema, preserve_index=False, nthreads=threads
+            )
+            writer.write_table(table, row_group_size=max(len(table), 1))
+            del table
+
+
+def write_time_table(aggregator, path, fmt="tsv", interval=10):
+    """Write the metrics per dataset and time bin to <path>NanoComp-time.tsv or .parquet.
+
+    The metrics are aggregated per dataset from the data of the aggregator,
+    see nanocomp.aggregate.time_table. Returns the name of the file written.
+    """
+    from nanocomp.aggregate import time_table
+
+    df = time_table(aggregator, interval=interval)
+    if fmt == "parquet":
+        outputfile = path + "NanoComp-time.parquet"
+        df.to_parquet(outputfile, index=False, compression="zstd")
+    else:
+        outputfile = path + "NanoComp-time.tsv"
+        df.to_csv(outputfile, sep="\t", index=False, na_rep="NaN")
+    logging.info(f"NanoComp: Wrote the metrics over time to {outputfile}.")
+    return outputfile
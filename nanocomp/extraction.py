@@ -0,0 +1,1530 @@
+"""
+Extraction of metrics from the input files, as a NanoComp specific layer on top of nanoget.
+
+Where NanoComp can do better than the generic nanoget functions because it knows all
+files that are compared up front, the extraction is done here. All other sources are
+passed on to nanoget.get_input unchanged. The DataFrame returned is identical in
+structure to the one of nanoget.get_input with combine="track".
+"""
+
+import logging
+import os
+import re
+import struct
+import sys
+import zlib
+import concurrent.futures as cfutures
+from collections import Counter
+from functools import partial
+from itertools import repeat
+from math import ceil, log
+import numpy as np
+import pandas as pd
+import pysam
+from pandas.api.types import union_categoricals
+import nanoget.utils as ut
+import nanoget.extraction_functions as ex
+from nanoget import combine_dfs, calculate_start_time
+import nanocomp.progress as progress
+
+# Error probability of every Phred score, indexed by the score
+ERRS = np.array(ut.errs_tab(128) + [10 ** (q / -10) for q in range(129, 256)])
+# Error probability of every byte in a fastq quality line, indexed by the ASCII value
+QUAL_ERRS = np.concatenate((np.zeros(33), ERRS[: 256 - 33]))
+# Reads shorter than this are processed in groups rather than one by one
+SHORT_READ = 256
+
+# Fields in the description of fastq files from MinKNOW, albacore or dorado,
+# in the legacy key=value format or the SAM-style tag:type:value format of MinKNOW >= 26.01.
+# For the latter the run id is the first underscore-separated part of the read group.
+# Sequence and quality lines contain no spaces, so a match can only be in a header line.
+RICH_FIELDS = {
+    "channelIDs": re.compile(rb" (?:ch=|ch:i:)(\S+)"),
+    "timestamp": re.compile(rb" (?:start_time=|st:Z:)(\S+)"),
+    "runIDs": re.compile(rb" (?:runid=(\S+)|RG:Z:([^\s_]+))"),
+}
+
+ALIGNMENT_COLUMNS = [
+    "readIDs",
+    "quals",
+    "aligned_quals",
+    "lengths",
+    "aligned_lengths",
+    "mapQ",
+    "percentIdentity",
+]
+
+# Tags of unaligned bam files, which are only used if every read has them
+UBAM_TAGS = ["channelIDs", "timestamp", "runIDs"]
+
+# Columns of summary files, as used by nanoget.extraction_functions.process_summary,
+# to which the run_id is added as runIDs with --split_runs
+SUMMARY_COLUMNS = {
+    "1D": {
+        "channel": "channelIDs",
+        "start_time": "time",
+        "duration": "duration",
+        "sequence_length_template": "lengths",
+        "mean_qscore_template": "quals",
+    },
+    "2D": {
+        "channel": "channelIDs",
+        "start_time": "time",
+        "duration": "duration",
+        "sequence_length_2d": "lengths",
+        "mean_qscore_2d": "quals",
+    },
+}
+SUMMARY_COLUMNS["1D2"] = SUMMARY_COLUMNS["2D"]
+
+# Types of the columns of summary files read by pyarrow, others are dictionary encoded
+SUMMARY_TYPES = {
+    "channel": "int64",
+    "start_time": "double",
+    "duration": "double",
+    "sequence_length_template": "int64",
+    "mean_qscore_template": "double",
+    "sequence_length_2d": "int64",
+    "mean_qscore_2d": "double",
+    "barcode_arrangement": "string",
+    "alias": "string",
+}
+
+# States of the channels in a mux scan, in the order in which they are stacked in plots
+MUX_SCAN_STATES = ["single_pore", "saturated", "multiple", "other", "zero", "unavailable"]
+
+# Columns of stored data used by NanoComp, the only columns read from feather files
+STORED_COLUMNS = [
+    "readIDs",
+    "quals",
+    "aligned_quals",
+    "lengths",
+    "aligned_lengths",
+    "mapQ",
+    "percentIdentity",
+    "identities",
+    "channelIDs",
+    "start_time",
+    "duration",
+    "time",
+    "timestamp",
+    "runIDs",
+    "barcode",
+]
+
+# Batches of a fastq file read ahead of the one parsed by default (--prefetch)
+PREFETCH = 2
+
+# Header of a BGZF block, up to and including the BC subfield identifier and its length
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_HEADER_SIZE = 18
+
+
+def get_input(
+    source,
+    files,
+    threads=4,
+    readtype="1D",
+    names=None,
+    barcoded=False,
+    keep_supp=True,
+    batch_size=1 << 24,
+    extras=None,
+    time_window=None,
+    split=None,
+    prefetch=PREFETCH,
+):
+    """Get a DataFrame with metrics of all files, with a 'dataset' column tracking the origin.
+
+    Alignment files (bam and cram) are processed by splitting all files in regions using
+    the index, and processing all regions in a single pool of <threads> workers.
+    Unaligned bam files are split on BGZF block boundaries and processed in the same way.
+    Fastq files are processed in parallel, each parsed in batches of <batch_size> bytes with numpy,
+    while a thread reads up to <prefetch> batches ahead.
+    Other sources are handed over to nanoget.
+
+    Summary files are read one after the other, each by pyarrow with <threads> threads.
+    Data which doesn't fit in the DataFrame is added to the <extras> dictionary, if given:
+    for summary files the number of reads per end reason of every dataset, see end_reasons(),
+    or of every barcode with <barcoded>, counted after splitting runs and the time window.
+    With a <time_window> only the reads started in it are kept, see in_time_window(), of which
+    summary and rich fastq files drop most others already while read, see window_frame().
+    With <split>, the names of run IDs (--split_runs), the reads of every file are assigned to
+    the dataset of their run, see split_runs().
+    """
+    if source == "summary":
+        import pyarrow as pa
+
+        pa.set_cpu_count(threads)
+        windowed = own_dataset(names or files, split)
+        count = extras is not None
+        # the datasets are only known once combined, split in runs or barcodes, within a window
+        keep = count and bool(barcoded or time_window or split)
+        extract_summary = partial(
+            process_summary,
+            readtype=readtype,
+            barcoded=barcoded,
+            run_ids=bool(split),
+            end_reasons=count,
+            keep_end_reasons=keep,
+            time_window=time_window,
+        )
+        results = list(
+            reported(
+                files,
+                (extract_summary(f, exact=exact) for f, exact in zip(files, windowed)),
+                count=lambda res: len(res[0]),
+            )
+        )
+        dfs = [df for df, _ in results]
+        if count and not keep:
+            extras["end_reasons"] = end_reasons([c for _, c in results], names=names or files)
+        elif keep and not all("end_reason" in df for df in dfs):
+            dfs = [df.drop(columns="end_reason", errors="ignore") for df in dfs]
+        datadf = combine(
+            dfs, names or files, time_window=time_window, split=split, windowed=windowed
+        )
+        if "end_reason" in datadf:
+            extras["end_reasons"] = end_reasons_of(datadf, by="barcode" if barcoded else "dataset")
+            datadf.drop(columns="end_reason", inplace=True)
+        return datadf
+    if source not in ["bam", "cram", "ubam", "fastq", "fastq_rich"]:
+        from nanoget import get_input as nanoget_input
+
+        datadf = nanoget_input(
+            source=source,
+            files=files,
+            threads=threads,
+            readtype=readtype,
+            names=names,
+            barcoded=barcoded,
+            keep_supp=keep_supp,
+            combine="track",
+        )
+        progress.advance(sum(os.path.getsize(f) for f in files), reads=len(datadf))
+        if split:
+            datadf = split_runs(datadf, split)
+        return in_time_window([datadf], [None], time_window)[0] if time_window else datadf
+    windowed = None
+    if source == "ubam":
+        dfs = process_unaligned(files, threads=threads)
+    elif source == "fastq":
+        with cfutures.ProcessPoolExecutor(max_workers=min(len(files), threads)) as executor:
+            dfs = list(
+                reported(
+                    files,
+                    executor.map(
+                        partial(process_fastq, batch_size=batch_size, prefetch=prefetch), files
+                    ),
+                )
+            )
+    elif source == "fastq_rich":
+        windowed = own_dataset(names or files, split)
+        with cfutures.ProcessPoolExecutor(max_workers=min(len(files), threads)) as executor:
+            futures = [
+                executor.submit(
+                    process_fastq_rich,
+                    f,
+                    batch_size=batch_size,
+                    prefetch=prefetch,
+                    time_window=time_window,
+                    per_run=bool(split),
+                    exact=exact,
+                )
+                for f, exact in zip(files, windowed)
+            ]
+            dfs = list(reported(files, (future.result() for future in futures)))
+    else:
+        dfs = process_alignments(files, threads=threads, samtype=source, keep_supp=keep_supp)
+    return combine(dfs, names or files, time_window=time_window, split=split, windowed=windowed)
+
+
+def reported(files, results, count=lambda res: len(res["lengths"])):
+    """Yield the results of work on <files>, reporting every result as done, see nanocomp.progress.
+
+    The size of a file is divided equally over its results, of which the reads are <count>ed.
+    """
+    shares = Counter(files)
+    for f, res in zip(files, results):
+        progress.advance(os.path.getsize(f) / shares[f], file=f, reads=count(res))
+        yield res
+
+
+def combine(dfs, names, time_window=None, split=None, windowed=None):
+    """Combine the DataFrames of all files, as nanoget.get_input does with combine="track".
+
+    With <split> the reads of every file are assigned to the dataset of their run first,
+    with a <time_window> the reads outside it are dropped from every file before combining,
+    apart from the files <windowed> by their reader already, see window_frame().
+    """
+    if split:
+        dfs = [split_runs(df, split, name) for df, name in zip(dfs, names)]
+    if time_window:
+        dfs = in_time_window(dfs, names, time_window, skip=windowed)
+    if split:
+        datadf = concat_tracked(dfs)
+    else:
+        datadf = combine_dfs(
+            dfs=dfs,
+            names=names,
+            method="track",
+        )
+    if "readIDs" in datadf.columns and pd.isna(datadf["readIDs"]).any():
+        datadf.drop("readIDs", axis="columns", inplace=True)
+    datadf = calculate_start_time(datadf)
+    if time_window and "start_time" in datadf:
+        # last, as calculate_start_time adds it
+        datadf["start_time"] = datadf.pop("start_time")
+    logging.info("NanoComp: Gathered all metrics of {} reads".format(len(datadf)))
+    if len(datadf) == 0:
+        logging.critical("NanoComp: no reads retrieved.")
+        sys.exit("Fatal: No reads found in input.")
+    return datadf
+
+
+def process_summary(
+    summaryfile,
+    readtype="1D",
+    barcoded=False,
+    run_ids=False,
+    end_reasons=False,
+    keep_end_reasons=False,
+    time_window=None,
+    exact=False,
+):
+    """Return the metrics of the reads in a summary file as nanoget's process_summary, and the
+    number of reads per end reason if requested and in the file, or None.
+
+    The file is parsed by the multithreaded CSV reader of pyarrow, only reading the columns
+    used, with their types given. With <run_ids> the run ID of every read is in 'runIDs'.
+    With <keep_end_reasons> the end reason of every read is in 'end_reason' instead of counted.
+    With a <time_window> the reads known to be outside it are dropped before the conversion,
+    see window_frame(), per run with <run_ids>, all if the file is <exact>ly one dataset.
+    The numeric columns are converted to the DataFrame without copying.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+
+    logging.info(f"NanoComp: Collecting metrics from summary file {summaryfile}")
+    available = ex.summary_columns(summaryfile)
+    colnames = dict(SUMMARY_COLUMNS[readtype])
+    if run_ids:
+        colnames["run_id"] = "runIDs"
+    extra_cols = []
+    if barcoded:
+        # as nanoget, see nanoget.extraction_functions.barcodes_from_alias
+        if "barcode_arrangement" not in available and "alias" in available:
+            colnames["alias"] = "barcode"
+        else:
+            colnames["barcode_arrangement"] = "barcode"
+            if "alias" in available:
+                extra_cols.append("alias")
+    if end_reasons and "end_reason" in available:
+        extra_cols.append("end_reason")
+    if not set(colnames).issubset(available):
+        sys.exit(
+            "ERROR: expected columns in summary file {} not found:\n {}".format(
+                summaryfile, ", ".join(colnames)
+            )
+        )
+    columns = list(colnames) + extra_cols
+    types = {
+        c: pa.type_for_alias(SUMMARY_TYPES[c])
+        if c in SUMMARY_TYPES
+        else pa.dictionary(pa.int32(), pa.string())
+        for c in columns
+    }
+    table = pacsv.read_csv(
+        summaryfile,
+        parse_options=pacsv.ParseOptions(delimiter="\t"),
+        convert_options=pacsv.ConvertOptions(include_columns=columns, column_types=types),
+    )
+    counts = None
+    if "end_reason" in extra_cols and not keep_end_reasons:
+        counts = count_values(table["end_reason"])
+        table = table.drop_columns(["end_reason"])
+    elif end_reasons:
+        logging.info(f"NanoComp: No end reasons in summary file {summaryfile}.")
+    table = table.rename_columns([colnames.get(c, c) for c in table.column_names])
+    # as nanoget, reads of which the length is missing are kept
+    table = table.filter(pc.fill_null(pc.not_equal(table["lengths"], 0), True))
+    if time_window:
+        table = window_frame(table, summaryfile, time_window, per_run=run_ids, exact=exact)
+    datadf = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    if "alias" in extra_cols:
+        datadf = ex.barcodes_from_alias(datadf)
+    # within an exact time window the time is replaced by the start_time, see window_frame
+    datadf = datadf[[c for c in [*colnames.values(), "start_time", "end_reason"] if c in datadf]]
+    return reduce_memory_usage(datadf), counts
+
+
+def reduce_memory_usage(datadf):
+    """Return a DataFrame with the memory usage reduced by nanoget.utils.reduce_memory_usage,
+    apart from the time column of the start of every read.
+
+    Whether that rounds float64 columns to float32 precision depends on how the columns are
+    stored, so that the time, and the start_time calculated from it, would differ depending
+    on whether the reads were filtered in the reader first, see window_frame().
+    """
+    if "time" not in datadf:
+        return ut.reduce_memory_usage(datadf)
+    position = datadf.columns.get_loc("time")
+    time = datadf.pop("time")
+    datadf = ut.reduce_memory_usage(datadf)
+    datadf.insert(position, "time", time)
+    return datadf
+
+
+def split_runs(df, split, name=None):
+    """Return the DataFrame of a file with a 'dataset' column with the name of the run
+    of every read, from <split>: the names of run IDs of --split_runs.
+
+    Reads with a run ID not in <split> keep the dataset <name> of the file, or without a name,
+    for combined data, their dataset. Their number is reported per run ID.
+    """
+    if "runIDs" not in df:
+        sys.exit("ERROR: --split_runs requires run IDs, which are not in the input.")
+    run_ids = df["runIDs"].astype("category")
+    codes = run_ids.cat.codes.to_numpy()
+    categories = list(run_ids.cat.categories)
+    # code -1, of reads without run ID, takes the last entry
+    known = np.array([r in split for r in categories] + [False])[codes]
+    datasets = np.array([split.get(r) for r in categories] + [None], dtype=object)[codes]
+    datasets = np.where(known, datasets, df["dataset"].to_numpy() if name is None else name)
+    if not known.all():
+        unknown = run_ids[~known].astype(object).fillna("none").value_counts()
+        message = (
+            f"{(~known).sum()} reads of {name or 'the input'} have a run ID not in --split_runs, "
+            f"kept in dataset {name or 'of their file'}: "
+            + ", ".join(f"{run_id} ({number})" for run_id, number in unknown.items())
+        )
+        logging.warning(f"NanoComp: {message}")
+        sys.stderr.write(f"\nWarning: {message}\n\n")
+    return df.assign(dataset=datasets)
+
+
+def in_time_window(dfs, names, window, skip=None):
+    """Return the DataFrames of all files with only the reads started in the time <window>,
+    (start, end) in hours since the start of their dataset, logging the reads dropped.
+
+    The start of a dataset is its first read over all its files, as in
+    nanoget.calculate_start_time. Its start_time is calculated here already, so that
+    times stay relative to the start of the run rather than to the first read kept.
+    The dataset of a DataFrame is its name, or of every read its 'dataset' if it has one,
+    as combined DataFrames, of which the start_time is calculated, which get name None.
+    DataFrames without time information are returned unchanged, as are those to <skip>.
+    """
+    times = [None if done else start_times(df) for df, done in zip(dfs, skip or [False] * len(dfs))]
+    zeros = {}
+    for df, name, time in zip(dfs, names, times):
+        if time is None or len(time) == 0:
+            continue
+        if "dataset" in df:
+            firsts = time.groupby(df["dataset"].to_numpy()).min().items()
+        else:
+            firsts = [(name, time.min())]
+        for dataset, first in firsts:
+            zeros[dataset] = min(zeros.get(dataset, first), first)
+    start, end = (pd.Timedelta(hours=hours) for hours in window)
+    kept = []
+    dropped = {}
+    for df, name, time in zip(dfs, names, times):
+        if time is None:
+            kept.append(df)
+            continue
+        start_time = time - (df["dataset"].map(zeros) if "dataset" in df else zeros.get(name))
+        inside = ((start_time >= start) & (start_time < end)).to_numpy()
+        if "dataset" in df:
+            outside = df["dataset"][~inside].value_counts(sort=False).items()
+        else:
+            outside = [(name, (~inside).sum())]
+        for dataset, number in outside:
+            dropped[dataset] = dropped.get(dataset, 0) + int(number)
+        df = df.loc[inside].drop(columns=["time", "timestamp"], errors="ignore")
+        df["start_time"] = start_time[inside].to_numpy()
+        kept.append(df)
+    for name, number in dropped.items():
+        if number == 0:
+            continue
+        logging.info(
+            f"NanoComp: Dropped {number} reads of {name} started outside "
+            f"{window[0]} to {window[1]} hours."
+        )
+    return kept
+
+
+def start_times(df):
+    """Return the time each read started, as used by nanoget.calculate_start_time, or None."""
+    if "time" in df:
+        return pd.Series(df["time"], dtype="datetime64[s]")
+    if "timestamp" in df:
+        return df["timestamp"]
+    if "start_time" in df:
+        return df["start_time"]
+    return None
+
+
+def own_dataset(names, split=None):
+    """Return for every file of which the datasets are <names> whether it is a dataset of its own,
+    not sharing its name with other files nor split in runs by <split>."""
+    return [not split and names.count(name) == 1 for name in names]
+
+
+def window_frame(frame, path, window, per_run=False, exact=False, dropped=0):
+    """Return a DataFrame or pyarrow Table of a file without the reads of which the start is known
+    to be outside the time <window>, see outside_window(), logging how many were dropped,
+    adding those <dropped> before.
+
+    The start of the dataset is taken as the first read of the file, of every 'dataset' in it,
+    or of every run with <per_run>, as these are never earlier than the start of their dataset.
+    If the file is <exact>ly one dataset, all reads outside the window are dropped and its
+    start_time is calculated, as in in_time_window(), which then skips the file.
+    """
+    columns = column_names(frame)
+    time = next((c for c in ["time", "timestamp", "start_time"] if c in columns), None)
+    if time is None:
+        return frame
+    groups = next((c for c in ["runIDs"] * per_run + ["dataset"] if c in columns), None)
+    exact = exact and groups is None
+    if isinstance(frame, pd.DataFrame):
+        data = frame[[time] + ([groups] if groups else [])]
+    else:
+        data = frame.select([time] + ([groups] if groups else [])).to_pandas()
+    times = start_times(data)
+    firsts = first_starts(times, {}, data[groups] if groups else None)
+    outside = outside_window(times, window, firsts, exact=exact)
+    logging.info(
+        f"NanoComp: Dropped {dropped + outside.sum()} reads of {path} started outside "
+        f"{window[0]} to {window[1]} hours."
+    )
+    if isinstance(frame, pd.DataFrame):
+        frame = frame.loc[~outside]
+    else:
+        import pyarrow as pa
+
+        frame = frame.filter(pa.array(~outside))
+    if exact and firsts is not None:
+        start_time = (times - firsts)[~outside].to_numpy()
+        times = [c for c in ["time", "timestamp", "start_time"] if c in columns]
+        if isinstance(frame, pd.DataFrame):
+            frame = frame.drop(columns=times).assign(start_time=start_time)
+        else:
+            frame = frame.drop_columns(times).append_column("start_time", pa.array(start_time))
+    return frame
+
+
+def first_starts(times, firsts, groups=None):
+    """Return the first of the reads started at <times> and the earlier reads, of which the first
+    per group are <firsts>, updated here, or with <groups> of every read that of its group."""
+    if groups is None:
+        batch = [(None, times.min())]
+    else:
+        batch = times.groupby(np.asarray(groups)).min().items()
+    for group, first in batch:
+        if not pd.isna(first):
+            firsts[group] = min(firsts.get(group, first), first)
+    if groups is None:
+        return firsts.get(None)
+    return pd.Series(np.asarray(groups), index=times.index).map(firsts)
+
+
+def outside_window(times, window, firsts, exact=False):
+    """Return the mask of the reads started at <times>, see start_times(), known to be outside
+    the time <window>, (start, end) in hours since the start of their dataset.
+
+    <firsts> is the first start known of the dataset of every read, see first_starts(). As a
+    dataset doesn't start after any of its reads, those started <end> hours or more later are
+    outside, and if it is <exact>ly the start of the dataset, all reads outside are known.
+    The readers drop these reads, in_time_window() those left once all files are read.
+    """
+    if firsts is None:
+        return np.zeros(len(times), dtype=bool)
+    start, end = (pd.Timedelta(hours=hours) for hours in window)
+    start_time = times - firsts
+    if exact:
+        return ~((start_time >= start) & (start_time < end)).to_numpy()
+    return (start_time >= end).to_numpy()
+
+
+def get_stored(
+    source, files, threads=4, names=None, sample=None, extras=None, time_window=None, split=None
+):
+    """Get a DataFrame with the data stored earlier in pickle (--store) or feather files.
+
+    The datasets are named after <names>, or without names after the feather files, or the
+    datasets stored in the pickle files. The files are loaded concurrently by up to <threads>
+    threads, of feather files only the STORED_COLUMNS are read, and combined by concat_tracked.
+    With <sample> (--quick) only that many reads per dataset are kept, and the table of the
+    number of reads sampled and stored is added to <extras>, see nanocomp.quick.
+    With a <time_window> only the reads started in it are kept, see in_time_window(), of which
+    most others are dropped from every file once loaded, see window_frame(),
+    with <split> the reads are assigned to the dataset of their run, see split_runs().
+    """
+    load = partial(load_feather, sample=sample) if source == "feather" else load_pickle
+    with cfutures.ThreadPoolExecutor(max_workers=max(1, min(threads, len(files)))) as executor:
+        loaded = reported(files, executor.map(load, files), count=lambda res: len(res[0]))
+        frames, rows = map(list, zip(*loaded))
+    sampled = [len(frame) for frame in frames]
+    if time_window:
+        frames = [
+            window_frame(frame, path, time_window, per_run=bool(split))
+            for frame, path in zip(frames, files)
+        ]
+    if source == "feather":
+        names = names or files
+    datadf = concat_tracked(frames, names, threads=threads)
+    if source == "feather":
+        datadf = datadf.rename(columns={"identities": "percentIdentity"})
+    if split:
+        datadf = split_runs(datadf, split)
+    if time_window:
+        datadf = in_time_window([datadf], [None], time_window)[0]
+    if sample:
+        from nanocomp.quick import sample_table, subsample
+
+        if source == "feather":
+            table = sample_table(sampled, rows, names)
+        else:
+            datadf, table = subsample(datadf, sample)
+        if extras is not None:
+            extras["quick"] = table
+    logging.info(f"NanoComp: Loaded {len(datadf)} reads from {len(files)} {source} files.")
+    return datadf
+
+
+def load_pickle(path):
+    """Return the DataFrame stored in a pickle file, and its number of rows."""
+    import pickle
+
+    with open(path, "rb") as handle:
+        df = pickle.load(handle)
+    return df, len(df)
+
+
+def load_feather(path, sample=None):
+    """Return a pyarrow Table with the STORED_COLUMNS of a feather file, and its number of rows.
+
+    With <sample> only a seeded random sample of that many rows is kept.
+    """
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+
+    with ipc.open_file(path) as reader:
+        columns = [c for c in reader.schema.names if c in STORED_COLUMNS]
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    rows = table.num_rows
+    if sample and rows > sample:
+        rng = np.random.default_rng(0)
+        table = table.take(np.sort(rng.choice(rows, sample, replace=False)))
+    return table, rows
+
+
+def concat_tracked(frames, names=None, threads=4):
+    """Return DataFrames or pyarrow Tables concatenated with a 'dataset' column of their names,
+    as nanoget.combine_dfs with method="track", or with their own 'dataset' column without names.
+
+    Every numeric column is allocated once at its full length, after which every frame is
+    copied into its part of it by up to <threads> threads and then dropped from <frames>.
+    As the pages of the columns are only allocated when filled, and Tables are converted per
+    column while copying, the memory used stays close to that of the data once.
+    """
+    sizes = [len(frame) for frame in frames]
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    present = [column_names(frame) for frame in frames]
+    columns = list(dict.fromkeys([c for p in present for c in p] + ["dataset"]))
+    data = {}
+    numeric = []
+    for column in columns:
+        if column == "dataset" and names is not None:
+            data[column] = pd.Series(names).repeat(sizes).reset_index(drop=True)
+            continue
+        dtypes = {column_dtype(f, column) for f, p in zip(frames, present) if column in p}
+        if (
+            all(isinstance(d, np.dtype) and d.kind in "biufmM" for d in dtypes)
+            and len({d.kind for d in dtypes}) == 1
+            and all(column in p for p in present)
+        ):
+            data[column] = np.empty(bounds[-1], dtype=np.result_type(*dtypes))
+            numeric.append(column)
+        else:
+            data[column] = pd.concat(
+                [
+                    column_values(f, column) if column in p else pd.Series(np.nan, index=range(n))
+                    for f, p, n in zip(frames, present, sizes)
+                ],
+                ignore_index=True,
+            )
+
+    def fill(index):
+        start, end = bounds[index], bounds[index + 1]
+        for column in numeric:
+            data[column][start:end] = column_values(frames[index], column)
+        table = not isinstance(frames[index], pd.DataFrame)
+        frames[index] = None
+        if table:
+            import pyarrow
+
+            # the pyarrow memory pool keeps the memory of dropped Tables otherwise
+            pyarrow.default_memory_pool().release_unused()
+
+    with cfutures.ThreadPoolExecutor(max_workers=max(1, min(threads, len(frames)))) as executor:
+        list(executor.map(fill, range(len(frames))))
+    return pd.DataFrame(data, copy=False)
+
+
+def column_names(frame):
+    return list(frame.columns) if isinstance(frame, pd.DataFrame) else frame.column_names
+
+
+def column_dtype(frame, column):
+    """Return the dtype of a column of a DataFrame, or of a Table once converted to pandas."""
+    if isinstance(frame, pd.DataFrame):
+        return frame[column].dtype
+    try:
+        dtype = np.dtype(frame.schema.field(column).type.to_pandas_dtype())
+    except TypeError:
+        return None
+    if frame.column(column).null_count and dtype.kind in "biu":
+        return np.dtype(object) if dtype.kind == "b" else np.dtype(np.float64)
+    return dtype
+
+
+def column_values(frame, column):
+    """Return the values of a column of a DataFrame, or of a Table converted to pandas."""
+    if isinstance(frame, pd.DataFrame):
+        return frame[column]
+    return frame.column(column).to_pandas()
+
+
+def count_end_reasons(summaryfile):
+    """Return the number of reads per end reason in a summary file, or None if not in the file.
+
+    Only the end_reason column is parsed, by pyarrow as in process_summary.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    if "end_reason" not in ex.summary_columns(summaryfile):
+        logging.info(f"NanoComp: No end reasons in summary file {summaryfile}.")
+        return None
+    table = pacsv.read_csv(
+        summaryfile,
+        parse_options=pacsv.ParseOptions(delimiter="\t"),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=["end_reason"],
+            column_types={"end_reason": pa.dictionary(pa.int32(), pa.string())},
+        ),
+    )
+    return count_values(table["end_reason"])
+
+
+def count_values(column):
+    """Return the number of times every value occurs in a pyarrow column, sorted by value."""
+    counts = column.combine_chunks().value_counts()
+    return pd.Series(
+        counts.field("counts").to_numpy().astype("int64"),
+        index=counts.field("values").to_pylist(),
+    ).sort_index()
+
+
+def end_reasons(counts, names):
+    """Return a DataFrame with the number of reads per end reason (rows) and dataset (columns).
+
+    Datasets with the same name are summed, as their reads are merged.
+    Returns None if the end reasons are missing for any of the files.
+    """
+    if any(c is None for c in counts):
+        return None
+    df = pd.concat(counts, axis="columns", keys=range(len(counts))).fillna(0).astype("int64")
+    df.columns = names
+    return df.T.groupby(level=0, sort=False).sum().T
+
+
+def end_reasons_of(datadf, by="dataset"):
+    """Return a DataFrame as end_reasons() from the 'end_reason' of every read of a DataFrame,
+    per dataset in the order they first occur, or sorted per value of another column <by>."""
+    reasons = datadf["end_reason"].astype(object)
+    counts = reasons.groupby(datadf[by].astype(object), sort=by != "dataset").value_counts()
+    counts = counts.unstack(level=0, fill_value=0).rename_axis(index=None, columns=None)
+    return counts.sort_index().astype("int64")
+
+
+def get_mux_scan(files, names, threads=4):
+    """Return the number of channels per pore state in the mux scans of all datasets.
+
+    The mux_scan_data files are read in parallel, returning a DataFrame with the datasets
+    and repeats of the mux scan as rows and the pore states as columns.
+    """
+    logging.info(f"NanoComp: Reading {len(files)} mux scan files.")
+    with cfutures.ProcessPoolExecutor(max_workers=min(len(files), threads)) as executor:
+        counts = list(executor.map(count_mux_scan, files))
+    df = pd.concat(counts, keys=names, names=["dataset", "repeat"]).fillna(0).astype("int64")
+    df = df.groupby(level=["dataset", "repeat"], sort=False).sum()
+    states = [s for s in MUX_SCAN_STATES if s in df] + sorted(set(df) - set(MUX_SCAN_STATES))
+    return df[states]
+
+
+def count_mux_scan(path):
+    """Return the number of channels per repeat (rows) and pore state (columns) of a mux scan.
+
+    Only the repeat and mux_scan_assessment columns of the (compressed) csv file are parsed,
+    and the channels are counted in one pass with numpy.
+    """
+    ut.check_existance(path)
+    try:
+        df = pd.read_csv(
+            path,
+            usecols=["repeat", "mux_scan_assessment"],
+            dtype={"mux_scan_assessment": "category"},
+        )
+    except ValueError:
+        logging.error(f"NanoComp: no repeat or mux_scan_assessment column in {path}")
+        sys.exit(f"ERROR: expected columns repeat and mux_scan_assessment not found in {path}")
+    repeats, repeat_index = pd.factorize(df["repeat"], sort=True)
+    states = df["mux_scan_assessment"].cat
+    valid = (repeats >= 0) & (states.codes.to_numpy() >= 0)
+    n_states = len(states.categories)
+    counts = np.bincount(
+        repeats[valid] * n_states + states.codes.to_numpy()[valid],
+        minlength=len(repeat_index) * n_states,
+    )
+    return pd.DataFrame(
+        counts.reshape(len(repeat_index), n_states),
+        index=pd.Index(repeat_index, name="repeat"),
+        columns=list(states.categories),
+    )
+
+
+def process_alignments(files, threads=4, samtype="bam", keep_supp=True):
+    """Extract metrics from sorted and indexed bam or cram files, returning a DataFrame per file.
+
+    Every file is split in regions of roughly equal numbers of mapped reads, and the regions
+    of all files are processed by one pool of workers. Results are collected in the order
+    of the regions, so the output is deterministic regardless of the number of threads.
+    """
+    tasks = []
+    for f in files:
+        logging.info(f"NanoComp: Starting to collect statistics from {samtype} file {f}.")
+        samfile = ex.check_bam(f, samtype=samtype)
+        tasks.extend([(f, regions) for regions in split_regions(samfile, chunks=threads * 4)])
+    logging.info(f"NanoComp: Processing {len(tasks)} regions using {threads} workers.")
+    with cfutures.ProcessPoolExecutor(max_workers=threads) as executor:
+        results = list(
+            reported(
+                [t[0] for t in tasks],
+                executor.map(
+                    extract_from_regions,
+                    [t[0] for t in tasks],
+                    [t[1] for t in tasks],
+                    repeat(keep_supp),
+                ),
+            )
+        )
+    dfs = []
+    for f in files:
+        datadf = alignment_frame([res for (name, _), res in zip(tasks, results) if name == f])
+        logging.info(
+            f"NanoComp: {samtype} {f} contains {datadf['lengths'].size} primary alignments."
+        )
+        dfs.append(datadf)
+    return dfs
+
+
+def alignment_frame(columns):
+    """Return the DataFrame of a file from the metrics extracted from parts of it, in order."""
+    datadf = (
+        pd.DataFrame({c: np.concatenate([res[c] for res in columns]) for c in ALIGNMENT_COLUMNS})
+        .dropna(axis="columns", how="all")
+        .dropna(axis="index", how="any")
+    )
+    return ut.reduce_memory_usage(datadf)
+
+
+def split_regions(samfile, chunks):
+    """Split the reference in regions containing roughly equal numbers of mapped reads.
+
+    The number of mapped reads per contig is taken from the index where possible, otherwise
+    contig lengths are used as weight. Large contigs are split in multiple regions,
+    small contigs are grouped together so that every task is of a similar size.
+    Returns a list of tasks, each task a list of (contig, start, end) regions.
+    """
+    try:
+        weights = {s.contig: s.mapped for s in samfile.get_index_statistics()}
+    except (AttributeError, ValueError):
+        weights = dict(zip(samfile.references, samfile.lengths))
+    contigs = [(c, l, weights.get(c, l)) for c, l in zip(samfile.references, samfile.lengths)]
+    contigs = [(c, l, w) for c, l, w in contigs if w > 0]
+    target = max(sum(w for _, _, w in contigs) / max(chunks, 1), 1)
+    tasks = []
+    current = []
+    current_weight = 0
+    for contig, length, weight in contigs:
+        pieces = min(ceil(weight / target), length)
+        if pieces > 1:
+            bounds = np.linspace(0, length, pieces + 1, dtype=int)
+            tasks.extend([[(contig, int(s), int(e))] for s, e in zip(bounds[:-1], bounds[1:])])
+            continue
+        current.append((contig, 0, length))
+        current_weight += weight
+        if current_weight >= target:
+            tasks.append(current)
+            current, current_weight = [], 0
+    if current:
+        tasks.append(current)
+    return tasks
+
+
+def extract_from_regions(bam, regions, keep_supplementary=True):
+    """Extract metrics from the alignments starting in a list of regions.
+
+    Worker function, returning a dictionary of arrays with metrics per read:
+    -read identifiers
+    -qualities
+    -aligned qualities
+    -lengths
+    -aligned lengths
+    -mapping qualities
+    -percent identity to the reference genome
+
+    Reads overlapping the start of a region are skipped, as these are extracted by the
+    region in which the alignment starts, such that every alignment is counted once.
+    Secondary alignments and unmapped reads are always ignored,
+    supplementary alignments only if keep_supplementary is False.
+    """
+    samfile = pysam.AlignmentFile(bam, "rb")
+    res = []
+    for contig, start, end in regions:
+        for read in samfile.fetch(contig, start, end, multiple_iterators=True):
+            if read.reference_start < start:
+                continue
+            if is_primary(read, keep_supplementary):
+                res.append(alignment_metrics(read))
+    return alignment_columns(res)
+
+
+def is_primary(read, keep_supplementary=True):
+    """Return if an alignment is used, skipping secondary alignments and unmapped reads,
+    and supplementary alignments if keep_supplementary is False."""
+    if read.is_secondary or read.is_unmapped:
+        return False
+    return keep_supplementary or not read.is_supplementary
+
+
+def alignment_metrics(read):
+    return (
+        read.query_name,
+        ave_qual(read.query_qualities),
+        ave_qual(read.query_alignment_qualities),
+        read.query_length,
+        read.query_alignment_length,
+        read.mapping_quality,
+        get_pID(read),
+    )
+
+
+def alignment_columns(res):
+    """Return a dictionary of arrays from the metrics of the reads, see alignment_metrics()."""
+    columns = list(zip(*res)) or [[] for _ in ALIGNMENT_COLUMNS]
+    return {
+        "readIDs": np.array(columns[0], dtype=object),
+        "quals": np.array(columns[1], dtype=float),
+        "aligned_quals": np.array(columns[2], dtype=float),
+        "lengths": np.array(columns[3], dtype=np.int64),
+        "aligned_lengths": np.array(columns[4], dtype=np.int64),
+        "mapQ": np.array(columns[5], dtype=np.int64),
+        "percentIdentity": np.array(columns[6], dtype=float),
+    }
+
+
+def ave_qual(quals):
+    """Calculate average basecall quality of a read, averaging in error probability space.
+
+    Equivalent to nanoget.utils.ave_qual, but looking up the error probabilities in numpy.
+    The cumulative sum adds the probabilities one by one like the builtin sum does,
+    which keeps the result identical rather than different in the last decimals.
+    Returns None for reads without quality scores.
+    """
+    if quals is None or len(quals) == 0:
+        return None
+    errs = ERRS[np.frombuffer(quals, dtype=np.uint8)]
+    return -10 * log(np.cumsum(errs)[-1] / len(errs), 10)
+
+
+def get_pID(read):
+    """Return the percent identity of a read, as in nanoget.extraction_functions.get_pID
+
+    but using the cigar statistics calculated by htslib rather than looping over the cigar.
+    """
+    ops = read.get_cigar_stats()[0]
+    alignment_length = ops[0] + ops[7] + ops[8] + ops[1] + ops[2]
+    if alignment_length == 0:
+        return None
+    if read.has_tag("NM"):
+        return (1 - read.get_tag("NM") / alignment_length) * 100
+    elif read.has_tag("MD"):
+        return 100 * (1 - (ex.parse_MD(read.get_tag("MD")) + ops[1]) / alignment_length)
+    else:
+        return None
+
+
+def process_unaligned(files, threads=4):
+    """Extract metrics from unaligned bam files, returning a DataFrame per file.
+
+    Unaligned bam files have no index, so every file is split in chunks on BGZF block
+    boundaries instead, each chunk starting at the first complete record in its block.
+    All chunks of all files are processed by one pool of workers and concatenated in order,
+    which gives the same result as reading each file from start to end.
+    """
+    tasks = []
+    for f in files:
+        logging.info("NanoComp: Starting to collect statistics from ubam file {}.".format(f))
+        ut.check_existance(f)
+        starts = split_bgzf(f, chunks=threads * 4)
+        tasks.extend(zip(repeat(f), starts, starts[1:] + [None]))
+    logging.info(f"NanoComp: Processing {len(tasks)} ubam chunks using {threads} workers.")
+    with cfutures.ProcessPoolExecutor(max_workers=threads) as executor:
+        results = list(
+            reported(
+                [t[0] for t in tasks],
+                executor.map(
+                    extract_from_ubam,
+                    [t[0] for t in tasks],
+                    [t[1] for t in tasks],
+                    [t[2] for t in tasks],
+                ),
+            )
+        )
+    dfs = []
+    for f in files:
+        datadf = unaligned_frame([res for (name, _, _), res in zip(tasks, results) if name == f])
+        logging.info("NanoComp: ubam {} contains {} reads.".format(f, datadf["lengths"].size))
+        dfs.append(datadf)
+    if not all("timestamp" in df for df in dfs):
+        dfs = [df.drop(columns=UBAM_TAGS, errors="ignore") for df in dfs]
+    return dfs
+
+
+def unaligned_frame(columns):
+    """Return the DataFrame of a ubam file from the metrics extracted from parts of it, in order."""
+    datadf = pd.DataFrame({c: np.concatenate([res[c] for res in columns]) for c in columns[0]})
+    # tags are only used if every read has all of them, rather than dropping reads without
+    if datadf[UBAM_TAGS].isna().any(axis=None):
+        datadf = datadf.drop(columns=UBAM_TAGS)
+    datadf = datadf.dropna(axis="columns", how="all").dropna(axis="index", how="any")
+    if "timestamp" in datadf:
+        datadf["timestamp"] = pd.to_datetime(datadf["timestamp"], format="mixed", utc=True)
+        datadf["channelIDs"] = datadf["channelIDs"].astype("int64")
+    return ut.reduce_memory_usage(datadf)
+
+
+def split_bgzf(bam, chunks):
+    """Return the virtual offsets at which the chunks of a bgzf compressed bam file start.
+
+    The file is divided in <chunks> parts of equal compressed size, every split point is
+    moved forward to the next BGZF block and from there to the first record starting in the
+    decompressed data. The first chunk starts at the first record after the header.
+    """
+    samfile = pysam.AlignmentFile(bam, "rb", check_sq=False)
+    starts = [samfile.tell()]
+    n_references = samfile.nreferences
+    samfile.close()
+    size = os.path.getsize(bam)
+    with open(bam, "rb") as handle:
+        for offset in range(0, size, max(size // max(chunks, 1), 1))[1:]:
+            block = find_bgzf_block(handle, offset, size)
+            if block is None or block <= starts[-1] >> 16:
+                continue
+            start = first_record(handle, block, n_references)
+            if start is not None and start > starts[-1]:
+                starts.append(start)
+    return starts
+
+
+def read_bgzf_header(handle, offset):
+    """Return the total size of the BGZF block at offset, or None if no block starts there."""
+    handle.seek(offset)
+    header = handle.read(BGZF_HEADER_SIZE)
+    if len(header) < BGZF_HEADER_SIZE or not header.startswith(BGZF_MAGIC):
+        return None
+    xlen, si1, si2, slen, bsize = struct.unpack("<HBBHH", header[10:18])
+    if xlen != 6 or (si1, si2, slen) != (66, 67, 2):
+        return None
+    return bsize + 1
+
+
+def find_bgzf_block(handle, offset, size):
+    """Return the offset of the first BGZF block starting at or after offset.
+
+    A match of the magic bytes only counts as a block if the next block (or the end of the
+    file) follows directly after it, to avoid false positives in the compressed data.
+    """
+    handle.seek(offset)
+    window = handle.read(1 << 17)
+    position = window.find(BGZF_MAGIC)
+    while position != -1:
+        candidate = offset + position
+        block_size = read_bgzf_header(handle, candidate)
+        if block_size is not None:
+            following = candidate + block_size
+            if following == size or read_bgzf_header(handle, following) is not None:
+                return candidate
+        position = window.find(BGZF_MAGIC, position + 1)
+    return None
+
+
+def first_record(handle, block, n_references, max_blocks=256):
+    """Return the virtual offset of the first record starting in or after the block at offset.
+
+    Blocks are decompressed as long as needed to confirm a record, as long reads span many
+    blocks, up to max_blocks. A position is accepted as the start of a record when the record
+    fields are valid and the records directly following it are valid as well, or it is the
+    last record of the file. Returns None if no record is confirmed, in which case the data
+    is read from the record before instead.
+    """
+    data = bytearray()
+    offsets = []  # (compressed offset, start in data) of every decompressed block
+    coffset = block
+    eof = False
+    position = 0
+    while True:
+        if not eof and len(offsets) < max_blocks:
+            block_size = read_bgzf_header(handle, coffset)
+            if block_size is None:
+                eof = True
+            else:
+                handle.seek(coffset)
+                raw = handle.read(block_size)
+                offsets.append((coffset, len(data)))
+                data += zlib.decompress(raw[BGZF_HEADER_SIZE:-8], -15)
+                coffset += block_size
+                # the empty block at the end of the file
+                eof = len(raw) == block_size and block_size == 28
+        complete = eof or len(offsets) >= max_blocks
+        for candidate in record_candidates(data, position, n_references):
+            valid = is_record_chain(data, candidate, n_references, eof=eof)
+            if valid:
+                return to_virtual_offset(offsets, candidate)
+            if valid is None and not complete:
+                # the chain continues beyond the data, decompress the next block
+                position = candidate
+                break
+        else:
+            position = max(position, len(data) - 36)
+            if complete:
+                return None
+
+
+def record_candidates(data, start, n_references):
+    """Return the positions from <start> at which the fixed fields of a record are valid.
+
+    These are only the checks of is_record on the fields before the read name, done for
+    all positions at once with numpy, so that only few positions are checked by is_record.
+    """
+    n = len(data) - 36 - start
+    if n <= 0:
+        return []
+    buf = np.frombuffer(data, dtype=np.uint8)
+
+    def field(offset):
+        # the little endian int32 at every position, as an unaligned strided view
+        return np.ndarray((n,), dtype="<i4", buffer=data, offset=start + offset, strides=(1,))
+
+    ref_id, next_ref_id = field(4), field(24)
+    names = buf[start + 36 : start + 36 + n]
+    valid = (
+        (field(0) >= 34)
+        & (ref_id >= -1)
+        & (ref_id < n_references)
+        & (next_ref_id >= -1)
+        & (next_ref_id < n_references)
+        & (field(8) >= -1)
+        & (field(28) >= -1)
+        & (buf[start + 12 : start + 12 + n] >= 2)
+        & (names >= 33)
+        & (names <= 126)
+    )
+    return (np.flatnonzero(valid) + start).tolist()
+
+
+def to_virtual_offset(offsets, position):
+    """Convert a position in the decompressed data to a BGZF virtual offset."""
+    coffset, start = [(c, s) for c, s in offsets if s <= position][-1]
+    return coffset << 16 | (position - start)
+
+
+def is_record_chain(data, position, n_references, length=3, eof=False):
+    """Check if valid bam records start at position and directly after it.
+
+    Returns None if the data ends before <length> records are checked, unless it is the end
+    of the file (<eof>), in which case records ending exactly at the end are valid.
+    """
+    for _ in range(length):
+        if eof and position == len(data):
+            return True
+        block_size = is_record(data, position, n_references)
+        if block_size is None:
+            return False if eof else None
+        if not block_size:
+            return False
+        position += 4 + block_size
+    return True
+
+
+def is_record(data, position, n_references):
+    """Return the block_size of the bam record at position, False if it is not one,
+    or None if the data ends before the read name.
+
+    Checks the fixed length fields of the record against the bam specification
+    and whether the read name is printable and NUL terminated.
+    """
+    if position + 36 > len(data):
+        return None
+    fields = struct.unpack_from("<iiiBBHHHiiii", data, position)
+    block_size, ref_id, pos, l_read_name = fields[:4]
+    n_cigar_op, l_seq, next_ref_id, next_pos = fields[6], fields[8], fields[9], fields[10]
+    if block_size < 32 + l_read_name or l_read_name < 2 or l_seq < 0:
+        return False
+    if not (-1 <= ref_id < n_references and -1 <= next_ref_id < n_references):
+        return False
+    if pos < -1 or next_pos < -1:
+        return False
+    if 32 + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq > block_size:
+        return False
+    name_end = position + 36 + l_read_name - 1
+    if name_end >= len(data):
+        return None
+    name = data[position + 36 : name_end]
+    if data[name_end] != 0 or not all(33 <= c <= 126 for c in name):
+        return False
+    return block_size
+
+
+def extract_from_ubam(bam, start, end=None):
+    """Extract metrics from the records of an unaligned bam file between two virtual offsets.
+
+    Worker function, returning a dictionary of arrays with per read:
+    -read identifiers
+    -qualities
+    -lengths
+    -channel, start time and run id, if these are stored as ch, st and RG tags
+    """
+    samfile = pysam.AlignmentFile(bam, "rb", check_sq=False)
+    samfile.seek(start)
+    res = []
+    while end is None or samfile.tell() < end:
+        try:
+            read = next(samfile)
+        except StopIteration:
+            break
+        res.append(unaligned_metrics(read))
+    return unaligned_columns(res)
+
+
+def unaligned_metrics(read):
+    return (
+        read.query_name,
+        ave_qual(read.query_qualities),
+        read.query_length,
+        read.get_tag("ch") if read.has_tag("ch") else None,
+        read.get_tag("st") if read.has_tag("st") else None,
+        read.get_tag("RG").partition("_")[0] if read.has_tag("RG") else None,
+    )
+
+
+def unaligned_columns(res):
+    """Return a dictionary of arrays from the metrics of the reads, see unaligned_metrics()."""
+    columns = list(zip(*res)) or [[] for _ in range(6)]
+    return {
+        "readIDs": np.array(columns[0], dtype=object),
+        "quals": np.array(columns[1], dtype=float),
+        "lengths": np.array(columns[2], dtype=np.int64),
+        "channelIDs": np.array(columns[3], dtype=object),
+        "timestamp": np.array(columns[4], dtype=object),
+        "runIDs": np.array(columns[5], dtype=object),
+    }
+
+
+def open_binary(path):
+    """Return a binary handle to a (compressed) fastq or fasta file, based on the extension."""
+    ut.check_existance(path)
+    if path.endswith((".gz", "bgz")):
+        import gzip
+
+        logging.info("NanoComp: Decompressing gzipped {}".format(path))
+        return gzip.open(path, "rb")
+    elif path.endswith(".bz2"):
+        import bz2
+
+        logging.info("NanoComp: Decompressing bz2 compressed {}".format(path))
+        return bz2.open(path, "rb")
+    elif path.endswith((".fastq", ".fq", "fasta", ".fa", ".fas")):
+        return open(path, "rb")
+    else:
+        logging.error("INPUT ERROR: Unrecognized file extension {}".format(path))
+        sys.exit(
+            "INPUT ERROR:\nUnrecognized file extension in {}\n"
+            "Supported are gz, bz2, bgz, fastq, fq, fasta, fa and fas".format(path)
+        )
+
+
+def process_fastq(fastq, batch_size=1 << 24, prefetch=PREFETCH):
+    """Extract the mean quality and length of all reads in a fastq file.
+
+    The file is parsed in batches of batch_size bytes, each handled as a whole by numpy,
+    while up to <prefetch> next batches are read and decompressed, see fastq_batches().
+    This requires a fastq file with four lines per record, which is what sequencers
+    and basecallers write. For other files nanoget is used instead.
+    """
+    logging.info("NanoComp: Starting to collect statistics from plain fastq file {}.".format(fastq))
+    try:
+        metrics = [
+            fastq_metrics(*batch) for batch in fastq_batches(fastq, batch_size, prefetch)
+        ]
+    except ValueError:
+        logging.info("NanoComp: {} is not a four-line fastq file, using nanoget.".format(fastq))
+        return ex.process_fastq_plain(fastq)
+    datadf = pd.DataFrame(
+        {
+            "quals": np.concatenate([m[0] for m in metrics] or [np.empty(0)]),
+            "lengths": np.concatenate([m[1] for m in metrics] or [np.empty(0, dtype=np.int64)]),
+        }
+    ).dropna()
+    return ut.reduce_memory_usage(datadf)
+
+
+def process_fastq_rich(
+    fastq,
+    batch_size=1 << 24,
+    prefetch=PREFETCH,
+    time_window=None,
+    per_run=False,
+    exact=False,
+):
+    """Extract metrics from a fastq file with channel, start time and run id in the description.
+
+    The file is parsed in batches as in process_fastq, and from the descriptions only
+    the fields used for plotting are extracted into arrays, batch per batch.
+    With a <time_window> the reads of every batch started <end> hours or more after the first
+    read so far, of their run with <per_run>, are dropped, see outside_window(), and once the
+    file is read the others outside it if the file is <exact>ly one dataset.
+    For files not in the four-line format nanoget is used instead.
+    """
+    logging.info("NanoComp: Starting to collect statistics from rich fastq file {}.".format(fastq))
+    metrics = []
+    firsts = {}
+    dropped = 0
+    try:
+        for buf, starts, ends in fastq_batches(fastq, batch_size, prefetch):
+            quals, lengths = fastq_metrics(buf, starts, ends)
+            fields = rich_fields(buf, starts[0::4], ends[0::4])
+            batch = pd.DataFrame(dict(quals=quals, lengths=lengths, **fields)).dropna()
+            if time_window:
+                times = batch["timestamp"]
+                groups = batch["runIDs"] if per_run else None
+                outside = outside_window(times, time_window, first_starts(times, firsts, groups))
+                dropped += outside.sum()
+                batch = batch.loc[~outside]
+            metrics.append(batch)
+    except ValueError:
+        logging.info("NanoComp: {} is not a four-line fastq file, using nanoget.".format(fastq))
+        return ex.process_fastq_rich(fastq)
+    if not metrics:
+        return pd.DataFrame(columns=["quals", "lengths", "channelIDs", "timestamp", "runIDs"])
+    datadf = pd.DataFrame(
+        {
+            "quals": np.concatenate([m["quals"] for m in metrics]),
+            "lengths": np.concatenate([m["lengths"] for m in metrics]),
+            "channelIDs": np.concatenate([m["channelIDs"] for m in metrics]),
+            "timestamp": pd.concat([m["timestamp"] for m in metrics], ignore_index=True),
+            "runIDs": union_categoricals([m["runIDs"] for m in metrics]),
+        }
+    )
+    del metrics
+    if time_window:
+        datadf = window_frame(datadf, fastq, time_window, per_run, exact, dropped)
+    return ut.reduce_memory_usage(datadf)
+
+
+def rich_fields(buf, starts, ends):
+    """Extract channel, start time and run id from the header lines of a batch of records.
+
+    Returns the channels as integers, the start times as datetimes and the run ids as
+    a categorical, without keeping the description text of the reads.
+    Exits if a read lacks one of the fields, as nanoget does.
+    """
+    fields = {}
+    for name, pattern in RICH_FIELDS.items():
+        matches = list(pattern.finditer(buf))
+        records = np.searchsorted(starts, [m.start() for m in matches], side="right") - 1
+        # only the first occurrence in a header counts
+        records, first = np.unique(records, return_index=True)
+        if len(records) != len(starts):
+            missing = np.setdiff1d(np.arange(len(starts)), records)[0]
+            description = buf[starts[missing] : ends[missing]].tobytes().decode(errors="replace")
+            logging.error(f"NanoComp: keyerror when processing record {description}")
+            sys.exit(
+                f"Unexpected fastq identifier:\n{description}\n\n \
+            missing one or more of expected fields 'ch', 'start_time' or 'runid'"
+            )
+        values = [matches[i].group(1) or matches[i].group(2) for i in first]
+        if name == "channelIDs":
+            fields[name] = np.array(values).astype(np.int64)
+        elif name == "timestamp":
+            fields[name] = pd.Series(
+                pd.to_datetime(np.array(values).astype(str), format="mixed", utc=True)
+            )
+        else:
+            fields[name] = pd.Categorical(np.array(values).astype(str))
+    return fields
+
+
+def fastq_batches(fastq, batch_size=1 << 24, prefetch=PREFETCH):
+    """Read a fastq file in batches of complete records.
+
+    Yields the batch as a numpy array of bytes, with the start and end positions of
+    every line in it, excluding the line endings. The lines of incomplete records
+    at the end of a batch are carried over to the next batch.
+    The next <prefetch> chunks of the file are read by another thread, see prefetched().
+    Raises a ValueError if the file does not end with a complete record.
+    """
+    leftover = b""
+    for chunk in prefetched(read_chunks(fastq, batch_size), prefetch):
+        data = leftover + chunk
+        buf = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buf == 10)
+        if not chunk and data and data[-1] != 10:
+            newlines = np.append(newlines, len(data))
+        n_lines = len(newlines) // 4 * 4
+        if n_lines:
+            ends = newlines[:n_lines]
+            starts = np.concatenate(([0], ends[:-1] + 1))
+            leftover = data[ends[-1] + 1 :]
+            # strip the carriage return of windows line endings
+            ends = ends - (buf[np.maximum(ends - 1, 0)] == 13)
+            yield buf, starts, ends
+        else:
+            leftover = data
+        if not chunk:
+            if leftover.strip():
+                raise ValueError("Incomplete record at the end of {}".format(fastq))
+            return
+
+
+def read_chunks(path, size):
+    """Yield the (decompressed) content of a file in chunks of <size> bytes, the last empty."""
+    with open_binary(path) as handle:
+        while True:
+            chunk = handle.read(size)
+            yield chunk
+            if not chunk:
+                return
+
+
+def prefetched(chunks, depth=PREFETCH):
+    """Yield the items of the iterator <chunks>, produced up to <depth> items ahead by a thread.
+
+    Reading and decompressing the next chunks of a file then overlaps with parsing the current
+    one, which both release the GIL, while the queue between them caps the memory used.
+    Errors of the reader are raised here. With a <depth> of 0 nothing is read ahead.
+    """
+    if depth < 1:
+        yield from chunks
+        return
+    import queue
+    import threading
+
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # waits for room in the queue, unless the consumer stopped early
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    break
+            else:
+                put((end, None))
+        except BaseException as e:
+            put((end, e))
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    reader = threading.Thread(target=read, name="prefetch", daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk, error = buffer.get()
+            if chunk is end:
+                if error is not None:
+                    raise error
+                return
+            yield chunk
+    finally:
+        stop.set()
+        reader.join()
+
+
+def fastq_metrics(buf, starts, ends):
+    """Return the mean quality and length of the fastq records in a batch.
+
+    Verifies that the batch consists of four-line records, raising a ValueError if not.
+    The mean quality is calculated in error probability space, as nanoget.utils.ave_qual does,
+    with NaN for reads of length zero.
+    """
+    lengths = ends[1::4] - starts[1::4]
+    if (
+        not (buf[starts[0::4]] == 64).all()
+        or not (buf[starts[2::4]] == 43).all()
+        or not np.array_equal(lengths, ends[3::4] - starts[3::4])
+    ):
+        raise ValueError("Not a four-line fastq file")
+    quals = np.full(len(lengths), np.nan)
+    short = (lengths > 0) & (lengths < SHORT_READ)
+    if short.any():
+        quals[short] = short_read_quals(buf, starts[3::4][short], ends[3::4][short])
+    long_reads = np.flatnonzero(lengths >= SHORT_READ)
+    quals[long_reads] = [
+        -10 * log(QUAL_ERRS[buf[s:e]].cumsum()[-1] / (e - s), 10)
+        for s, e in zip(starts[3::4][long_reads].tolist(), ends[3::4][long_reads].tolist())
+    ]
+    return quals, lengths.astype(np.int64)
+
+
+def short_read_quals(buf, starts, ends):
+    """Return the mean quality of short reads, given the positions of their quality lines.
+
+    For short reads the overhead of handling reads one by one dominates, so reads of similar
+    lengths are grouped and padded with zeros to a 2D array, of which the cumulative sum is
+    taken along the rows: that adds up the values one by one for every read, in the same
+    order as the builtin sum of nanoget.utils.ave_qual, such that the results are identical
+    rather than different in the last decimals.
+    """
+    lengths = ends - starts
+    # select the bytes of all quality lines, marking the start and end of every line
+    marks = np.zeros(len(buf) + 1, dtype=np.int8)
+    marks[starts] += 1
+    marks[ends] -= 1
+    errs = QUAL_ERRS[buf[np.cumsum(marks[:-1], dtype=np.int8).astype(bool)]]
+    quals = np.empty(len(lengths))
+    groups = np.floor(np.log2(lengths)).astype(np.int8)
+    for group in np.unique(groups):
+        in_group = groups == group
+        n = lengths[in_group]
+        padded = np.zeros((len(n), n.max()))
+        padded[np.arange(n.max()) < n[:, None]] = errs[np.repeat(in_group, lengths)]
+        np.cumsum(padded, axis=1, out=padded)
+        quals[in_group] = [-10 * log(s / length, 10) for s, length in zip(padded[:, -1], n)]
+    return quals
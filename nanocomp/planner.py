@@ -0,0 +1,221 @@
+"""Planning the use of memory, from the size of the input and the memory available.
+
+Before extracting data NanoComp estimates the number of reads in the input from the size of
+the files and the first part of their content, and chooses the number of workers, the size
+of the batches in which fastq files are parsed and the number of reads subsampled for plots,
+to remain within the memory budget given with --max_memory or otherwise the available memory.
+"""
+
+import bz2
+import gzip
+import logging
+import os
+import re
+from argparse import ArgumentTypeError
+
+# Estimated memory per read of the extracted data, including the copies made for plotting
+BYTES_PER_READ = {
+    "fastq": 48,
+    "fasta": 48,
+    "fastq_rich": 96,
+    "summary": 160,
+    "bam": 256,
+    "cram": 256,
+    "ubam": 96,
+    "pickle": 160,
+    "feather": 160,
+}
+# Memory used by a worker process, without the batch it is processing
+WORKER_MEMORY = 128 << 20
+# Memory used by the libraries for plotting, which are loaded after the extraction
+PLOTTING_MEMORY = 128 << 20
+# Memory used while parsing a batch, per byte of fastq in the batch
+BATCH_MEMORY = 8
+MIN_BATCH_SIZE = 1 << 20
+MAX_BATCH_SIZE = 1 << 24
+MIN_SUBSAMPLE = 1000
+MAX_SUBSAMPLE = 10000
+# Bytes of every file which are read to estimate the number of reads
+PEEK_SIZE = 1 << 22
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_memory(value):
+    """Parse a memory size such as 8G, 500M or 1000000 to a number of bytes, for argparse."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?", value.strip().upper())
+    if not match:
+        raise ArgumentTypeError(f"invalid memory size: '{value}', use e.g. 16G or 500M")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def human(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def available_memory():
+    """Return the memory available, also taking a cgroup (container) limit into account."""
+    import psutil
+
+    available = psutil.virtual_memory().available
+    try:
+        with open("/sys/fs/cgroup/memory.max") as limit, open(
+            "/sys/fs/cgroup/memory.current"
+        ) as current:
+            available = min(available, int(limit.read()) - int(current.read()))
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+def peek(path):
+    """Return the first part of the (decompressed) content of a file,
+    and the size of the file in which this content is stored."""
+    with open(path, "rb") as raw:
+        magic = raw.read(3)
+        raw.seek(0)
+        if magic[:2] == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=raw) as handle:
+                content = handle.read(PEEK_SIZE)
+            return content, raw.tell()
+        if magic == b"BZh":
+            with bz2.BZ2File(raw) as handle:
+                content = handle.read(PEEK_SIZE)
+            return content, raw.tell()
+        content = raw.read(PEEK_SIZE)
+        return content, len(content)
+
+
+def estimate_reads(source, path):
+    """Estimate the number of reads in a file."""
+    size = os.path.getsize(path)
+    if source in ["bam", "cram"]:
+        import pysam
+
+        with pysam.AlignmentFile(path) as samfile:
+            if samfile.has_index():
+                return samfile.mapped + samfile.unmapped
+    if source in ["bam", "cram", "ubam"]:
+        import pysam
+
+        with pysam.AlignmentFile(path, check_sq=False) as samfile:
+            reads = 0
+            for reads, _ in enumerate(samfile.fetch(until_eof=True), start=1):
+                if reads == 10000:
+                    break
+            stored = samfile.tell() >> 16 if source != "cram" else 0
+        return reads if not stored else int(reads * size / max(stored, 1))
+    if source in ["pickle", "feather"]:
+        return size // 16
+    content, stored = peek(path)
+    if not content:
+        return 0
+    if source in ["fastq", "fastq_rich"]:
+        reads = content.count(b"\n") / 4
+    elif source == "fasta":
+        reads = content.count(b"\n>") + content.startswith(b">")
+    else:
+        reads = content.count(b"\n") - 1
+    return int(max(reads, 1) * size / stored)
+
+
+class Plan(object):
+    """The choices made to remain within the memory budget."""
+
+    def __init__(
+        self, budget, reads, data_memory, threads, batch_size, subsample, prefetch=0, sample=None
+    ):
+        self.budget = budget
+        self.reads = reads
+        self.data_memory = data_memory
+        self.threads = threads
+        self.batch_size = batch_size
+        self.subsample = subsample
+        self.prefetch = prefetch
+        self.sample = sample
+        self.streaming = batch_size < MAX_BATCH_SIZE
+
+    def __str__(self):
+        return (
+            f"{'streaming' if self.streaming else 'in-memory'} extraction of "
+            f"~{self.reads} reads (~{human(self.data_memory)}) "
+            f"{f'sampling {self.sample} reads per file ' if self.sample else ''}"
+            f"with {self.threads} workers, batches of {human(self.batch_size)} "
+            f"read {self.prefetch} ahead "
+            f"and subsamples of {self.subsample} reads, within {human(self.budget)}"
+        )
+
+
+def make_plan(
+    source, files, threads, max_memory=None, sample=None, prefetch=0, auto_sample=False
+):
+    """Choose the number of workers, batch size and subsample size for the memory budget.
+
+    Workers parsing batches as large as possible are preferred, then the batches are made
+    smaller down to MIN_BATCH_SIZE (streaming), then fewer batches than <prefetch> (--prefetch)
+    are read ahead, then fewer workers are used.
+    With <sample> (--quick) at most that many reads are kept per file. If the data of the reads
+    doesn't fit even with a single worker, with <auto_sample> only as many reads per file are
+    sampled as fit, see Plan.sample, otherwise this is warned for.
+    """
+    import psutil
+
+    budget = max_memory or available_memory()
+    estimates = [estimate_reads(source, f) for f in files]
+    in_use = psutil.Process().memory_info().rss
+    if auto_sample:
+        room = budget - in_use - PLOTTING_MEMORY - WORKER_MEMORY - BATCH_MEMORY * MIN_BATCH_SIZE
+        fitting = int(max(room, 0) // (BYTES_PER_READ[source] * max(len(files), 1)))
+        needed = sum(min(e, sample) if sample else e for e in estimates)
+        if fitting and needed > fitting * len(files):
+            sample = min(sample or fitting, fitting)
+            logging.warning(
+                f"NanoComp: The data of ~{needed} reads doesn't fit in {human(budget)} memory, "
+                f"sampling {sample} reads per file as with --quick {sample}."
+            )
+    reads = sum(min(e, sample) if sample else e for e in estimates)
+    data_memory = reads * BYTES_PER_READ[source]
+    free = budget - in_use - PLOTTING_MEMORY - data_memory
+    workers = max(1, min(threads, len(files) if source in ["fastq", "fastq_rich"] else threads))
+    batch_size = MAX_BATCH_SIZE
+    while workers > 1 or batch_size > MIN_BATCH_SIZE or prefetch > 0:
+        if workers * (WORKER_MEMORY + (BATCH_MEMORY + prefetch) * batch_size) <= free:
+            break
+        if batch_size > MIN_BATCH_SIZE:
+            batch_size //= 2
+        elif prefetch > 0:
+            prefetch -= 1
+        else:
+            workers -= 1
+    per_dataset = free // (max(len(files), 1) * BYTES_PER_READ[source] * 10)
+    subsample = int(min(MAX_SUBSAMPLE, max(MIN_SUBSAMPLE, per_dataset)))
+    plan = Plan(budget, reads, data_memory, workers, batch_size, subsample, prefetch, sample)
+    logging.info(f"NanoComp: Planned {plan}.")
+    if workers * (WORKER_MEMORY + (BATCH_MEMORY + prefetch) * batch_size) > free:
+        logging.warning(
+            f"NanoComp: The data of ~{reads} reads likely doesn't fit in {human(budget)} memory, "
+            "even with a single worker, use --quick to sample fewer reads."
+        )
+    return plan
+
+
+def log_peak_memory(plan):
+    """Log the peak resident memory of NanoComp and of its largest worker process."""
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    scale = 1 if os.uname().sysname == "Darwin" else 1024
+    main = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    worker = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    logging.info(
+        f"NanoComp: Peak memory {human(main)}, largest worker {human(worker)}, "
+        f"budget {human(plan.budget)}."
+    )
+    if main + worker > plan.budget:
+        logging.warning(
+            "NanoComp: The peak memory may have exceeded the budget, "
+            "use --quick or fewer --threads to use less."
+        )
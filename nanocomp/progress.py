@@ -0,0 +1,104 @@
+"""Progress of a NanoComp run as a stream of JSON lines (--progress), for workflow managers.
+
+Every line is an event with its "event" type, the "time" (seconds since the epoch),
+the "elapsed" seconds since the start and the resident memory in "rss" bytes:
+- "stage_start" and "stage_end" for every stage, with its "stage" name, the "total" work
+  to do in "unit"s if known, and at the end the "seconds" the stage took.
+- "progress" when work in a stage is done, with the work "done", the "rate" in units per
+  second and the "eta" in seconds until the stage is done, and details of the work done,
+  such as the "file" and its "reads" during ingest, or the "plot" made.
+- "finish" at the end of the run, with the "error" which ended it, if any.
+
+Work is reported from the main process as it completes, such as every file or region during
+ingest and every plot. The functions do nothing unless the stream was opened with init().
+"""
+
+import json
+import os
+import time
+
+
+class Progress(object):
+    """The stream of progress events and the stage reported on."""
+
+    def __init__(self):
+        self.stream = None
+        self.start = None
+        self.stage = None
+
+    def emit(self, event, **fields):
+        import psutil
+
+        now = time.time()
+        record = dict(
+            event=event,
+            time=round(now, 3),
+            elapsed=round(now - self.start, 3),
+            rss=psutil.Process().memory_info().rss,
+            **fields,
+        )
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+
+_progress = Progress()
+
+
+def init(target):
+    """Open the stream of progress events, to a file, or to a file descriptor if a number."""
+    if target.isdigit():
+        _progress.stream = os.fdopen(int(target), "w")
+    else:
+        _progress.stream = open(target, "w")
+    _progress.start = time.time()
+
+
+def stage(name, total=None, unit=None):
+    """Start a stage, ending the previous one, of which <total> <unit>s of work is done."""
+    if _progress.stream is None:
+        return
+    end_stage()
+    _progress.stage = dict(name=name, started=time.time(), total=total, unit=unit, done=0)
+    _progress.emit("stage_start", stage=name, total=total, unit=unit)
+
+
+def end_stage():
+    current = _progress.stage
+    if _progress.stream is None or current is None:
+        return
+    seconds = round(time.time() - current["started"], 3)
+    _progress.emit("stage_end", stage=current["name"], done=round(current["done"]), seconds=seconds)
+    _progress.stage = None
+
+
+def advance(amount=1, **fields):
+    """Report <amount> units of work of the current stage done, with details in <fields>."""
+    current = _progress.stage
+    if _progress.stream is None or current is None:
+        return
+    current["done"] += amount
+    elapsed = max(time.time() - current["started"], 1e-6)
+    rate = current["done"] / elapsed
+    eta = None
+    if current["total"] and rate:
+        eta = round(max(current["total"] - current["done"], 0) / rate, 1)
+    _progress.emit(
+        "progress",
+        stage=current["name"],
+        done=round(current["done"]),
+        total=current["total"],
+        unit=current["unit"],
+        rate=round(rate, 1),
+        eta=eta,
+        **fields,
+    )
+
+
+def finish(error=None):
+    """End the last stage and close the stream, with the <error> which ended the run if any."""
+    if _progress.stream is None:
+        return
+    end_stage()
+    _progress.emit("finish", error=error)
+    _progress.stream.close()
+    _progress.stream = None
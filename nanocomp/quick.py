@@ -0,0 +1,402 @@
+"""Quick-look mode, extracting a sample of the reads of every input file rather than all reads.
+
+With --quick N, about N reads are taken from every file, in runs of consecutive records starting
+at offsets spread randomly over the file, which are found by seeking rather than by parsing the
+file from the start. Uncompressed files are sampled at byte offsets, bgzip compressed files and
+(unaligned) bam files at the first BGZF block after every offset. Files which can't be sampled by
+seeking (gzip or bz2 compressed, cram) or with fewer than N reads are extracted completely,
+after which N reads are sampled. Stored data is sampled by extraction.get_stored.
+
+The number of reads of a sampled file is estimated from the bytes taken by the sampled records,
+and used to extrapolate totals such as the number of reads and bases, see extrapolate().
+"""
+
+import concurrent.futures as cfutures
+import io
+import logging
+import os
+import struct
+import zlib
+import numpy as np
+import pandas as pd
+import pysam
+import nanoget.utils as ut
+import nanoget.extraction_functions as ex
+import nanocomp.extraction as extraction
+import nanocomp.progress as progress
+from nanocomp.extraction import (
+    BGZF_HEADER_SIZE,
+    SUMMARY_COLUMNS,
+    find_bgzf_block,
+    first_record,
+    read_bgzf_header,
+)
+
+# Number of consecutive records read at every offset
+RUN_LENGTH = 50
+# Bytes read at every offset of a text file, doubled until a complete record fits
+READ_SIZE = 1 << 20
+MAX_READ_SIZE = 1 << 26
+SEED = 0
+
+
+def get_sample(
+    source,
+    files,
+    n,
+    threads=4,
+    readtype="1D",
+    names=None,
+    keep_supp=True,
+    batch_size=1 << 24,
+    time_window=None,
+    prefetch=extraction.PREFETCH,
+):
+    """Return a DataFrame with a sample of about <n> reads of every file, as extraction.get_input,
+    and a DataFrame with the number of reads sampled and estimated in every dataset."""
+    names = names or files
+    sampled = [seekable(source, f, n) for f in files]
+    with cfutures.ProcessPoolExecutor(max_workers=max(1, min(sum(sampled), threads))) as executor:
+        tasks = [
+            executor.submit(sample_file, source, f, n, readtype, keep_supp) if s else None
+            for f, s in zip(files, sampled)
+        ]
+        results = []
+        for f, task in zip(files, tasks):
+            result = task.result() if task else None
+            if result is None:
+                logging.info(f"NanoComp: Extracting all reads of {f} to sample them.")
+                df = extract_file(source, f, readtype, keep_supp, threads, batch_size, prefetch)
+                result = df.sample(min(n, len(df)), random_state=SEED).sort_index(), len(df)
+            else:
+                logging.info(f"NanoComp: Sampled {len(result[0])} reads of ~{result[1]} in {f}.")
+            progress.advance(os.path.getsize(f), file=f, reads=len(result[0]))
+            results.append(result)
+    dfs = [df for df, _ in results]
+    if source == "ubam" and not all("timestamp" in df for df in dfs):
+        dfs = [df.drop(columns=extraction.UBAM_TAGS, errors="ignore") for df in dfs]
+    table = sample_table([len(df) for df in dfs], [total for _, total in results], names)
+    return extraction.combine(dfs, names=names, time_window=time_window), table
+
+
+def sample_table(sampled, estimated, names):
+    """Return a DataFrame with the number of reads sampled and estimated per dataset."""
+    table = pd.DataFrame(
+        {"sampled": sampled, "estimated_reads": estimated},
+        index=pd.Index(names, name="dataset"),
+    )
+    return table.groupby(level=0, sort=False).sum()
+
+
+def subsample(df, n):
+    """Return a sample of <n> reads of every dataset of data which was completely loaded,
+    with the table of the number of reads sampled and in every dataset."""
+    from nanocomp.utils import subsample_datasets
+
+    counts = df["dataset"].value_counts(sort=False)
+    table = sample_table(counts.clip(upper=n).tolist(), counts.tolist(), counts.index.tolist())
+    return subsample_datasets(df, minimal=n), table
+
+
+def seekable(source, path, n):
+    """Return if a file can be sampled by seeking, and has more than <n> reads."""
+    from nanocomp.planner import estimate_reads
+
+    if source not in ["fastq", "fastq_rich", "fasta", "summary", "bam", "ubam"]:
+        return False
+    with open(path, "rb") as handle:
+        magic = handle.read(3)
+        bgzf = read_bgzf_header(handle, 0) is not None
+    if magic.startswith(b"\x1f\x8b") and not bgzf or magic == b"BZh":
+        return False
+    return estimate_reads(source, path) > n
+
+
+def extract_file(
+    source,
+    path,
+    readtype="1D",
+    keep_supp=True,
+    threads=4,
+    batch_size=1 << 24,
+    prefetch=extraction.PREFETCH,
+):
+    """Return the DataFrame with the metrics of all reads of a file."""
+    if source == "fastq":
+        return extraction.process_fastq(path, batch_size=batch_size, prefetch=prefetch)
+    if source == "fastq_rich":
+        return extraction.process_fastq_rich(path, batch_size=batch_size, prefetch=prefetch)
+    if source in ["bam", "cram"]:
+        return extraction.process_alignments(
+            [path], threads=threads, samtype=source, keep_supp=keep_supp
+        )[0]
+    if source == "ubam":
+        return extraction.process_unaligned([path], threads=threads)[0]
+    if source == "fasta":
+        return ex.process_fasta(path)
+    return ex.process_summary(path, readtype=readtype, barcoded=False)
+
+
+def offsets(size, runs):
+    """Return <runs> offsets spread over a file, one at a random position in every 1/runs part."""
+    rng = np.random.default_rng(SEED)
+    return ((np.arange(runs) + rng.random(runs)) * size / runs).astype(np.int64)
+
+
+def sample_file(source, path, n, readtype="1D", keep_supp=True):
+    """Return a DataFrame with a sample of about <n> reads of a file, and the estimated number
+    of reads in the file, or None if the file can't be sampled by seeking.
+
+    Worker function, the number of reads is estimated from the (compressed) bytes per record.
+    """
+    runs = -(-n // RUN_LENGTH)
+    if source in ["bam", "ubam"]:
+        df, span = sample_bam(path, runs, source=source, keep_supp=keep_supp)
+    else:
+        try:
+            df, span = sample_text(path, runs, source=source, readtype=readtype)
+        except ValueError:
+            return None
+    if len(df) == 0:
+        return None
+    return df, int(os.path.getsize(path) * len(df) / max(span, 1))
+
+
+class TextFile(object):
+    """A text file, uncompressed or bgzip compressed, which can be read from any offset."""
+
+    def __init__(self, path):
+        self.size = os.path.getsize(path)
+        self.handle = open(path, "rb")
+        self.bgzf = read_bgzf_header(self.handle, 0) is not None
+
+    def close(self):
+        self.handle.close()
+
+    def read(self, offset, size):
+        """Return the data from offset, the compressed bytes per byte of data,
+        and if the data is at the start and at the end of the file.
+
+        Of bgzip compressed files the blocks from the first block after offset are read.
+        """
+        if not self.bgzf:
+            self.handle.seek(offset)
+            data = self.handle.read(size)
+            return data, 1.0, offset == 0, offset + len(data) >= self.size
+        block = find_bgzf_block(self.handle, offset, self.size)
+        chunks = []
+        coffset = block
+        while block is not None and sum(len(c) for c in chunks) < size:
+            block_size = read_bgzf_header(self.handle, coffset)
+            if block_size is None:
+                break
+            self.handle.seek(coffset)
+            chunks.append(zlib.decompress(self.handle.read(block_size)[BGZF_HEADER_SIZE:-8], -15))
+            coffset += block_size
+        data = b"".join(chunks)
+        ratio = (coffset - block) / max(len(data), 1) if block is not None else 1.0
+        return data, ratio, block == 0, block is None or coffset >= self.size
+
+
+def sample_text(path, runs, source, readtype="1D"):
+    """Return a DataFrame with the metrics of runs of records from a fastq, fasta or summary file,
+    and the number of bytes these records take in the file."""
+    parsers = {
+        "fastq": fastq_run,
+        "fastq_rich": fastq_run,
+        "fasta": fasta_run,
+        "summary": summary_run,
+    }
+    textfile = TextFile(path)
+    if source == "summary":
+        header = textfile.read(0, READ_SIZE)[0].partition(b"\n")[0] + b"\n"
+        kwargs = dict(header=header, columns=SUMMARY_COLUMNS[readtype])
+    else:
+        kwargs = dict(rich=source == "fastq_rich") if source != "fasta" else {}
+    frames = []
+    span = 0
+    position = 0
+    for offset in offsets(textfile.size, runs):
+        size = READ_SIZE
+        while True:
+            data, ratio, at_start, at_end = textfile.read(max(offset, position), size)
+            run, run_span = parsers[source](data, at_start, at_end, RUN_LENGTH, **kwargs)
+            if run is not None or at_end or size >= MAX_READ_SIZE:
+                break
+            size *= 2
+        if run is not None:
+            frames.append(run)
+            span += run_span * ratio
+            position = max(offset, position) + int(run_span * ratio)
+    textfile.close()
+    if not frames:
+        return pd.DataFrame(), 0
+    datadf = pd.concat(frames, ignore_index=True)
+    if source == "summary":
+        datadf = datadf.loc[datadf["lengths"] != 0]
+    else:
+        datadf = datadf.dropna()
+    return ut.reduce_memory_usage(datadf), span
+
+
+def lines(data, at_start, at_end):
+    """Return the start and end of the complete lines in the data, excluding line endings."""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    if at_end and len(buf) and buf[-1] != 10:
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # the first line is incomplete, unless the data starts at the start of the file
+    if not at_start:
+        starts, ends = starts[1:], ends[1:]
+    return buf, starts, ends
+
+
+def fastq_run(data, at_start, at_end, n, rich=False):
+    """Return the metrics of the first <n> complete fastq records in the data,
+    and the number of bytes they take, or None if the data has no complete record."""
+    buf, starts, ends = lines(data, at_start, at_end)
+    stripped = ends - (buf[np.maximum(ends - 1, 0)] == 13)
+    for first in range(min(4, len(starts) - 3)):
+        if (
+            buf[starts[first]] == 64
+            and buf[starts[first + 2]] == 43
+            and stripped[first + 1] - starts[first + 1] == stripped[first + 3] - starts[first + 3]
+        ):
+            break
+    else:
+        return None, 0
+    records = min(n, (len(starts) - first) // 4)
+    selected = slice(first, first + 4 * records)
+    start, end = starts[first], ends[first + 4 * records - 1] + 1
+    batch = buf[start:end]
+    quals, lengths = extraction.fastq_metrics(
+        batch, starts[selected] - start, stripped[selected] - start
+    )
+    columns = dict(quals=quals, lengths=lengths)
+    if rich:
+        columns.update(
+            extraction.rich_fields(
+                batch, starts[selected][0::4] - start, stripped[selected][0::4] - start
+            )
+        )
+    return pd.DataFrame(columns), end - start
+
+
+def fasta_run(data, at_start, at_end, n):
+    """Return the lengths of the first <n> complete fasta records in the data,
+    and the number of bytes they take, or None if the data has no complete record."""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    headers = np.flatnonzero(buf == 62)
+    headers = headers[(headers > 0) & (buf[np.maximum(headers - 1, 0)] == 10) | (headers == 0)]
+    if not at_start:
+        headers = headers[headers > 0]
+    # a record is complete if another record follows, or the data ends at the end of the file
+    bounds = np.append(headers, len(buf)) if at_end else headers
+    if len(bounds) < 2:
+        return None, 0
+    bounds = bounds[: n + 1]
+    newlines = np.append(np.flatnonzero(buf == 10), len(buf))
+    sequence_starts = newlines[np.searchsorted(newlines, bounds[:-1])] + 1
+    whitespace = np.concatenate(([0], np.cumsum((buf == 10) | (buf == 13))))
+    lengths = (bounds[1:] - sequence_starts) - (
+        whitespace[bounds[1:]] - whitespace[np.minimum(sequence_starts, len(buf))]
+    )
+    return pd.DataFrame({"lengths": np.maximum(lengths, 0)}), bounds[-1] - bounds[0]
+
+
+def summary_run(data, at_start, at_end, n, header, columns):
+    """Return the metrics of the first <n> complete lines of a summary file in the data,
+    and the number of bytes they take, or None if the data has no complete line."""
+    buf, starts, ends = lines(data, at_start, at_end)
+    if at_start:
+        starts, ends = starts[1:], ends[1:]
+    if len(starts) == 0:
+        return None, 0
+    starts, ends = starts[:n], ends[:n]
+    text = header + data[starts[0] : ends[-1]] + b"\n"
+    df = pd.read_csv(io.BytesIO(text), sep="\t", usecols=list(columns)).rename(columns=columns)
+    return df[list(columns.values())], ends[-1] + 1 - starts[0]
+
+
+def sample_bam(path, runs, source="bam", keep_supp=True):
+    """Return a DataFrame with the metrics of runs of records from a (unaligned) bam file,
+    and the number of compressed bytes these records take in the file.
+
+    Every run starts at the first record in the first BGZF block after an offset.
+    """
+    samfile = pysam.AlignmentFile(path, "rb", check_sq=False)
+    header_end = samfile.tell()
+    size = os.path.getsize(path)
+    res = []
+    span = 0
+    position = header_end
+    with open(path, "rb") as handle:
+        for offset in offsets(size, runs):
+            block = find_bgzf_block(handle, max(offset, position >> 16), size)
+            if block is None:
+                continue
+            if block <= header_end >> 16:
+                start = header_end
+            else:
+                start = first_record(handle, block, samfile.nreferences)
+            if start is None or start < position:
+                continue
+            samfile.seek(start)
+            for _ in range(RUN_LENGTH):
+                try:
+                    read = next(samfile)
+                except StopIteration:
+                    break
+                if source == "ubam":
+                    res.append(extraction.unaligned_metrics(read))
+                elif extraction.is_primary(read, keep_supp):
+                    res.append(extraction.alignment_metrics(read))
+            position = samfile.tell()
+            span += compressed_offset(handle, position) - compressed_offset(handle, start)
+    samfile.close()
+    if source == "ubam":
+        return extraction.unaligned_frame([extraction.unaligned_columns(res)]), span
+    return extraction.alignment_frame([extraction.alignment_columns(res)]), span
+
+
+def compressed_offset(handle, virtual_offset):
+    """Return the offset in the compressed file of a BGZF virtual offset,
+    interpolated within its block with the compression ratio of the block."""
+    block, within = virtual_offset >> 16, virtual_offset & 0xFFFF
+    block_size = read_bgzf_header(handle, block)
+    if not within or block_size is None:
+        return block
+    handle.seek(block + block_size - 4)
+    (uncompressed,) = struct.unpack("<I", handle.read(4))
+    return block + within * block_size / max(uncompressed, 1)
+
+
+def factors(table):
+    """Return the factor by which totals of every dataset are extrapolated."""
+    return (table["estimated_reads"] / table["sampled"].replace(0, 1)).to_dict()
+
+
+def extrapolate(stats, factor):
+    """Extrapolate the totals of the nanomath Stats of a sampled dataset with a factor."""
+    stats.number_of_reads = int(round(stats.number_of_reads * factor))
+    stats.number_of_bases = stats.number_of_bases * factor
+    if hasattr(stats, "number_of_bases_aligned"):
+        stats.number_of_bases_aligned = stats.number_of_bases_aligned * factor
+    if hasattr(stats, "_reads_above_qual"):
+        stats._reads_above_qual = [
+            (int(round(number * factor)), megabases * factor)
+            for number, megabases in stats._reads_above_qual
+        ]
+    return stats
+
+
+def report_note(table):
+    """Return the html explaining which values of the report are estimates."""
+    return (
+        "<p>Quick-look mode (--quick): all values are estimated from the sampled reads. "
+        "The number of reads and bases, the reads above quality cutoffs, the number of reads "
+        "and throughput barplots and the cumulative yield are extrapolated to the estimated "
+        "number of reads of every dataset. Active channels and pores are counted in the "
+        "sampled reads only.</p>" + table.to_html()
+    )
@@ -0,0 +1,119 @@
+"""Exporting the plots as static images, with a single session of the image renderer."""
+
+import json
+import logging
+import os
+from time import perf_counter
+
+import nanocomp.progress as progress
+
+
+def image_formats(settings):
+    """Return the requested static formats which need the renderer.
+
+    The json format is written together with the html file of a plot.
+    """
+    if settings["no_static"]:
+        return []
+    return [f for f in settings["format"] if f.lower() != "json"]
+
+
+def export_images(images, settings, default_inches=(6.4, 4.8)):
+    """Export static images of plots, for a list of (plot, formats) tuples.
+
+    The renderer is started once, after which every figure is sent to it with all its formats.
+    The time taken for every figure is logged. If exporting a figure fails, its images are
+    removed and the plot is only available as html, while the other plots are still exported.
+    Returns the list of plots for which all images were saved.
+    """
+    images = [(plot, formats) for plot, formats in images if formats]
+    if not images:
+        return []
+    try:
+        import kaleido
+
+        # kaleido >= 1 renders in a browser session, older versions start a process of their own
+        session = hasattr(kaleido, "start_sync_server")
+        if session:
+            import plotly.io as pio
+
+            if hasattr(pio, "get_chrome"):
+                pio.get_chrome()
+            kaleido.start_sync_server(silence_warnings=True)
+    except Exception as e:
+        logging.warning("NanoComp: No static plots are saved, the image renderer failed to start:")
+        logging.warning(e)
+        return []
+
+    dpi = int(settings.get("dpi", 300))
+    width, height = int(default_inches[0] * dpi), int(default_inches[1] * dpi)
+    logging.info(f"NanoComp: Saving static images of {len(images)} plots.")
+    start = perf_counter()
+    saved = []
+    progress.stage("images", total=len(images), unit="plots")
+    try:
+        for plot, formats in images:
+            paths = [plot.path.replace(".html", f".{figformat}") for figformat in formats]
+            remove(paths)
+            figure_start = perf_counter()
+            try:
+                write_images(json.loads(plot.json), paths, width, height)
+                for path in paths:
+                    set_dpi(path, dpi)
+            except Exception as e:
+                remove(paths)
+                logging.warning(f"NanoComp: Failed to save static images of {plot.path}:")
+                logging.warning(e)
+                progress.advance(plot=plot.title, saved=False)
+                continue
+            logging.info(
+                f"NanoComp: Saved {plot.title} as {', '.join(formats)} "
+                f"in {perf_counter() - figure_start:.2f}s."
+            )
+            saved.append(plot)
+            progress.advance(plot=plot.title, saved=True)
+    finally:
+        if session:
+            kaleido.stop_sync_server(silence_warnings=True)
+    logging.info(
+        f"NanoComp: Saved static images of {len(saved)}/{len(images)} plots "
+        f"in {perf_counter() - start:.2f}s."
+    )
+    return saved
+
+
+def write_images(figure, paths, width, height):
+    """Write a figure to all <paths>, at once with plotly >= 6.1, otherwise one by one."""
+    import plotly.io as pio
+
+    if hasattr(pio, "write_images"):
+        pio.write_images(
+            fig=[figure] * len(paths),
+            file=paths,
+            width=width,
+            height=height,
+            scale=1,
+            validate=False,
+        )
+    else:
+        for path in paths:
+            pio.write_image(figure, path, width=width, height=height, scale=1, validate=False)
+
+
+def set_dpi(path, dpi):
+    """Set the resolution in the metadata of raster images."""
+    if path.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
+        try:
+            from PIL import Image
+
+            with Image.open(path) as image:
+                image.load()
+            image.save(path, dpi=(dpi, dpi))
+        except Exception as e:
+            logging.warning(f"NanoComp: Could not set DPI metadata for {path}: {e}")
+
+
+def remove(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
@@ -3,9 +3,61 @@ import sys
 import os
 import textwrap as _textwrap
 from .version import __version__
+from .planner import parse_memory
 from argparse import ArgumentParser, FileType, HelpFormatter
 
 
+# The plots NanoComp can make, with the columns required to make them,
+# or the extra data required, collected during extraction (see extraction.get_input)
+PLOTS = {
+    "number_of_reads": ("lengths",),
+    "total_throughput": ("lengths",),
+    "N50": ("lengths",),
+    "lengths": ("lengths",),
+    "log_length": ("lengths",),
+    "quals": ("quals",),
+    "sequencing_speed": ("start_time", "duration"),
+    "identity": ("percentIdentity",),
+    "identity_histogram": ("percentIdentity",),
+    "phred_histogram": ("percentIdentity",),
+    "cumulative_yield": ("start_time",),
+    "active_pores": ("start_time", "channelIDs"),
+    "histogram": ("lengths",),
+    "histogram_normalized": ("lengths",),
+    "histogram_weighted": ("lengths",),
+    "log_histogram": ("lengths",),
+    "log_histogram_normalized": ("lengths",),
+    "log_histogram_weighted": ("lengths",),
+    "end_reasons": ("end_reasons",),
+    "end_reasons_relative": ("end_reasons",),
+    "mux_scan": ("mux_scan",),
+}
+
+# The pages of the report with --paginate, with their title and plots
+REPORT_PAGES = {
+    "yield": ("Yield", ["number_of_reads", "total_throughput", "N50", "cumulative_yield"]),
+    "lengths": (
+        "Read lengths",
+        [
+            "lengths",
+            "log_length",
+            "histogram",
+            "histogram_normalized",
+            "histogram_weighted",
+            "log_histogram",
+            "log_histogram_normalized",
+            "log_histogram_weighted",
+        ],
+    ),
+    "quality": (
+        "Quality and identity",
+        ["quals", "identity", "identity_histogram", "phred_histogram"],
+    ),
+    "time": ("Over time", ["sequencing_speed", "active_pores"]),
+    "pores": ("End reasons and pores", ["end_reasons", "end_reasons_relative", "mux_scan"]),
+}
+
+
 def make_output_dir(path):
     try:
         if not os.path.exists(path):
@@ -50,6 +102,22 @@ def init_logs(args, tool="NanoComp"):
     return logname
 
 
+def subsample_datasets(df, minimal=10000):
+    """Return a subsample of at most <minimal> reads of each dataset.
+
+    The sampling is seeded, so that the same data always results in the same subsample.
+    """
+    import pandas as pd
+
+    return pd.concat(
+        [
+            dataset if len(dataset) <= minimal else dataset.sample(minimal, random_state=0)
+            for _, dataset in df.groupby("dataset", sort=False, observed=True)
+        ],
+        ignore_index=True,
+    )
+
+
 def validate_split_runs_file(split_runs_file):
     """Check if structure of file is as expected and return dictionary linking names to run_IDs."""
     try:
@@ -64,12 +132,6 @@ def validate_split_runs_file(split_runs_file):
         logging.error("ERROR: Format of --split_runs tab separated file not as expected")
 
 
-def change_identifiers(datadf, split_dict):
-    """Change the dataset identifiers based on the names in the dictionary."""
-    for rid, name in split_dict.items():
-        datadf.loc[datadf["runIDs"] == rid, "dataset"] = name
-
-
 class CustomHelpFormatter(HelpFormatter):
     def _format_action_invocation(self, action):
         if not action.option_strings or action.nargs == 0:
@@ -138,11 +200,71 @@ def get_args():
         help="Store the extracted data in tab separated file.",
         action="store_true",
     )
+    general.add_argument(
+        "--mux_scan",
+        "--mux-scan",
+        help="(Compressed) mux_scan_data csv files of the datasets, in the same order as the "
+        "input files, to compare the pore states.",
+        nargs="+",
+        metavar="file",
+    )
+    general.add_argument(
+        "--time_table",
+        "--time-table",
+        help="Store the number of reads, cumulative yield, median speed and active pores "
+        "per dataset and 10 minute interval in a table.",
+        action="store_true",
+    )
+    general.add_argument(
+        "--raw_format",
+        help="Format of the files written with --raw and --time_table: "
+        "gzip compressed 'tsv' (default) or zstd compressed 'parquet'",
+        default="tsv",
+        choices=["tsv", "parquet"],
+    )
     general.add_argument(
         "--store",
         help="Store the extracted data in a pickle file for future plotting.",
         action="store_true",
     )
+    general.add_argument(
+        "--max_memory",
+        "--max-memory",
+        help="Memory NanoComp can use, e.g. 16G or 500M, by default the memory available. "
+        "The number of workers, batch size, batches read ahead and subsample size are "
+        "lowered to fit. If the reads don't fit even so, only as many reads of every file as "
+        "fit are sampled, as with --quick, or with --barcoded or --split_runs, a warning is "
+        "logged.",
+        type=parse_memory,
+        metavar="SIZE",
+    )
+    general.add_argument(
+        "--prefetch",
+        help="Number of batches of every fastq file read ahead while parsing, "
+        "to overlap reading with parsing, 0 to not read ahead.",
+        type=int,
+        default=2,
+        metavar="N",
+    )
+    general.add_argument(
+        "--quick",
+        help="Quick look: only extract about N reads of every file, sampled at random offsets. "
+        "Statistics are estimated from the sample, totals extrapolated.",
+        type=int,
+        metavar="N",
+    )
+    general.add_argument(
+        "--cache",
+        help="Directory to store plots in, and to reuse plots from "
+        "when they were made earlier from the same data with the same settings.",
+        metavar="DIR",
+    )
+    general.add_argument(
+        "--progress",
+        help="Write progress events with throughput and estimated time remaining per stage "
+        "as JSON lines to this file, or to this file descriptor if a number.",
+        metavar="TARGET",
+    )
     general.add_argument(
         "--tsv_stats",
         help="Output the stats file as a properly formatted TSV.",
@@ -176,6 +298,15 @@ def get_args():
         type=int,
         metavar="N",
     )
+    filtering.add_argument(
+        "--time_window",
+        "--time-window",
+        help="Only use the reads started between START and END hours after the start of "
+        "every dataset, to compare runs over the same hours.",
+        nargs=2,
+        type=float,
+        metavar=("START", "END"),
+    )
     filtering.add_argument(
         "--barcoded",
         help="Barcoded experiment in summary format, splitting per barcode.",
@@ -184,7 +315,8 @@ def get_args():
     filtering.add_argument(
         "--split_runs",
         help="File: Split the summary on run IDs and use names in tsv file. "
-        "Mandatory header fields are 'NAME' and 'RUN_ID'.",
+        "Mandatory header fields are 'NAME' and 'RUN_ID'. "
+        "Reads of other run IDs keep the name of their file, and are reported.",
         default=False,
         type=FileType("r"),
         metavar="TSV_FILE",
@@ -226,6 +358,28 @@ def get_args():
         type=str,
         default=None,
     )
+    visual.add_argument(
+        "--plots",
+        help="Only make the plots with these names, from: " + ", ".join(PLOTS),
+        nargs="+",
+        choices=PLOTS,
+        default=list(PLOTS),
+        metavar="name",
+    )
+    visual.add_argument(
+        "--exclude_plots",
+        help="Do not make the plots with these names, see --plots",
+        nargs="+",
+        choices=PLOTS,
+        default=[],
+        metavar="name",
+    )
+    visual.add_argument(
+        "--paginate",
+        help="Write the report as an index page with the statistics and a page per group "
+        "of plots, which is done anyway if the plots are too large for one page.",
+        action="store_true",
+    )
     visual.add_argument(
         "--dpi",
         help="Set the dpi for saving images (deprecated)",
@@ -307,6 +461,21 @@ def get_args():
     if args.colors:
         if not len(args.colors) == [len(i) for i in sources if i][0]:
             sys.exit("ERROR: Number of colors (-c) should be same as number of files specified!")
+    if args.mux_scan:
+        if not len(args.mux_scan) == [len(i) for i in sources if i][0]:
+            sys.exit("ERROR: Number of --mux_scan files should be same as number of files!")
+    if args.time_window and not 0 <= args.time_window[0] < args.time_window[1]:
+        sys.exit("ERROR: --time_window requires 0 <= START < END.")
+    if args.prefetch < 0:
+        sys.exit("ERROR: --prefetch can't be negative.")
+    if args.quick is not None:
+        if args.quick < 1:
+            sys.exit("ERROR: --quick requires a positive number of reads.")
+        if args.barcoded or args.split_runs:
+            sys.exit("ERROR: --quick can't be combined with --barcoded or --split_runs.")
+    args.plots = [p for p in PLOTS if p in args.plots and p not in args.exclude_plots]
+    if not args.plots and args.plot != "false":
+        sys.stderr.write("\nWarning: all plots are excluded with --plots/--exclude_plots.\n\n")
     settings = vars(args)
     settings["path"] = os.path.join(args.outdir, args.prefix)
     return settings, args
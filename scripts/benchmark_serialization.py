@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+import plotly.io as pio
+from argparse import ArgumentParser
+from time import perf_counter
+import nanocomp.compplots as compplots
+
+
+def main():
+    args = get_args()
+    df = simulate(args.reads, args.datasets)
+    colorway = pio.templates["plotly"].layout.colorway
+    palette = {d: c for d, c in zip(df["dataset"].unique(), colorway)}
+    aggregator = compplots.aggregator_of(df)
+    figures = {
+        "violin": go.Figure(
+            [go.Violin(y=df.loc[df["dataset"] == d, "lengths"], name=d) for d in palette]
+        ),
+        "histogram": compplots.plot_overlay_histogram(aggregator, palette, "lengths", "Histogram"),
+        "log histogram": compplots.plot_log_histogram(aggregator, palette, "Log histogram"),
+        "weighted histogram": compplots.plot_overlay_histogram(
+            aggregator, palette, "lengths", "Weighted", weights_column="lengths"
+        ),
+    }
+    print("figure\tbefore (s)\tafter (s)\tsaved (s)")
+    for name, fig in figures.items():
+        before = timeit(lambda: serialize_before(fig), args.repeat)
+        after = timeit(lambda: serialize_after(fig), args.repeat)
+        print(f"{name}\t{before:.3f}\t{after:.3f}\t{before - after:.3f}")
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Time serializing figures for the report, html and json output, "
+        "comparing serializing once with serializing for every output separately."
+    )
+    parser.add_argument("-r", "--reads", help="reads per dataset", type=int, default=100000)
+    parser.add_argument("-d", "--datasets", help="number of datasets", type=int, default=4)
+    parser.add_argument("--repeat", help="number of repetitions", type=int, default=3)
+    return parser.parse_args()
+
+
+def simulate(reads, datasets):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "dataset": np.repeat([f"dataset{i}" for i in range(datasets)], reads),
+            "lengths": rng.lognormal(9, 1, reads * datasets).astype(int) + 1,
+        }
+    )
+
+
+def serialize_before(fig):
+    """Serializing as done before: html for the report and html file, and json output."""
+    fig.to_html(full_html=False, include_plotlyjs="cdn")
+    pio.to_json(fig)
+
+
+def serialize_after(fig):
+    """Serializing once, reusing the JSON for the html and json output."""
+    fig_json = fig.to_json()
+    compplots.html_from_json(fig_json, height=fig.layout.height)
+
+
+def timeit(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import gzip
+import os
+import shutil
+import tempfile
+import uuid
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import nanoget.extraction_functions as ex
+import nanocomp.extraction as extraction
+
+CHUNK = 1000000
+
+
+def main():
+    args = get_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="nanocomp_summary_")
+    os.makedirs(workdir, exist_ok=True)
+    paths = [simulate(os.path.join(workdir, "sequencing_summary.txt"), args.gigabytes)]
+    if args.gzip:
+        paths.append(compress(paths[0]))
+    print("file\tsize (GB)\treader\tthreads\ttime (s)\tthroughput (MB/s)\tidentical")
+    for path in paths:
+        size = os.path.getsize(path)
+        name = os.path.basename(path)
+        start = perf_counter()
+        expected = ex.process_summary(path, readtype="1D", barcoded=False)
+        seconds = perf_counter() - start
+        print(f"{name}\t{size / 1e9:.2f}\tpandas\t1\t{seconds:.1f}\t{size / 1e6 / seconds:.0f}\t")
+        for threads in args.threads:
+            import pyarrow as pa
+
+            pa.set_cpu_count(threads)
+            start = perf_counter()
+            datadf, _ = extraction.process_summary(path, readtype="1D")
+            seconds = perf_counter() - start
+            print(
+                f"{name}\t{size / 1e9:.2f}\tpyarrow\t{threads}\t{seconds:.1f}"
+                f"\t{size / 1e6 / seconds:.0f}\t{datadf.equals(expected)}"
+            )
+            del datadf
+        del expected
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Time reading a sequencing summary file, comparing the pandas reader used "
+        "by nanoget with the multithreaded pyarrow reader of NanoComp."
+    )
+    parser.add_argument("-g", "--gigabytes", help="size of the summary", type=float, default=2)
+    parser.add_argument(
+        "-t", "--threads", help="threads for pyarrow", type=int, nargs="+", default=[1, 4, 8]
+    )
+    parser.add_argument("--gzip", help="also time a gzip compressed copy", action="store_true")
+    parser.add_argument("--workdir", help="keep the summary files in this directory")
+    return parser.parse_args()
+
+
+def simulate(path, gigabytes):
+    """Write a summary file of about <gigabytes> in the layout of a dorado summary."""
+    if os.path.exists(path) and os.path.getsize(path) >= gigabytes * 1e9:
+        return path
+    rng = np.random.default_rng(0)
+    header = True
+    with open(path, "w") as summary:
+        while summary.tell() < gigabytes * 1e9:
+            lengths = rng.lognormal(8, 1, CHUNK).astype(int)
+            pd.DataFrame(
+                {
+                    "filename": "PAW00000_pass_0.pod5",
+                    "read_id": [str(uuid.UUID(int=int(i))) for i in rng.integers(0, 2**62, CHUNK)],
+                    "run_id": rng.choice(["run0", "run1"], CHUNK),
+                    "channel": rng.integers(1, 3000, CHUNK),
+                    "mux": rng.integers(1, 5, CHUNK),
+                    "start_time": np.sort(rng.uniform(0, 259200, CHUNK)).round(4),
+                    "duration": (lengths / 400).round(4),
+                    "passes_filtering": rng.random(CHUNK) < 0.9,
+                    "sequence_length_template": lengths,
+                    "mean_qscore_template": rng.uniform(5, 25, CHUNK).round(6),
+                    "end_reason": rng.choice(["signal_positive", "unblock_mux_change"], CHUNK),
+                }
+            ).to_csv(summary, sep="\t", index=False, header=header)
+            header = False
+    return path
+
+
+def compress(path):
+    if not os.path.exists(path + ".gz"):
+        with open(path, "rb") as summary, gzip.open(path + ".gz", "wb", compresslevel=1) as gz:
+            shutil.copyfileobj(summary, gz)
+    return path + ".gz"
+
+
+if __name__ == "__main__":
+    main()
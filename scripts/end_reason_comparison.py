@@ -1,16 +1,13 @@
-import pandas as pd
 import plotly.graph_objs as go
 import plotly
 from argparse import ArgumentParser
+from nanocomp.extraction import count_end_reasons, end_reasons
 
 
 def main():
     args = get_args()
 
-    df = pd.concat([pd.read_csv(f, sep="\t")["end_reason"].value_counts()
-                    for f in args.summaries],
-                   axis='columns')
-    df.columns = args.names
+    df = end_reasons([count_end_reasons(f) for f in args.summaries], names=args.names)
     with open("End_reason_comparison.html", 'w') as output:
         output.write(plot(trace=[go.Bar(name=t, x=args.names, y=df.loc[t])
                                  for t in df.index],
@@ -1,46 +1,46 @@
-import nanoget
+import pandas as pd
 from argparse import ArgumentParser
-from nanoplotter.timeplots import check_valid_time_and_sort
 
 
 def main():
     args = get_args()
 
-    dfs = check_valid_time_and_sort(
-        nanoget.get_input(
-            source="summary",
-            files=args.summaries,
-            threads=8,
-            readtype="1D",
-            names=None,
-            barcoded=False,
-            combine="track"),
-        timescol="start_time"
-    ).set_index("start_time")
-
-    cumsums = [get_cumsum(dfs, dataset) for dataset in dfs["dataset"].unique()]
+    table = read_table(args.table)
     print(
-        cumsums[0].join(cumsums[1:], how="outer").to_csv(sep="\t", na_rep='NaN')
+        table.pivot(index="hours", columns="dataset", values="cumulative_yield")
+        .reindex(columns=table["dataset"].unique())
+        .to_csv(sep="\t", na_rep="NaN")
     )
 
 
-def get_cumsum(df, dataset):
-    return df.loc[df["dataset"] == dataset, "lengths"] \
-        .cumsum() \
-        .resample('10T')\
-        .max() \
-        .divide(1e9) \
-        .to_frame() \
-        .rename(columns={"lengths": dataset})
+def read_table(path):
+    """Read the time table of NanoComp --time_table,
+    or calculate it from the data stored by NanoComp with --store or --raw."""
+    if path.endswith(".pickle"):
+        data = pd.read_pickle(path)
+    elif path.endswith(".parquet"):
+        data = pd.read_parquet(path)
+    else:
+        data = pd.read_csv(path, sep="\t", float_precision="round_trip")
+    if "cumulative_yield" in data:
+        return data
+    from nanocomp.aggregate import Aggregator, time_table
+
+    if not pd.api.types.is_timedelta64_dtype(data["start_time"]):
+        data["start_time"] = pd.to_timedelta(data["start_time"])
+    with Aggregator(data, threads=1) as aggregator:
+        return time_table(aggregator)
 
 
 def get_args():
     parser = ArgumentParser(description="Extract cumulative yield information to table.")
-    parser.add_argument("summaries",
-                        help="(compressed) summary files generated by albacore or guppy.",
-                        nargs='+')
+    parser.add_argument(
+        "table",
+        help="NanoComp-time.tsv or .parquet written by NanoComp with --time_table, "
+        "or NanoComp-data.pickle, .tsv.gz or .parquet written with --store or --raw.",
+    )
     return parser.parse_args()
 
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     main()
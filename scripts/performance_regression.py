@@ -0,0 +1,388 @@
+"""End-to-end performance regression check of NanoComp.
+
+NanoComp is run on fixed synthetic inputs of every source, recording the wall time and the
+peak memory (RSS) of the run including its worker processes. The statistics in NanoStats.txt
+and the data of every figure are checked against golden files, so a speed optimization can be
+checked for identical numbers, and its time and memory compared with a stored baseline.
+
+    python scripts/performance_regression.py                  # check golden files and baseline
+    python scripts/performance_regression.py --save_baseline  # store time and memory as baseline
+    python scripts/performance_regression.py --update_golden  # after an intended output change
+
+The golden files only hold for the default --reads and --seed, and are stored next to this
+script. The baseline is machine specific and is not part of the repository.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from array import array
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+GOLDEN = os.path.join(HERE, "golden")
+SOURCES = [
+    "summary",
+    "fastq",
+    "fastq_rich",
+    "fasta",
+    "bam",
+    "ubam",
+    "ubam_long",
+    "feather",
+    "pickle",
+]
+# Inputs of long reads (200-400kb) spanning many BGZF blocks, with their source, of which
+# one in LONG_FRACTION reads is simulated
+LONG_SOURCES = {"ubam_long": "ubam"}
+LONG_FRACTION = 50
+NAMES = ["A", "B"]
+READS = 2000
+SEED = 0
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def main():
+    args = get_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="nanocomp_regression_")
+    os.makedirs(workdir, exist_ok=True)
+    inputs = make_inputs(workdir, args.sources, args.reads, args.seed)
+    baseline = read_json(args.baseline) or {}
+    golden_applies = args.reads == READS and args.seed == SEED
+    measured = {}
+    failed = False
+    print("source\twall (s)\tbaseline (s)\tpeak RSS (MB)\tbaseline (MB)\toutput")
+    for source in args.sources:
+        outdir = os.path.join(workdir, f"out_{source}")
+        runs = [run(source, inputs[source], outdir, args.threads) for _ in range(args.repeat)]
+        wall = min(r[0] for r in runs)
+        rss = max(r[1] for r in runs)
+        measured[source] = {"wall": wall, "peak_rss": rss}
+        output = collect(outdir)
+        golden_path = os.path.join(GOLDEN, f"{source}.json")
+        if args.update_golden:
+            write_json(golden_path, output)
+            verdict = "updated"
+        elif not golden_applies:
+            verdict = "not checked"
+        else:
+            differences = compare(read_json(golden_path), output)
+            verdict = "identical" if not differences else "DIFFERENT"
+            for difference in differences:
+                print(f"  {source}: {difference}", file=sys.stderr)
+        old = baseline.get(source, {})
+        for key, value in measured[source].items():
+            if key in old and value > old[key] * (1 + args.threshold):
+                verdict += f", {key.upper()} REGRESSED"
+        failed |= "DIFFERENT" in verdict or "REGRESSED" in verdict
+        print(
+            f"{source}\t{wall:.2f}\t{fmt(old.get('wall'), 1)}\t{rss / 1e6:.0f}"
+            f"\t{fmt(old.get('peak_rss'), 1e6)}\t{verdict}"
+        )
+    if args.save_baseline:
+        write_json(args.baseline, {**baseline, **measured})
+    if not args.workdir:
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Run NanoComp on synthetic inputs of every source, check the statistics "
+        "and figure data against golden files and the time and memory against a baseline."
+    )
+    parser.add_argument(
+        "-s", "--sources", help="sources to run", nargs="+", choices=SOURCES, default=SOURCES
+    )
+    parser.add_argument("-r", "--reads", help="reads per dataset", type=int, default=READS)
+    parser.add_argument("--seed", help="seed of the synthetic inputs", type=int, default=SEED)
+    parser.add_argument("-t", "--threads", help="threads for NanoComp", type=int, default=4)
+    parser.add_argument("--repeat", help="runs per source, timing the fastest", type=int, default=1)
+    parser.add_argument(
+        "--threshold",
+        help="fraction by which the time or memory may exceed the baseline",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--baseline", help="json file with the baseline", default="nanocomp_baseline.json"
+    )
+    parser.add_argument("--save_baseline", help="store the measurements", action="store_true")
+    parser.add_argument("--update_golden", help="overwrite the golden files", action="store_true")
+    parser.add_argument("--workdir", help="keep the inputs and outputs in this directory")
+    return parser.parse_args()
+
+
+def make_inputs(workdir, sources, reads, seed):
+    """Write the synthetic inputs, two datasets per source, and return their paths per source."""
+    inputs = {}
+    for source in sources:
+        paths = []
+        for i, name in enumerate(NAMES):
+            rng = np.random.default_rng([seed, i])
+            if source in LONG_SOURCES:
+                reads_df = simulate(reads // LONG_FRACTION, rng, run=f"run{i}", long=True)
+            else:
+                reads_df = simulate(reads, rng, run=f"run{i}")
+            path = os.path.join(workdir, f"{name}_{source}{SUFFIXES[source]}")
+            WRITERS[source](reads_df, path)
+            paths.append(path)
+        inputs[source] = paths
+    return inputs
+
+
+def simulate(reads, rng, run, long=False):
+    """Return a DataFrame of reads with a sequence, qualities and the details of a summary."""
+    if long:
+        lengths = rng.integers(200000, 400000, reads)
+    else:
+        lengths = rng.lognormal(7.5, 0.8, reads).astype(int) + 50
+    qualities = [rng.integers(2, 40, n, dtype=np.uint8) for n in lengths]
+    return pd.DataFrame(
+        {
+            "read_id": [f"{run}_read{i}" for i in range(reads)],
+            "run_id": run,
+            "channel": rng.integers(1, 513, reads),
+            "start_time": np.sort(rng.uniform(0, 36000, reads)),
+            "duration": lengths / rng.normal(400, 30, reads),
+            "length": lengths,
+            "sequence": [BASES[rng.integers(0, 4, n)].tobytes().decode() for n in lengths],
+            "qualities": qualities,
+            "mean_qscore": [-10 * np.log10(np.mean(10 ** (-q / 10))) for q in qualities],
+            "identity": rng.uniform(85, 100, reads),
+        }
+    )
+
+
+def write_summary(df, path):
+    df.rename(
+        columns={"length": "sequence_length_template", "mean_qscore": "mean_qscore_template"}
+    ).assign(end_reason="signal_positive")[
+        [
+            "read_id",
+            "run_id",
+            "channel",
+            "start_time",
+            "duration",
+            "sequence_length_template",
+            "mean_qscore_template",
+            "end_reason",
+        ]
+    ].to_csv(path, sep="\t", index=False)
+
+
+def write_fastq(df, path, rich=False):
+    start = pd.Timestamp("2024-01-01T00:00:00Z")
+    with open(path, "w") as fastq:
+        for read in df.itertuples():
+            header = read.read_id
+            if rich:
+                time = start + pd.Timedelta(seconds=read.start_time)
+                time = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                header += f" runid={read.run_id} ch={read.channel} start_time={time}"
+            quals = (read.qualities + 33).tobytes().decode()
+            fastq.write(f"@{header}\n{read.sequence}\n+\n{quals}\n")
+
+
+def write_fasta(df, path):
+    with open(path, "w") as fasta:
+        for read in df.itertuples():
+            fasta.write(f">{read.read_id}\n{read.sequence}\n")
+
+
+def write_bam(df, path, aligned=True):
+    """Write an aligned, sorted and indexed bam file, or an unaligned one."""
+    import pysam
+
+    if aligned:
+        header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 10**7}]}
+    else:
+        header = {"HD": {"VN": "1.6", "SO": "unknown"}, "RG": [{"ID": df["run_id"].iloc[0]}]}
+    starts = np.linspace(0, 10**7 - 10**5, len(df)).astype(int)
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for read, start in zip(df.itertuples(), starts):
+            segment = pysam.AlignedSegment(bam.header)
+            segment.query_name = read.read_id
+            segment.query_sequence = read.sequence
+            segment.query_qualities = array("B", read.qualities.tobytes())
+            if aligned:
+                clip = min(20, read.length // 4)
+                segment.reference_id = 0
+                segment.reference_start = start
+                segment.mapping_quality = 60
+                segment.cigartuples = [(4, clip), (0, read.length - 2 * clip), (4, clip)]
+                segment.set_tag("NM", int((read.length - 2 * clip) * (100 - read.identity) / 100))
+            else:
+                segment.flag = 4
+                segment.set_tag("RG", read.run_id)
+                segment.set_tag("ch", int(read.channel), "i")
+            bam.write(segment)
+    if aligned:
+        pysam.index(path)
+
+
+def stored(df):
+    return pd.DataFrame(
+        {
+            "readIDs": df["read_id"],
+            "lengths": df["length"],
+            "quals": df["mean_qscore"],
+            "channelIDs": df["channel"],
+            "start_time": pd.to_timedelta(df["start_time"], unit="s"),
+            "duration": df["duration"],
+        }
+    )
+
+
+def write_feather(df, path):
+    stored(df).to_feather(path)
+
+
+def write_pickle(df, path):
+    stored(df).assign(dataset=df["run_id"]).to_pickle(path)
+
+
+SUFFIXES = {
+    "summary": ".txt",
+    "fastq": ".fastq",
+    "fastq_rich": ".fastq",
+    "fasta": ".fasta",
+    "bam": ".bam",
+    "ubam": ".bam",
+    "ubam_long": ".bam",
+    "feather": ".feather",
+    "pickle": ".pickle",
+}
+WRITERS = {
+    "summary": write_summary,
+    "fastq": write_fastq,
+    "fastq_rich": lambda df, path: write_fastq(df, path, rich=True),
+    "fasta": write_fasta,
+    "bam": write_bam,
+    "ubam": lambda df, path: write_bam(df, path, aligned=False),
+    "ubam_long": lambda df, path: write_bam(df, path, aligned=False),
+    "feather": write_feather,
+    "pickle": write_pickle,
+}
+
+
+def run(source, files, outdir, threads):
+    """Run NanoComp of this checkout and return its wall time and the peak RSS in bytes.
+
+    The peak RSS from wait4 is the largest of the process and its (waited for) workers.
+    """
+    shutil.rmtree(outdir, ignore_errors=True)
+    option = LONG_SOURCES.get(source, source)
+    command = [sys.executable, "-m", "nanocomp.NanoComp", f"--{option}", *files]
+    command += ["-n", *NAMES, "-o", outdir, "-f", "json", "--tsv_stats", "-t", str(threads)]
+    start = perf_counter()
+    process = subprocess.Popen(command, cwd=REPO, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.exit(f"NanoComp failed on the {source} input, see the log in {outdir}")
+    return wall, usage.ru_maxrss * 1024
+
+
+def collect(outdir):
+    """Return the statistics and a digest of the data of every figure written to <outdir>."""
+    import plotly.io as pio
+
+    stats = pd.read_csv(os.path.join(outdir, "NanoStats.txt"), sep="\t", dtype=str)
+    figures = {}
+    for name in sorted(os.listdir(outdir)):
+        if name.endswith(".json"):
+            figure = pio.read_json(os.path.join(outdir, name), skip_invalid=True)
+            figures[name] = [digest(trace) for trace in figure.to_plotly_json()["data"]]
+    return {"stats": stats.fillna("").values.tolist(), "figures": figures}
+
+
+def digest(trace):
+    """Return the type, name and a digest of every array of a trace."""
+    summary = {"type": trace.get("type"), "name": trace.get("name")}
+    for key, value in sorted(trace.items()):
+        if isinstance(value, (list, tuple, np.ndarray)) and len(value):
+            values = np.asarray(value)
+            if values.dtype.kind in "biuf":
+                values = values.astype(float)
+                summary[key] = {
+                    "n": len(values),
+                    "sum": float(np.nansum(values)),
+                    "sha1": hashlib.sha1(np.round(values, 6).tobytes()).hexdigest(),
+                }
+            else:
+                text = "\n".join(map(str, values)).encode()
+                summary[key] = {"n": len(values), "sha1": hashlib.sha1(text).hexdigest()}
+    return summary
+
+
+def compare(golden, output):
+    """Return the differences between the golden and current output."""
+    if golden is None:
+        return ["no golden file, run with --update_golden"]
+    differences = []
+    old_stats = {row[0]: row[1:] for row in golden["stats"]}
+    for row in output["stats"]:
+        if row[0] not in old_stats:
+            differences.append(f"new statistic {row[0]}")
+        else:
+            old = old_stats.pop(row[0])
+            if not same_values(old, row[1:]):
+                differences.append(f"{row[0]}: {old} -> {row[1:]}")
+    differences.extend(f"missing statistic {name}" for name in old_stats)
+    for name in sorted(set(golden["figures"]) | set(output["figures"])):
+        if name not in output["figures"]:
+            differences.append(f"missing figure {name}")
+        elif name not in golden["figures"]:
+            differences.append(f"new figure {name}")
+        elif golden["figures"][name] != output["figures"][name]:
+            differences.append(f"data of figure {name} changed")
+    return differences
+
+
+def same_values(old, new):
+    """Return whether two rows of statistics are equal, numbers up to rounding."""
+    if len(old) != len(new):
+        return False
+    for a, b in zip(old, new):
+        try:
+            if not np.isclose(float(a), float(b), rtol=1e-9, atol=0):
+                return False
+        except ValueError:
+            if a != b:
+                return False
+    return True
+
+
+def read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as handle:
+        json.dump(data, handle, indent=1)
+        handle.write("\n")
+
+
+def fmt(value, unit):
+    if value is None:
+        return "-"
+    return f"{value:.2f}" if unit == 1 else f"{value / unit:.0f}"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
-import pandas as pd
 import plotly.graph_objects as go
 from argparse import ArgumentParser
 from plotly import subplots
+from nanocomp.extraction import get_mux_scan
 
 
 def main():
@@ -16,18 +16,17 @@ def main():
         specs=[[{}] for i in range(len(args.mux_scan_files))],
         print_grid=False,
         vertical_spacing=0.05)
-    for index, (muxfile, showlegend) in enumerate(zip(args.mux_scan_files, showlegends), start=1):
-        df = pd.read_csv(muxfile, usecols=['mux_scan_assessment', 'repeat']) \
-            .groupby("repeat")['mux_scan_assessment'] \
-            .value_counts() \
-            .unstack()
+    names = args.names or args.mux_scan_files
+    mux_scan = get_mux_scan(args.mux_scan_files, names=names, threads=len(names))
+    for index, (name, showlegend) in enumerate(zip(names, showlegends), start=1):
+        df = mux_scan.loc[name].reindex(columns=states, fill_value=0)
 
         for trace in [go.Bar(name=s, x=df.index, y=df[s],
                              marker_color=c, legendgroup=s, showlegend=showlegend)
                       for s, c in zip(states, colors)]:
             fig.append_trace(trace=trace, row=index, col=1)
     fig.update_layout(barmode='stack')
-    for index, name in enumerate(args.names or args.mux_scan_files, start=1):
+    for index, name in enumerate(names, start=1):
         fig.update_yaxes(title_text=name, row=index, col=1, range=[0, 12000])
     with open(args.output, 'w') as output:
         output.write(fig.to_html(full_html=True, include_plotlyjs='cdn'))